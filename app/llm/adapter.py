@@ -0,0 +1,236 @@
+import logging
+import threading
+from abc import ABCMeta, abstractmethod
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+
+class AdapterBackend(metaclass=ABCMeta):
+    @abstractmethod
+    def fetch(self, name: str):
+        """Reads adapter weights without touching the model, safe to run in the background."""
+        pass
+
+    @abstractmethod
+    def attach(self, name: str, fetched) -> int:
+        """Adds fetched weights to the model and returns the bytes they hold."""
+        pass
+
+    @abstractmethod
+    def detach(self, name: str):
+        pass
+
+    @abstractmethod
+    def activate(self, name: str):
+        pass
+
+
+class MockAdapterBackend(AdapterBackend):
+    """Records what the registry asks for, to test eviction and routing without torch."""
+
+    def __init__(self, sizes: dict[str, int] = None, default_size=1) -> None:
+        self.sizes = sizes or {}
+        self.default_size = default_size
+        self.events: list[tuple[str, str]] = []
+
+    def fetch(self, name: str):
+        self.events.append(("fetch", name))
+        return name
+
+    def attach(self, name: str, fetched) -> int:
+        self.events.append(("attach", name))
+        return self.sizes.get(name, self.default_size)
+
+    def detach(self, name: str):
+        self.events.append(("detach", name))
+
+    def activate(self, name: str):
+        self.events.append(("activate", name))
+
+
+class PeftAdapterBackend(AdapterBackend):
+    def __init__(self, model, adapter_dir: str) -> None:
+        self.model = model
+        self.adapter_dir = adapter_dir
+
+    def fetch(self, name: str):
+        from peft import PeftConfig
+        import torch
+
+        adapter_path = Path(self.adapter_dir, name)
+        config = PeftConfig.from_pretrained(adapter_path)
+        config.inference_mode = True
+        if (adapter_path / "adapter_model.safetensors").is_file():
+            from safetensors.torch import load_file
+
+            return config, load_file(adapter_path / "adapter_model.safetensors", device="cpu")
+        return config, torch.load(adapter_path / "adapter_model.bin", map_location="cpu")
+
+    def attach(self, name: str, fetched) -> int:
+        from peft import set_peft_model_state_dict
+
+        config, state_dict = fetched
+        self.model.add_adapter(name, config)
+        set_peft_model_state_dict(self.model, state_dict, adapter_name=name)
+        return self.size(name)
+
+    def size(self, name: str) -> int:
+        return sum(
+            parameter.numel() * parameter.element_size()
+            for parameter_name, parameter in self.model.named_parameters()
+            if f".{name}." in parameter_name
+        )
+
+    def detach(self, name: str):
+        self.model.delete_adapter(name)
+
+    def activate(self, name: str):
+        self.model.set_adapter(name)
+
+
+class AdapterRegistry:
+    """Keeps up to max_adapters LoRA adapters resident within max_bytes, evicting the least
+    recently used, and fetches adapters of queued requests in the background.
+
+    The active adapter is global to the model, so requests of one adapter may overlap, but a
+    switch waits until every in-flight request of the previous adapter is finished.
+    """
+
+    def __init__(
+        self,
+        backend: AdapterBackend,
+        max_adapters: int,
+        max_bytes: int = 0,
+        default: str = None,
+        character_adapters: dict[int, str] = None,
+    ) -> None:
+        self.backend = backend
+        self.max_adapters = max(1, max_adapters)
+        self.max_bytes = max_bytes
+        self.default = default
+        self.character_adapters = character_adapters or {}
+        self.active: str = None
+        self.loads = 0
+        self.evictions = 0
+        self.switches = 0
+        self._resident: OrderedDict[str, int] = OrderedDict()
+        self._fetching: dict[str, Future] = {}
+        # Queued requests that preloaded each adapter, fetched weights nobody waits for are dropped
+        self._wanted: dict[str, int] = {}
+        self._in_flight = 0
+        self._condition = threading.Condition()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="adapter-fetch")
+
+    def add_resident(self, name: str, nbytes: int, active=False):
+        with self._condition:
+            self._resident[name] = nbytes
+            if active:
+                self.active = name
+
+    def resolve(self, character_id: int, adapter_name: str = None) -> str | None:
+        return adapter_name or self.character_adapters.get(character_id) or self.default
+
+    def is_resident(self, name: str) -> bool:
+        return name in self._resident
+
+    def preload(self, name: str):
+        """Fetches the adapter of a queued request, which calls discard once it left the queue."""
+        if name is None:
+            return
+        with self._condition:
+            self._wanted[name] = self._wanted.get(name, 0) + 1
+        self._fetch(name)
+
+    def discard(self, name: str):
+        if name is None:
+            return
+        with self._condition:
+            wanted = self._wanted.get(name, 0) - 1
+            if wanted > 0:
+                self._wanted[name] = wanted
+                return
+            self._wanted.pop(name, None)
+            # Shed before running, its weights would otherwise stay fetched
+            future = self._fetching.pop(name, None)
+        if future is not None:
+            future.cancel()
+            logger.info("Dropped fetched adapter %s, no request waits for it", name)
+
+    def _fetch(self, name: str):
+        with self._condition:
+            if name in self._resident or name in self._fetching:
+                return
+            logger.info("Fetching adapter %s in background", name)
+            self._fetching[name] = self._executor.submit(self.backend.fetch, name)
+
+    @contextmanager
+    def use(self, name: str):
+        if name is not None and not self.is_resident(name):
+            self._fetch(name)
+            # Read the weights before waiting for the model, other adapters can still run
+            fetched = self._wait_fetched(name)
+        else:
+            fetched = None
+
+        with self._condition:
+            self._condition.wait_for(lambda: self.active == name or self._in_flight == 0)
+            if self.active != name:
+                if name not in self._resident:
+                    self._attach(name, fetched)
+                logger.info("Switching adapter from %s to %s", self.active, name)
+                self.backend.activate(name)
+                self.active = name
+                self.switches += 1
+            self._resident.move_to_end(name)
+            self._in_flight += 1
+
+        try:
+            yield name
+        finally:
+            with self._condition:
+                self._in_flight -= 1
+                self._condition.notify_all()
+
+    def _wait_fetched(self, name: str):
+        future = self._fetching.get(name)
+        if future is None:
+            return None
+        try:
+            return future.result()
+        except Exception:
+            self._fetching.pop(name, None)
+            raise
+
+    def _attach(self, name: str, fetched):
+        if fetched is None:
+            fetched = self.backend.fetch(name)
+        self._fetching.pop(name, None)
+        nbytes = self.backend.attach(name, fetched)
+        self._resident[name] = nbytes
+        self.loads += 1
+        logger.info("Attached adapter %s: %d bytes", name, nbytes)
+
+        while len(self._resident) > 1 and (
+            len(self._resident) > self.max_adapters
+            or (self.max_bytes and sum(self._resident.values()) > self.max_bytes)
+        ):
+            # The new adapter is the most recently used, so it is never the one evicted
+            evicted, _ = self._resident.popitem(last=False)
+            self.backend.detach(evicted)
+            self.evictions += 1
+            logger.info("Evicted adapter %s", evicted)
+
+    def report(self) -> dict:
+        return {
+            "resident": list(self._resident),
+            "bytes_held": sum(self._resident.values()),
+            "active": self.active,
+            "loads": self.loads,
+            "evictions": self.evictions,
+            "switches": self.switches,
+            "fetched": list(self._fetching),
+        }
@@ -1,5 +1,6 @@
+from functools import lru_cache
 from pathlib import Path
-from pydantic import root_validator
+from pydantic import root_validator, validator
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
 from app.llm.constants import ModelType
@@ -17,7 +18,58 @@ class LLMConfig(BaseSettings):
     adapter_name: str | None = None
     prompt_template: str = "Toonchat_v2.1"
     load_in_4bit: bool = True
+    # CUDA device index, or "cpu" to run a small model without a GPU
+    device: int | str = 0
+    # Compiled snapshot from `python -m app.llm.snapshot`, used when its manifest is up to date
+    snapshot_dir: str | None = None
     model_max_length: int
+    # LoRA adapters kept loaded at once and their memory cap (0 for no cap)
+    max_adapters: int = 1
+    adapter_max_bytes: int = 0
+    adapter_by_character: dict[int, str] = {}
+    # Number of tokenized prompt segments kept in memory, 0 disables the segment cache
+    segment_cache_size: int = 0
+    # Trim history and references to context_token_budget, or model_max_length - max_new_tokens
+    context_window: bool = False
+    context_token_budget: int = 0
+    context_keep_last_messages: int = 2
+    # Answers in chunks, only without the batch scheduler, which refuses to start with it
+    stream: bool = False
+    stream_interval: float = 0.2
+    stream_tokens: int = 16
+    # Memory budget of the per-conversation KV cache, 0 disables it
+    kv_cache_max_bytes: int = 0
+    # Memory budget of the per-character persona prefix cache, 0 disables it
+    prefix_cache_max_bytes: int = 0
+    prefix_cache_with_reference: bool = False
+    prefix_cache_warmup_file: str | None = None
+    # Answers kept for identical prompts and settings, 0 disables the response cache. Only
+    # greedy answers are reused unless response_cache_sampled is set
+    response_cache_size: int = 0
+    response_cache_ttl: float = 3600.0
+    response_cache_path: str | None = None
+    response_cache_disk_size: int = 100000
+    response_cache_sampled: bool = False
+    # Indexes from `python -m app.llm.retrieval`. For characters with an index, the reference
+    # is the retrieval_top_k passages that best match the latest user message, as many as fit
+    # in retrieval_token_budget, and PromptData.reference can be sent empty
+    retrieval_index_dir: str | None = None
+    retrieval_top_k: int = 4
+    retrieval_token_budget: int = 512
+    retrieval_max_indexes: int = 32
+    # Encoder the indexes were built with --embedding-model, to mix dense scores into BM25
+    retrieval_embedding_model: str | None = None
+    # Speculative templates draft with this model, or with n-grams of the prompt without one
+    draft_model_name_or_path: str | None = None
+    speculative_tokens: int = 8
+    prompt_lookup_max_ngram: int = 3
+    # Served side by side in worker processes, by the name PromptData.model routes with, e.g.
+    # {"v2.3": {"prompt_template": "Toonchat_v2.3", "pretrained_model_name_or_path": "...",
+    # "device": 1}}. The values override this config for the workers of that model
+    serve_models: dict[str, dict] = {}
+    # Model of messages without PromptData.model, the first of serve_models by default
+    default_model: str | None = None
+    workers_per_model: int = 1
 
     @root_validator(pre=True)
     def a(cls, values: dict):
@@ -36,11 +88,19 @@ class LLMConfig(BaseSettings):
 
         return values
 
+    @validator("device")
+    def device_index(cls, value):
+        return int(value) if isinstance(value, str) and value.isdigit() else value
+
     def get_adapter_path(self, adapter_name: str = None):
         return path_concat(self.adapter_dir, adapter_name if adapter_name else self.adapter_name)
 
 
-llm_config = LLMConfig()
+@lru_cache
+def get_llm_config() -> LLMConfig:
+    return LLMConfig()
+
+
 generation_config = {
     "max_time": 10,
     "max_new_tokens": 256,
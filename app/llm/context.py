@@ -0,0 +1,155 @@
+import logging
+from dataclasses import dataclass, replace
+
+from app.message_queue.data import PromptData
+from app.llm.prompter import Prompter, Segment, message_key, reference_key
+from app.llm.tokenizer import SegmentEncoder
+from app.metrics.registry import REGISTRY, Counter, Histogram
+
+logger = logging.getLogger(__name__)
+
+TRIMMED_TOKENS = REGISTRY.register(
+    Histogram(
+        "toonchat_context_trimmed_tokens",
+        "Prompt tokens trimmed per request to fit the context window",
+        buckets=(0, 16, 64, 128, 256, 512, 1024, 2048, 4096, 8192),
+    )
+)
+TRIMMED_SEGMENTS = REGISTRY.register(
+    Counter(
+        "toonchat_context_trimmed_segments_total",
+        "History messages and reference passages dropped to fit the context window",
+        ("kind",),
+    )
+)
+
+
+@dataclass
+class TrimResult:
+    data: PromptData
+    segments: list[Segment]
+    token_count: int
+    trimmed_tokens: int = 0
+    dropped_messages: int = 0
+    dropped_references: int = 0
+
+
+def _bigrams(text: str) -> set[str]:
+    return {text[i : i + 2] for i in range(len(text) - 1)}
+
+
+def reference_relevance(reference: str, query: str) -> float:
+    """Character bigram overlap, which works for Korean text without a morphological analyzer."""
+    reference_bigrams = _bigrams(reference)
+    if not reference_bigrams:
+        return 0.0
+    return len(reference_bigrams & _bigrams(query)) / len(reference_bigrams)
+
+
+class ContextWindow:
+    """Fits a prompt into token_budget by dropping the oldest messages, then the least relevant
+    reference passages, while always keeping the persona and the latest message.
+
+    Token counts come from the per-segment cache of the SegmentEncoder, so deciding what to drop
+    only subtracts cached lengths instead of re-tokenizing the prompt.
+    """
+
+    def __init__(
+        self,
+        prompter: Prompter,
+        segment_encoder: SegmentEncoder,
+        token_budget: int,
+        keep_last_messages: int = 2,
+    ) -> None:
+        self.prompter = prompter
+        self.segment_encoder = segment_encoder
+        self.token_budget = token_budget
+        self.keep_last_messages = max(1, keep_last_messages)
+
+    def fit(self, data: PromptData) -> TrimResult:
+        segments = self.prompter.get_segments(data)
+        lengths = self.segment_encoder.segment_lengths(segments)
+        token_count = sum(lengths)
+        result = TrimResult(data, segments, token_count)
+        if token_count <= self.token_budget:
+            TRIMMED_TOKENS.observe(0)
+            return result
+
+        messages = list(data.get_chat_history_list())
+        references = list(data.get_reference_list())
+        message_lengths = self._match_lengths(segments, lengths, map(message_key, messages))
+        reference_lengths = self._match_lengths(segments, lengths, map(reference_key, references))
+
+        # Rendering can change with what is dropped, so re-count and keep trimming if still over
+        while token_count > self.token_budget:
+            estimate = token_count
+            dropped_messages, dropped_references = 0, set()
+
+            keep = min(self.keep_last_messages, len(messages))
+            while estimate > self.token_budget and dropped_messages < len(messages) - keep:
+                estimate -= message_lengths[dropped_messages]
+                dropped_messages += 1
+
+            query = messages[-1].content if messages else ""
+            for i in sorted(
+                range(len(references)),
+                key=lambda i: reference_relevance(references[i], query),
+            ):
+                if estimate <= self.token_budget:
+                    break
+                if not reference_lengths[i]:
+                    continue
+                estimate -= reference_lengths[i]
+                dropped_references.add(i)
+
+            while estimate > self.token_budget and dropped_messages < len(messages) - 1:
+                estimate -= message_lengths[dropped_messages]
+                dropped_messages += 1
+
+            if dropped_messages == 0 and not dropped_references:
+                logger.warning(
+                    "Prompt of %d tokens can not fit in %d tokens", token_count, self.token_budget
+                )
+                break
+
+            messages = messages[dropped_messages:]
+            message_lengths = message_lengths[dropped_messages:]
+            references = [r for i, r in enumerate(references) if i not in dropped_references]
+            reference_lengths = [
+                length for i, length in enumerate(reference_lengths) if i not in dropped_references
+            ]
+            result.dropped_messages += dropped_messages
+            result.dropped_references += len(dropped_references)
+
+            result.data = replace(
+                data, reference=references, history=replace(data.history, messages=messages)
+            )
+            result.segments = self.prompter.get_segments(result.data)
+            token_count = sum(self.segment_encoder.segment_lengths(result.segments))
+
+        result.token_count = token_count
+        result.trimmed_tokens = sum(lengths) - token_count
+        TRIMMED_TOKENS.observe(result.trimmed_tokens)
+        TRIMMED_SEGMENTS.labels("message").inc(result.dropped_messages)
+        TRIMMED_SEGMENTS.labels("reference").inc(result.dropped_references)
+        logger.info(
+            "Trimmed %d tokens (%d messages, %d references) to fit %d tokens",
+            result.trimmed_tokens,
+            result.dropped_messages,
+            result.dropped_references,
+            self.token_budget,
+        )
+        return result
+
+    def _match_lengths(self, segments: list[Segment], lengths: list[int], keys) -> list[int]:
+        """Token length of the segment of each key, matched in order; 0 if it is not rendered."""
+        matched, position = [], 0
+        for key in keys:
+            for i in range(position, len(segments)):
+                if segments[i][0] == key:
+                    matched.append(lengths[i])
+                    position = i + 1
+                    break
+            else:
+                matched.append(0)
+        return matched
@@ -1,7 +1,7 @@
 from typing import Dict, Tuple
 import app.llm.prompter as prompter
 import app.llm.models as models
-from app.llm.config import llm_config
+from app.llm.config import get_llm_config
 
 
 class LLMFactory:
@@ -11,16 +11,25 @@ class LLMFactory:
     def register_llm_model(self, model_name, llm_model: models.LLM, prompter: prompter.Prompter):
         self.llm_models[model_name] = (llm_model, prompter)
 
-    def create_llm(self, model_name, dir_path=None) -> models.LLM:
+    def create_llm(self, model_name, dir_path=None, **overrides) -> models.LLM:
+        """overrides replace values of the LLM config, e.g. the path of one of several models."""
         if model_name not in self.llm_models:
             raise ValueError(f"Unsupported LLM model: {model_name}")
 
         model_class, prompter_class = self.llm_models[model_name]
 
-        return model_class(prompter_class=prompter_class, **llm_config.model_dump())
+        return model_class(
+            prompter_class=prompter_class, **{**get_llm_config().model_dump(), **overrides}
+        )
 
 
 llm_factory = LLMFactory()
 llm_factory.register_llm_model("Mock", models.MockLLM, prompter.MockPrompter)
 llm_factory.register_llm_model("Toonchat_v2.1", models.HuggingfaceLLM, prompter.ToonchatV21Prompter)
 llm_factory.register_llm_model("Toonchat_v2.3", models.HuggingfaceLLM, prompter.ToonchatV23Prompter)
+llm_factory.register_llm_model(
+    "Toonchat_v2.1_speculative", models.SpeculativeLLM, prompter.ToonchatV21Prompter
+)
+llm_factory.register_llm_model(
+    "Toonchat_v2.3_speculative", models.SpeculativeLLM, prompter.ToonchatV23Prompter
+)
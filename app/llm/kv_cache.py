@@ -0,0 +1,206 @@
+import copy
+import hashlib
+import logging
+import threading
+from array import array
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Hashable, Sequence
+
+logger = logging.getLogger(__name__)
+
+
+def hash_token_ids(token_ids: Sequence[int]) -> str:
+    return hashlib.blake2b(array("q", token_ids).tobytes(), digest_size=16).hexdigest()
+
+
+def common_prefix_length(a: Sequence[int], b: Sequence[int]) -> int:
+    length = min(len(a), len(b))
+    for i in range(length):
+        if a[i] != b[i]:
+            return i
+    return length
+
+
+def past_key_values_length(past_key_values) -> int:
+    if hasattr(past_key_values, "get_seq_length"):
+        return past_key_values.get_seq_length()
+    return past_key_values[0][0].shape[-2]
+
+
+def past_key_values_nbytes(past_key_values) -> int:
+    if hasattr(past_key_values, "key_cache"):
+        tensors = [*past_key_values.key_cache, *past_key_values.value_cache]
+    else:
+        tensors = [tensor for layer in past_key_values for tensor in layer]
+    return sum(tensor.numel() * tensor.element_size() for tensor in tensors)
+
+
+def crop_past_key_values(past_key_values, length: int):
+    if hasattr(past_key_values, "crop"):
+        past_key_values.crop(length)
+        return past_key_values
+    return tuple(tuple(tensor[..., :length, :] for tensor in layer) for layer in past_key_values)
+
+
+@dataclass
+class KVCacheEntry:
+    token_ids: list[int]
+    prefix_hash: str
+    past_key_values: object
+    nbytes: int
+
+
+class ConversationKVCache:
+    """Keeps the KV cache of the last turn of each conversation, LRU evicted under max_bytes.
+
+    An entry is taken out of the cache while it is used, since generate extends it in place,
+    and put back with the new turn appended once generation is finished.
+    """
+
+    def __init__(self, max_bytes: int) -> None:
+        self.max_bytes = max_bytes
+        self._entries: OrderedDict[Hashable, KVCacheEntry] = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.reused_tokens = 0
+
+    def take(self, conversation_id: Hashable, token_ids: list[int]):
+        """Returns (past_key_values, prefix_length) reusable for token_ids, or (None, 0)."""
+        with self._lock:
+            entry = self._entries.pop(conversation_id, None)
+            if entry is not None:
+                self._bytes -= entry.nbytes
+
+        prefix_length = 0
+        if entry is not None:
+            cached_length = len(entry.token_ids)
+            if cached_length < len(token_ids) and (
+                hash_token_ids(token_ids[:cached_length]) == entry.prefix_hash
+            ):
+                prefix_length = cached_length
+            else:
+                prefix_length = common_prefix_length(entry.token_ids, token_ids)
+            # At least one token has to be prefilled to get the next token logits
+            prefix_length = min(prefix_length, len(token_ids) - 1)
+
+        if prefix_length <= 0:
+            self.misses += 1
+            return None, 0
+
+        self.hits += 1
+        self.reused_tokens += prefix_length
+        past_key_values = entry.past_key_values
+        if prefix_length < len(entry.token_ids):
+            past_key_values = crop_past_key_values(past_key_values, prefix_length)
+        return past_key_values, prefix_length
+
+    def put(self, conversation_id: Hashable, token_ids: list[int], past_key_values):
+        nbytes = past_key_values_nbytes(past_key_values)
+        if nbytes > self.max_bytes:
+            logger.debug("KV cache of %s is over the budget: %d bytes", conversation_id, nbytes)
+            return
+
+        entry = KVCacheEntry(token_ids, hash_token_ids(token_ids), past_key_values, nbytes)
+        with self._lock:
+            previous = self._entries.pop(conversation_id, None)
+            if previous is not None:
+                self._bytes -= previous.nbytes
+            while self._entries and self._bytes + nbytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= evicted.nbytes
+            self._entries[conversation_id] = entry
+            self._bytes += nbytes
+
+    def report(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes_held": self._bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "reused_tokens": self.reused_tokens,
+        }
+
+
+@dataclass
+class PrefixCacheEntry:
+    token_ids: list[int]
+    past_key_values: object
+    nbytes: int
+    hits: int = 0
+
+
+class SharedPrefixCache:
+    """Precomputed persona (and reference) prefix states shared by every user of a character.
+
+    Entries are keyed by characterId and the hash of the prefix token ids, LFU evicted under
+    max_bytes. Lookups hand out a copy, since generate extends the cache in place.
+    """
+
+    def __init__(self, max_bytes: int) -> None:
+        self.max_bytes = max_bytes
+        self._entries: dict[tuple[Hashable, str], PrefixCacheEntry] = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.reused_tokens = 0
+
+    def lookup(self, character_id: Hashable, token_ids: list[int]):
+        """Returns a copy of (past_key_values, prefix_length) of the longest cached prefix."""
+        best, prefix_length = None, 0
+        with self._lock:
+            for (entry_character_id, _), entry in self._entries.items():
+                if entry_character_id != character_id:
+                    continue
+                length = min(common_prefix_length(entry.token_ids, token_ids), len(token_ids) - 1)
+                if length > prefix_length:
+                    best, prefix_length = entry, length
+            if best is not None:
+                best.hits += 1
+
+        if best is None:
+            self.misses += 1
+            return None, 0
+
+        self.hits += 1
+        self.reused_tokens += prefix_length
+        return (
+            crop_past_key_values(copy.deepcopy(best.past_key_values), prefix_length),
+            prefix_length,
+        )
+
+    def put(self, character_id: Hashable, token_ids: list[int], past_key_values):
+        nbytes = past_key_values_nbytes(past_key_values)
+        if nbytes > self.max_bytes:
+            logger.warning(
+                "Prefix of character %s is over the budget: %d bytes", character_id, nbytes
+            )
+            return
+
+        key = (character_id, hash_token_ids(token_ids))
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._bytes -= previous.nbytes
+            while self._entries and self._bytes + nbytes > self.max_bytes:
+                evicted_key = min(self._entries, key=lambda k: self._entries[k].hits)
+                self._bytes -= self._entries.pop(evicted_key).nbytes
+                logger.info("Evicted prefix of character %s", evicted_key[0])
+            self._entries[key] = PrefixCacheEntry(token_ids, past_key_values, nbytes)
+            self._bytes += nbytes
+
+    def report(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes_held": self._bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "reused_tokens": self.reused_tokens,
+        }
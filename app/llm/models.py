@@ -1,61 +1,304 @@
 import time
+import json
+import threading
+from typing import Iterator
 from abc import ABCMeta, abstractmethod
 import logging
-from pathlib import Path
+from contextlib import nullcontext
 
 from app.utils import log_execution_time, path_concat
 from app.message_queue.data import PromptData
-from app.llm.prompter import Prompter
+from app.llm.prompter import Prompter, Segment, join_segments
 from app.llm.constants import ModelType
-from app.llm.config import llm_config, generation_config
-from app.llm.tokenizer import load_tokenizer, tokenizer_encode, tokenizer_decode
+from app.llm.config import generation_config
+from app.llm.streamer import TokenStreamer, IncrementalDecoder
+from app.llm.context import ContextWindow
+from app.llm.adapter import AdapterRegistry, PeftAdapterBackend
+from app.llm.snapshot import find_snapshot
+from app.metrics.registry import STAGE_SECONDS, TOKENS, ERRORS
+from app.llm.kv_cache import ConversationKVCache, SharedPrefixCache, past_key_values_length
+from app.llm.response_cache import ResponseCache, response_key
+from app.llm.stop_sequences import StopSequences, StopTextFilter
+from app.llm.retrieval import ReferenceRetriever, TextEmbedder
+from app.scheduler.admission import kv_bytes_per_token
+from app.llm.speculative import (
+    ModelDrafter,
+    PromptLookupDrafter,
+    SpeculationStats,
+    load_draft_model,
+    model_sampling_settings,
+    speculative_decode,
+)
+from app.llm.tokenizer import (
+    load_tokenizer,
+    tokenizer_encode,
+    tokenizer_encode_batch,
+    tokenizer_decode_batch,
+    to_input_ids,
+    SegmentEncoder,
+)
 
 logger = logging.getLogger(__name__)
 
+PROMPT_BUILD_SECONDS = STAGE_SECONDS.labels("prompt_build")
+PREFILL_SECONDS = STAGE_SECONDS.labels("prefill")
+DECODE_SECONDS = STAGE_SECONDS.labels("decode")
+TOKENS_IN = TOKENS.labels("in")
+TOKENS_OUT = TOKENS.labels("out")
+GENERATE_ERRORS = ERRORS.labels("generate")
+
+
+class GenerationTimer:
+    """Splits a generate call into prefill, up to the first stopping criteria call, and decode.
+
+    Stopping criteria run once per generated token, so the first call marks the end of the
+    forward pass over the prompt and the number of calls is the number of decode steps.
+    """
+
+    def __init__(self) -> None:
+        self.begin()
+
+    def begin(self):
+        self.start = time.perf_counter()
+        self.first_token = None
+        self.steps = 0
+
+    def step(self):
+        if self.first_token is None:
+            self.first_token = time.perf_counter()
+        self.steps += 1
+
+    def observe(self):
+        end = time.perf_counter()
+        if self.first_token is None:
+            PREFILL_SECONDS.observe(end - self.start)
+            return
+        PREFILL_SECONDS.observe(self.first_token - self.start)
+        DECODE_SECONDS.observe(end - self.first_token)
+
+
+def stopping_criteria(
+    cancel=None,
+    timer: GenerationTimer = None,
+    stop_sequences: StopSequences = None,
+    prompt_length: int = 0,
+) -> dict:
+    """generate kwargs that stop a row once its event is set, cancel has one event per row,
+    or once it generated one of stop_sequences, and step timer on every generated token."""
+    from transformers import StoppingCriteria, StoppingCriteriaList
+    import torch
+
+    criteria = []
+    if cancel is not None:
+
+        class Cancelled(StoppingCriteria):
+            def __call__(self, input_ids, scores, **kwargs):
+                return torch.tensor([event.is_set() for event in cancel], device=input_ids.device)
+
+        criteria.append(Cancelled())
+    if timer is not None:
+
+        class Timed(StoppingCriteria):
+            def __call__(self, input_ids, scores, **kwargs):
+                timer.step()
+                return torch.zeros(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
+
+        criteria.append(Timed())
+    if stop_sequences:
+
+        class Stopped(StoppingCriteria):
+            def __call__(self, input_ids, scores, **kwargs):
+                start = max(prompt_length, input_ids.shape[1] - stop_sequences.max_length)
+                return torch.tensor(
+                    [stop_sequences.ends_with_stop(row) for row in input_ids[:, start:].tolist()],
+                    device=input_ids.device,
+                )
+
+        criteria.append(Stopped())
+    return {"stopping_criteria": StoppingCriteriaList(criteria)} if criteria else {}
+
 
 class LLM(metaclass=ABCMeta):
     @abstractmethod
     def __init__(self, **kwargs) -> None:
         pass
 
+    # generation_kwargs may carry cancel, a list of one threading.Event per row that stops
+    # generating that row once set
     @abstractmethod
     def generate(self, data: PromptData, **generation_kwargs):
         pass
 
+    def generate_batch(self, data_list: list[PromptData], **generation_kwargs) -> list[str]:
+        return [self.generate(data, **generation_kwargs) for data in data_list]
+
+    def generate_stream(self, data: PromptData, **generation_kwargs) -> Iterator[str]:
+        yield self.generate(data, **generation_kwargs)
+
+    def count_tokens(self, data: PromptData) -> int:
+        return 0
+
+    def kv_bytes_per_token(self) -> int:
+        """KV cache bytes per token of a sequence, 0 when unknown."""
+        return 0
+
+    def get_adapter(self, data: PromptData) -> str | None:
+        return None
+
+    def active_adapter(self) -> str | None:
+        return None
+
+    def preload_adapter(self, adapter_name: str):
+        return None
+
+    def discard_adapter(self, adapter_name: str):
+        """The request that preloaded adapter_name left the queue."""
+        return None
+
 
 class MockLLM(LLM):
     def __init__(self, **kwargs) -> None:
-        pass
+        # Simulated cost of a generate call: fixed per call plus per sequence in the batch
+        self.latency = kwargs.get("mock_latency", 0.0)
+        self.latency_per_sequence = kwargs.get("mock_latency_per_sequence", 0.0)
+        self.latency_per_token = kwargs.get("mock_latency_per_token", 0.0)
+        self.answer = kwargs.get("mock_answer", "This is a Mock LLM")
 
     def generate(self, data: PromptData, **generation_kwargs):
-        return "This is a Mock LLM"
+        return self.generate_batch([data], **generation_kwargs)[0]
+
+    def generate_batch(self, data_list: list[PromptData], **generation_kwargs) -> list[str]:
+        cancel = generation_kwargs.pop("cancel", None)
+        events = cancel or [None] * len(data_list)
+        if self.latency or self.latency_per_sequence:
+            self._sleep(self.latency + self.latency_per_sequence * len(data_list), events)
+        return ["" if event is not None and event.is_set() else self.answer for event in events]
+
+    def _sleep(self, seconds: float, events: list):
+        if all(event is None for event in events):
+            time.sleep(seconds)
+            return
+        # Like a stopping criterion, the call ends early once every row is cancelled
+        end = time.monotonic() + seconds
+        while time.monotonic() < end and not all(event.is_set() for event in events):
+            time.sleep(min(0.01, max(0.0, end - time.monotonic())))
+
+    def generate_stream(self, data: PromptData, **generation_kwargs) -> Iterator[str]:
+        cancel = generation_kwargs.get("cancel") or []
+        for i, word in enumerate(self.generate(data, **generation_kwargs).split(" ")):
+            time.sleep(self.latency_per_token)
+            if any(event.is_set() for event in cancel):
+                return
+            yield word if i == 0 else f" {word}"
+
+    def count_tokens(self, data: PromptData) -> int:
+        return sum(len(message.content) for message in data.get_chat_history_list())
 
 
 class HuggingfaceLLM(LLM):
     model = None
 
     def __init__(self, **kwargs) -> None:
-        self.tokenizer = load_tokenizer(kwargs.get("pretrained_model_name_or_path"), kwargs)
+        self.snapshot = find_snapshot(kwargs)
+        model_path = (
+            kwargs.get("snapshot_dir")
+            if self.snapshot
+            else kwargs.get("pretrained_model_name_or_path")
+        )
+        self.tokenizer = load_tokenizer(model_path, kwargs)
         prompter_class = kwargs.pop("prompter_class")
         self.prompter: Prompter = prompter_class(tokenizer=self.tokenizer)
-        self.load_pretrained_model(kwargs.get("pretrained_model_name_or_path"), kwargs)
+        self.stop_sequences = StopSequences(self.tokenizer, self.prompter.stop_sequences)
+        self.retriever: ReferenceRetriever = None
+        if kwargs.get("retrieval_index_dir"):
+            embedder = None
+            if kwargs.get("retrieval_embedding_model"):
+                embedder = TextEmbedder(
+                    kwargs.get("retrieval_embedding_model"), kwargs.get("device", 0)
+                )
+            self.retriever = ReferenceRetriever(
+                kwargs.get("retrieval_index_dir"),
+                kwargs.get("retrieval_top_k", 4),
+                kwargs.get("retrieval_token_budget", 512),
+                kwargs.get("retrieval_max_indexes", 32),
+                lambda text: len(self.tokenizer.encode(text, add_special_tokens=False)),
+                embedder,
+            )
+        self.segment_encoder: SegmentEncoder = None
+        if kwargs.get("segment_cache_size"):
+            self.segment_encoder = SegmentEncoder(self.tokenizer, kwargs.get("segment_cache_size"))
+
+        self.context_window: ContextWindow = None
+        if kwargs.get("context_window"):
+            self.context_window = ContextWindow(
+                self.prompter,
+                # Only the per-segment counts are needed when the segment cache is disabled
+                self.segment_encoder or SegmentEncoder(self.tokenizer, 4096, verify_every=0),
+                kwargs.get("context_token_budget")
+                or self.tokenizer.model_max_length - generation_config["max_new_tokens"],
+                kwargs.get("context_keep_last_messages", 2),
+            )
+        self.load_pretrained_model(model_path, kwargs)
 
-        if kwargs.pop("model_type") == ModelType.LoRA:
-            self.load_peft_model(path_concat(kwargs.pop("adapter_dir"), kwargs.pop("adapter_name")))
+        self.adapters: AdapterRegistry = None
+        model_type = kwargs.pop("model_type")
+        if (
+            model_type == ModelType.LoRA
+            and self.snapshot
+            and self.snapshot["source"]["merged_adapter"]
+        ):
+            # The adapter is part of the snapshot weights, there is nothing to switch between
+            logger.info("Adapter %s is merged in the snapshot", kwargs.get("adapter_name"))
+        elif model_type == ModelType.LoRA:
+            adapter_dir, adapter_name = kwargs.pop("adapter_dir"), kwargs.pop("adapter_name")
+            self.load_peft_model(path_concat(adapter_dir, adapter_name))
+            backend = PeftAdapterBackend(self.model, adapter_dir)
+            self.adapters = AdapterRegistry(
+                backend,
+                kwargs.get("max_adapters", 1),
+                kwargs.get("adapter_max_bytes", 0),
+                default=adapter_name,
+                character_adapters=kwargs.get("adapter_by_character"),
+            )
+            self.adapters.add_resident(adapter_name, backend.size(adapter_name), active=True)
 
         self.model.eval()
 
+        self.kv_cache: ConversationKVCache = None
+        if kwargs.get("kv_cache_max_bytes"):
+            self.kv_cache = ConversationKVCache(kwargs.get("kv_cache_max_bytes"))
+
+        self.prefix_cache: SharedPrefixCache = None
+        self.prefix_cache_with_reference = kwargs.get("prefix_cache_with_reference", False)
+        if kwargs.get("prefix_cache_max_bytes"):
+            self.prefix_cache = SharedPrefixCache(kwargs.get("prefix_cache_max_bytes"))
+            if kwargs.get("prefix_cache_warmup_file"):
+                self.warm_prefix_cache(kwargs.get("prefix_cache_warmup_file"))
+
+        self.response_cache: ResponseCache = None
+        if kwargs.get("response_cache_size"):
+            self.response_cache = ResponseCache(
+                kwargs.get("response_cache_size"),
+                kwargs.get("response_cache_ttl", 3600.0),
+                kwargs.get("response_cache_path"),
+                kwargs.get("response_cache_disk_size", 100000),
+                kwargs.get("response_cache_sampled", False),
+            )
+
     @log_execution_time
     def load_pretrained_model(self, pretrained_model_name_or_path, kwargs: dict):
         from transformers import AutoModelForCausalLM, PreTrainedModel
         import torch
 
         logger.info("Start loading Model from path: %s", pretrained_model_name_or_path)
+        # A snapshot is saved already quantized, its config carries the quantization settings
+        # and the safetensors files are memory-mapped as they are
+        load_in_4bit = kwargs.pop("load_in_4bit", True) and not self.snapshot
         self.model: PreTrainedModel = AutoModelForCausalLM.from_pretrained(
             pretrained_model_name_or_path,
             torch_dtype=torch.bfloat16,
-            load_in_4bit=kwargs.pop("load_in_4bit", True),
-            device_map={"": 0},
+            load_in_4bit=load_in_4bit,
+            device_map={"": kwargs.get("device", 0)},
         )
         logger.info("Finished to load Model")
 
@@ -71,54 +314,491 @@ class HuggingfaceLLM(LLM):
 
     def generate(self, data: PromptData, **generation_kwargs):
         start_time = time.time()
-        prompt = self.prompter.get_prompt(data)
-        encoded_prompt = tokenizer_encode(self.tokenizer, prompt)
+        with PROMPT_BUILD_SECONDS.time():
+            segments = self.get_segments(data)
+        encoded_prompt = self.encode_segments(segments)
 
         token_length = len(encoded_prompt[0])
+        TOKENS_IN.inc(token_length)
         logger.info(
             f"Start inference. query: {data.get_chat_history_list()[-1].content}, token_len: {token_length}"
         )
 
+        adapter = self.get_adapter(data)
+        cache_key = self.response_cache_key(encoded_prompt[0].tolist(), generation_kwargs, adapter)
+        if cache_key is not None:
+            cached = self.response_cache.get(cache_key)
+            if cached is not None:
+                logger.info("Answered from response cache: %s", self.response_cache.report())
+                return cached
+
+        timer = GenerationTimer()
+        stopping_kwargs = stopping_criteria(
+            generation_kwargs.pop("cancel", None), timer, self.stop_sequences, token_length
+        )
+        with self.use_adapter(adapter):
+            cache_kwargs = {}
+            if self.kv_cache is not None or self.prefix_cache is not None:
+                past_key_values, prefix_length = self.find_past_key_values(
+                    data, encoded_prompt[0].tolist(), adapter
+                )
+                cache_kwargs["past_key_values"] = past_key_values
+                logger.info(
+                    "Reusing %d of %d prompt tokens from KV cache", prefix_length, token_length
+                )
+            if self.kv_cache is not None:
+                cache_kwargs["return_dict_in_generate"] = True
+
+            try:
+                timer.begin()
+                output = self.model.generate(
+                    inputs=encoded_prompt.to(self.model.device),
+                    **cache_kwargs,
+                    **stopping_kwargs,
+                    **{**generation_config, **generation_kwargs},
+                )
+            except Exception as e:
+                GENERATE_ERRORS.inc()
+                logger.error("Error occured while generating answer.\n%s", e)
+                return ""
+            timer.observe()
+
+        if self.kv_cache is not None:
+            # KV states depend on the adapter, so they are only reused with the same one
+            self.cache_conversation((data.history._id, adapter), output)
+            output = output.sequences
+
+        generated_ids = output[0, token_length:].tolist()
+        TOKENS_OUT.inc(len(generated_ids))
+        inference_result = self.decode_answers([generated_ids], generation_kwargs)[0]
+        inference_time = time.time() - start_time
+        if cache_key is not None and self.is_finished(generated_ids, generation_kwargs):
+            self.response_cache.put(cache_key, inference_result, inference_time)
+        logger.info(
+            f"Inference finished. result:{inference_result}, tps: {len(generated_ids)/inference_time} tokens/s"
+        )
+
+        return inference_result
+
+    def find_past_key_values(self, data: PromptData, token_ids: list[int], adapter: str = None):
+        past_key_values, prefix_length = None, 0
+        if self.kv_cache is not None:
+            past_key_values, prefix_length = self.kv_cache.take(
+                (data.history._id, adapter), token_ids
+            )
+        if past_key_values is not None or self.prefix_cache is None:
+            return past_key_values, prefix_length
+
+        prefix_key = (data.get_character_id(), adapter)
+        past_key_values, prefix_length = self.prefix_cache.lookup(prefix_key, token_ids)
+        if past_key_values is None:
+            references = data.get_reference_list() if self.prefix_cache_with_reference else None
+            self.build_prefix_state(prefix_key, data.get_persona(), references)
+            past_key_values, prefix_length = self.prefix_cache.lookup(prefix_key, token_ids)
+        logger.info("Prefix cache: %s", self.prefix_cache.report())
+        return past_key_values, prefix_length
+
+    def build_prefix_state(self, prefix_key: tuple, persona: str, references: list[str] = None):
+        """prefix_key is (characterId, adapter), the adapter the state is computed with."""
+        import torch
+
+        system_prompt = self.prompter.get_system_prompt(persona, references)
+        if not system_prompt:
+            return
+
+        encoded_prefix = tokenizer_encode(self.tokenizer, system_prompt)
+        with self.use_adapter(prefix_key[1]), torch.no_grad():
+            output = self.model(input_ids=encoded_prefix.to(self.model.device), use_cache=True)
+        self.prefix_cache.put(prefix_key, encoded_prefix[0].tolist(), output.past_key_values)
+
+    @log_execution_time
+    def warm_prefix_cache(self, warmup_file: str):
+        """Builds prefix states from a json list of {characterId, persona, reference}."""
+        with open(warmup_file, encoding="utf-8") as f:
+            characters = json.load(f)
+
+        for character in characters:
+            persona = character.get("persona", "")
+            references = None
+            if self.prefix_cache_with_reference:
+                references = character.get("reference", [])
+                references = references if isinstance(references, list) else [references]
+            character_id = character.get("characterId")
+            adapter = self.adapters.resolve(character_id) if self.adapters is not None else None
+            self.build_prefix_state(
+                (character_id, adapter),
+                " ".join(persona) if isinstance(persona, list) else persona,
+                references,
+            )
+        logger.info("Warmed prefix cache for %d characters", len(characters))
+
+    def cache_conversation(self, conversation_id: tuple, output):
+        # The last generated token is never fed back, so the cache is one token shorter
+        cached_length = past_key_values_length(output.past_key_values)
+        self.kv_cache.put(
+            conversation_id, output.sequences[0, :cached_length].tolist(), output.past_key_values
+        )
+        logger.info("KV cache: %s", self.kv_cache.report())
+
+    def generate_batch(self, data_list: list[PromptData], **generation_kwargs) -> list[str]:
+        if len(data_list) == 1:
+            return [self.generate(data_list[0], **generation_kwargs)]
+
+        start_time = time.time()
+        with PROMPT_BUILD_SECONDS.time():
+            prompts = [join_segments(self.get_segments(data)) for data in data_list]
+        encoded_prompts = tokenizer_encode_batch(self.tokenizer, prompts)
+        prompt_length = encoded_prompts["input_ids"].shape[1]
+        # Batches are grouped by adapter by the scheduler
+        adapter = self.get_adapter(data_list[0])
+
+        results, cache_keys = [None] * len(data_list), [None] * len(data_list)
+        for i in range(len(data_list)):
+            token_ids = encoded_prompts["input_ids"][i][encoded_prompts["attention_mask"][i] == 1]
+            cache_keys[i] = self.response_cache_key(token_ids.tolist(), generation_kwargs, adapter)
+            if cache_keys[i] is not None:
+                results[i] = self.response_cache.get(cache_keys[i])
+        misses = [i for i, result in enumerate(results) if result is None]
+        if not misses:
+            return results
+        if len(misses) < len(data_list):
+            # Only the rows without a cached answer are generated
+            encoded_prompts = {key: value[misses] for key, value in encoded_prompts.items()}
+        cancel = generation_kwargs.pop("cancel", None)
+        if cancel is not None:
+            cancel = [cancel[i] for i in misses]
+
+        TOKENS_IN.inc(int(encoded_prompts["attention_mask"].sum()))
+        logger.info(f"Start batch inference. batch_size: {len(misses)}, token_len: {prompt_length}")
+
+        timer = GenerationTimer()
+        stopping_kwargs = stopping_criteria(cancel, timer, self.stop_sequences, prompt_length)
+        with self.use_adapter(adapter):
+            try:
+                timer.begin()
+                output = self.model.generate(
+                    **{key: value.to(self.model.device) for key, value in encoded_prompts.items()},
+                    **stopping_kwargs,
+                    **{**generation_config, **generation_kwargs},
+                )
+            except Exception as e:
+                GENERATE_ERRORS.inc()
+                logger.error("Error occured while generating batch answers.\n%s", e)
+                return [result or "" for result in results]
+            timer.observe()
+
+        # Rows that stopped early are padded with pad_token_id, which is the eos token
+        TOKENS_OUT.inc(int((output[:, prompt_length:] != self.tokenizer.pad_token_id).sum()))
+        inference_results = self.decode_answers(
+            output[:, prompt_length:].tolist(), generation_kwargs
+        )
+        inference_time = time.time() - start_time
+        logger.info(
+            f"Batch inference finished. batch_size: {len(misses)}, tps: {(output.numel() - encoded_prompts['input_ids'].numel())/inference_time} tokens/s"
+        )
+
+        for row, i in enumerate(misses):
+            results[i] = inference_results[row]
+            # A cancelled row is padded like one that ended on eos
+            cancelled = cancel is not None and cancel[row].is_set()
+            if (
+                cache_keys[i] is not None
+                and not cancelled
+                and self.is_finished(output[row, prompt_length:], generation_kwargs)
+            ):
+                # A batched answer costs its share of the generate call
+                self.response_cache.put(cache_keys[i], results[i], inference_time / len(misses))
+        return results
+
+    def generate_stream(self, data: PromptData, **generation_kwargs) -> Iterator[str]:
+        with PROMPT_BUILD_SECONDS.time():
+            segments = self.get_segments(data)
+        encoded_prompt = self.encode_segments(segments)
+        TOKENS_IN.inc(len(encoded_prompt[0]))
+        logger.info(
+            f"Start streaming inference. query: {data.get_chat_history_list()[-1].content}, token_len: {len(encoded_prompt[0])}"
+        )
+
+        streamer = TokenStreamer(self.tokenizer)
+        timer = GenerationTimer()
+        stopping_kwargs = stopping_criteria(
+            generation_kwargs.pop("cancel", None),
+            timer,
+            self.stop_sequences,
+            len(encoded_prompt[0]),
+        )
+        thread = threading.Thread(
+            target=self._generate_to_streamer,
+            args=(
+                streamer,
+                encoded_prompt,
+                self.get_adapter(data),
+                {**generation_config, **generation_kwargs, **stopping_kwargs},
+            ),
+        )
+        timer.begin()
+        thread.start()
+        yield from self.filter_stop_sequences(streamer)
+        thread.join()
+        timer.observe()
+        TOKENS_OUT.inc(timer.steps)
+        if self.stop_sequences.ends_with_stop(streamer.decoder.token_ids):
+            self.stop_sequences.record(
+                timer.steps, {**generation_config, **generation_kwargs}.get("max_new_tokens")
+            )
+
+    def _generate_to_streamer(
+        self, streamer: TokenStreamer, encoded_prompt, adapter: str, generation_kwargs
+    ):
         try:
-            output = self.model.generate(
-                inputs=encoded_prompt.to(0), **{**generation_config, **generation_kwargs}
+            with self.use_adapter(adapter):
+                self.model.generate(
+                    inputs=encoded_prompt.to(self.model.device),
+                    streamer=streamer,
+                    **generation_kwargs,
+                )
+        except Exception as e:
+            GENERATE_ERRORS.inc()
+            logger.error("Error occured while streaming answer.\n%s", e)
+            streamer.end()
+
+    def count_tokens(self, data: PromptData) -> int:
+        return len(self.encode_segments(self.get_segments(data))[0])
+
+    def kv_bytes_per_token(self) -> int:
+        import torch
+
+        return kv_bytes_per_token(self.model.config, torch.finfo(self.model.dtype).bits // 8)
+
+    def response_cache_key(self, token_ids: list[int], generation_kwargs: dict, adapter: str):
+        """Key of the answer in the response cache, None when it may not be cached."""
+        if self.response_cache is None:
+            return None
+        settings = {**generation_config, **generation_kwargs}
+        if not self.response_cache.cacheable(settings):
+            return None
+        return response_key(token_ids, settings, adapter)
+
+    def is_finished(self, generated_ids: list[int], generation_kwargs: dict) -> bool:
+        """Whether generation ended on eos, a stop sequence or max_new_tokens rather than
+        max_time or a cancel."""
+        max_new_tokens = {**generation_config, **generation_kwargs}.get("max_new_tokens")
+        return (
+            self.tokenizer.eos_token_id in generated_ids
+            or self.stop_sequences.ends_with_stop(generated_ids)
+            or (max_new_tokens is not None and len(generated_ids) >= max_new_tokens)
+        )
+
+    def decode_answers(self, generated_ids: list[list[int]], generation_kwargs: dict) -> list[str]:
+        """Decodes only the generated ids of each row, cut before the template's stop sequences."""
+        answers = tokenizer_decode_batch(self.tokenizer, generated_ids)
+        if not self.stop_sequences:
+            return answers
+
+        max_new_tokens = {**generation_config, **generation_kwargs}.get("max_new_tokens")
+        for row in generated_ids:
+            # Rows of a batch that stopped early are padded after the stop sequence
+            length = len(row)
+            while length and row[length - 1] == self.tokenizer.pad_token_id:
+                length -= 1
+            if self.stop_sequences.find_ids(row[:length], length - 1) >= 0:
+                self.stop_sequences.record(length, max_new_tokens)
+        return [self.stop_sequences.trim(answer) for answer in answers]
+
+    def filter_stop_sequences(self, texts: Iterator[str]) -> Iterator[str]:
+        """Streamed texts without the stop sequence and what follows it."""
+        if not self.stop_sequences:
+            yield from texts
+            return
+        stop_filter = StopTextFilter(self.stop_sequences)
+        for text in texts:
+            text = stop_filter.put(text)
+            if text:
+                yield text
+        text = stop_filter.flush()
+        if text:
+            yield text
+
+    def get_adapter(self, data: PromptData) -> str | None:
+        if self.adapters is None:
+            return None
+        return self.adapters.resolve(data.get_character_id(), data.adapterName)
+
+    def active_adapter(self) -> str | None:
+        return self.adapters.active if self.adapters is not None else None
+
+    def preload_adapter(self, adapter_name: str):
+        if self.adapters is not None:
+            self.adapters.preload(adapter_name)
+
+    def discard_adapter(self, adapter_name: str):
+        if self.adapters is not None:
+            self.adapters.discard(adapter_name)
+
+    def use_adapter(self, adapter_name: str):
+        if self.adapters is None:
+            return nullcontext()
+        return self.adapters.use(adapter_name)
+
+    def get_segments(self, data: PromptData) -> list[Segment]:
+        if self.retriever is not None:
+            # Prompters read the retrieved passages through get_reference_list
+            data = self.retriever.apply(data)
+        if self.context_window is None:
+            return self.prompter.get_segments(data)
+        return self.context_window.fit(data).segments
+
+    def encode_segments(self, segments: list[Segment]):
+        if self.segment_encoder is None:
+            return tokenizer_encode(self.tokenizer, join_segments(segments))
+        return to_input_ids(self.segment_encoder.encode(segments))
+
+
+class SpeculativeLLM(HuggingfaceLLM):
+    """Decodes with speculative_decode: a draft model, or n-gram lookup in the prompt without
+    one, proposes speculative_tokens tokens that the target model verifies in one forward pass.
+
+    Rows of a batch are decoded one after another, since accepted lengths differ per row. The
+    KV and prefix caches of HuggingfaceLLM are not used.
+    """
+
+    def __init__(self, **kwargs) -> None:
+        super().__init__(**kwargs)
+        self.speculative_tokens = kwargs.get("speculative_tokens", 8)
+        self.prompt_lookup_max_ngram = kwargs.get("prompt_lookup_max_ngram", 3)
+        self.draft_model = None
+        if kwargs.get("draft_model_name_or_path"):
+            self.draft_model = load_draft_model(
+                kwargs.get("draft_model_name_or_path"), kwargs.get("device", 0)
             )
+            if self.draft_model.config.vocab_size != self.model.config.vocab_size:
+                logger.warning(
+                    "Draft model vocabulary has %d tokens, target model %d",
+                    self.draft_model.config.vocab_size,
+                    self.model.config.vocab_size,
+                )
+        if self.kv_cache is not None or self.prefix_cache is not None:
+            logger.warning("KV and prefix caches are not used with speculative decoding")
+        self.sampling_settings = model_sampling_settings(self.model.generation_config)
+        self.stats = SpeculationStats()
+        self._stats_lock = threading.Lock()
+
+    def new_drafter(self):
+        if self.draft_model is not None:
+            return ModelDrafter(self.draft_model)
+        return PromptLookupDrafter(self.prompt_lookup_max_ngram)
+
+    def decode_tokens(self, token_ids: list[int], generation_kwargs: dict, adapter: str, cancel):
+        """Yields the tokens of each speculative step, see speculative_decode."""
+        stats = SpeculationStats()
+        timer = GenerationTimer()
+        generated = []
+        try:
+            with self.use_adapter(adapter):
+                for tokens in speculative_decode(
+                    self.model,
+                    self.new_drafter(),
+                    token_ids,
+                    {**self.sampling_settings, **generation_config, **generation_kwargs},
+                    self.speculative_tokens,
+                    self.tokenizer.eos_token_id,
+                    cancel,
+                    stats,
+                ):
+                    timer.step()
+                    start = len(generated)
+                    generated.extend(tokens)
+                    # A step accepts several tokens, the stop sequence may end in any of them
+                    end = self.stop_sequences.find_ids(generated, start)
+                    if end >= 0:
+                        yield tokens[: end - start]
+                        return
+                    yield tokens
+        finally:
+            timer.observe()
+            TOKENS_OUT.inc(stats.generated)
+            with self._stats_lock:
+                self.stats.add(stats)
+                report = self.stats.report()
+            logger.info("Speculative decoding: %s, total: %s", stats.report(), report)
+
+    def generate(self, data: PromptData, **generation_kwargs):
+        start_time = time.time()
+        with PROMPT_BUILD_SECONDS.time():
+            segments = self.get_segments(data)
+        token_ids = self.encode_segments(segments)[0].tolist()
+        TOKENS_IN.inc(len(token_ids))
+
+        adapter = self.get_adapter(data)
+        cache_key = self.response_cache_key(token_ids, generation_kwargs, adapter)
+        if cache_key is not None:
+            cached = self.response_cache.get(cache_key)
+            if cached is not None:
+                return cached
+
+        cancel = generation_kwargs.pop("cancel", None)
+        generated = []
+        try:
+            for tokens in self.decode_tokens(
+                token_ids, generation_kwargs, adapter, cancel[0] if cancel else None
+            ):
+                generated.extend(tokens)
         except Exception as e:
+            GENERATE_ERRORS.inc()
             logger.error("Error occured while generating answer.\n%s", e)
             return ""
 
-        decoded_output = tokenizer_decode(self.tokenizer, output)
-        inference_result = self.extract_answer(decoded_output, prompt)
+        inference_result = self.decode_answers([generated], generation_kwargs)[0]
         inference_time = time.time() - start_time
+        cancelled = cancel is not None and cancel[0].is_set()
+        if (
+            cache_key is not None
+            and not cancelled
+            and self.is_finished(generated, generation_kwargs)
+        ):
+            self.response_cache.put(cache_key, inference_result, inference_time)
         logger.info(
-            f"Inference finished. result:{inference_result}, tps: {(len(output[0]) - token_length)/inference_time} tokens/s"
+            f"Inference finished. result:{inference_result}, tps: {len(generated)/inference_time} tokens/s"
         )
-
         return inference_result
 
-    def extract_answer(self, decoded_output: str, prompt: str):
-        return decoded_output[
-            len(prompt) : -len(self.tokenizer.eos_token)
-            if decoded_output.endswith(self.tokenizer.eos_token)
-            else len(decoded_output)
+    def generate_batch(self, data_list: list[PromptData], **generation_kwargs) -> list[str]:
+        cancel = generation_kwargs.pop("cancel", None) or [None] * len(data_list)
+        return [
+            self.generate(data, **generation_kwargs, cancel=[event] if event else None)
+            for data, event in zip(data_list, cancel, strict=True)
         ]
 
-    def set_adapter(self, adapter_name: str):
-        from peft.peft_model import PeftModel
+    def generate_stream(self, data: PromptData, **generation_kwargs) -> Iterator[str]:
+        with PROMPT_BUILD_SECONDS.time():
+            segments = self.get_segments(data)
+        token_ids = self.encode_segments(segments)[0].tolist()
+        TOKENS_IN.inc(len(token_ids))
 
-        if not isinstance(self.model, PeftModel):
-            logger.error("model is not a peft model")
-            return
+        cancel = generation_kwargs.pop("cancel", None)
+        decoder = IncrementalDecoder(self.tokenizer)
 
-        if self.model.active_adapter == adapter_name:
-            return
+        def texts():
+            try:
+                for tokens in self.decode_tokens(
+                    token_ids,
+                    generation_kwargs,
+                    self.get_adapter(data),
+                    cancel[0] if cancel else None,
+                ):
+                    text = decoder.put(tokens)
+                    if text:
+                        yield text
+            except Exception as e:
+                GENERATE_ERRORS.inc()
+                logger.error("Error occured while streaming answer.\n%s", e)
+            text = decoder.flush()
+            if text:
+                yield text
 
-        if adapter_name not in self.model.peft_config:
-            adapter_path = Path(llm_config.get_adapter_path(adapter_name))
-            if adapter_path.is_dir():
-                try:
-                    self.model.load_adapter(adapter_path, adapter_name=adapter_name)
-                    self.model.set_adapter(adapter_name)
-                except Exception as e:
-                    logger.error("Can not load adpater name %s\n%s", adapter_name, e)
-                    return
+        yield from self.filter_stop_sequences(texts())
+        if self.stop_sequences.ends_with_stop(decoder.token_ids):
+            self.stop_sequences.record(
+                len(decoder.token_ids),
+                {**generation_config, **generation_kwargs}.get("max_new_tokens"),
+            )
@@ -1,11 +1,30 @@
 from abc import ABCMeta, abstractmethod
-from app.message_queue.data import PromptData
+from typing import Hashable
+from app.message_queue.data import PromptData, Message
 import logging
 
 logger = logging.getLogger(__name__)
 
+# (key, text) pieces of a prompt, cached by key (or by text when key is None) once tokenized
+Segment = tuple[Hashable, str]
+
+
+def join_segments(segments: list[Segment]) -> str:
+    return "".join(text for _, text in segments)
+
+
+def message_key(message: Message) -> Hashable:
+    return ("message", message.messageId)
+
+
+def reference_key(reference: str) -> Hashable:
+    return ("reference", reference)
+
 
 class Prompter(metaclass=ABCMeta):
+    # Texts that start the next turn of the template, the answer ends before them
+    stop_sequences: tuple[str, ...] = ()
+
     def __init__(self, **kwargs) -> None:
         logger.info("Selected Prompter: %s", self.__class__.__name__)
 
@@ -13,6 +32,14 @@ class Prompter(metaclass=ABCMeta):
     def get_prompt(self, messages: PromptData) -> str:
         pass
 
+    def get_segments(self, messages: PromptData) -> list[Segment]:
+        """get_prompt split where tokenization does not cross the boundaries."""
+        return [(None, self.get_prompt(messages))]
+
+    def get_system_prompt(self, persona: str, references: list[str] = None) -> str | None:
+        """Leading part of get_prompt shared by every request with the same persona (and reference)."""
+        return None
+
 
 class MockPrompter(Prompter):
     def get_prompt(self, messages: PromptData):
@@ -20,60 +47,119 @@ class MockPrompter(Prompter):
 
 
 class ToonchatV21Prompter(Prompter):
+    stop_sequences = ("\nUser:", "### ")
+
     def get_prompt(self, messages: PromptData):
+        return join_segments(self.get_segments(messages))
+
+    def get_segments(self, messages: PromptData) -> list[Segment]:
         tmp = []
         tmp.append(
-            """아래는 사용자와의 이전 대화 내용들과 캐릭터에 대한 정보 또는 대화에 필요한 추가 컨텍스트를 제공하는 입력이 짝을 이루는 예제입니다. 요청을 적절히 완료하는 응답을 작성하세요.
+            (
+                None,
+                """아래는 사용자와의 이전 대화 내용들과 캐릭터에 대한 정보 또는 대화에 필요한 추가 컨텍스트를 제공하는 입력이 짝을 이루는 예제입니다. 요청을 적절히 완료하는 응답을 작성하세요.
 
-### 명령어:"""
+### 명령어:""",
+            )
         )
 
         for message in messages.get_chat_history_list()[:-1]:
-            tmp.append(f"{'User' if message.fromUser else 'Assistant'}: {message.content}")
+            tmp.append(
+                (
+                    message_key(message),
+                    f"\n{'User' if message.fromUser else 'Assistant'}: {message.content}",
+                )
+            )
 
-        tmp.append("\n### 입력:")
-        tmp.append(f"System: {messages.get_persona()}")
-        tmp.append(f"User: {messages.get_chat_history_list()[-1].content}")
-        tmp.append("\n### 응답:\n")
-        return "\n".join(tmp)
+        last_message = messages.get_chat_history_list()[-1]
+        tmp.append((None, "\n\n### 입력:"))
+        tmp.append((None, f"\nSystem: {messages.get_persona()}"))
+        tmp.append((message_key(last_message), f"\nUser: {last_message.content}"))
+        tmp.append((None, "\n\n### 응답:\n"))
+        return tmp
 
 
 class ToonchatV23Prompter(Prompter):
+    stop_sequences = ("### Human:", "### Assistant:")
+
     def get_prompt(self, messages: PromptData):
-        tmp = []
-        tmp.append(f"### Persona: {messages.get_persona()}")
-        tmp.append(f"### Reference: {messages.get_reference()}")
+        return join_segments(self.get_segments(messages))
+
+    def get_segments(self, messages: PromptData) -> list[Segment]:
+        tmp = self.get_system_segments(messages.get_persona(), messages.get_reference_list())
         for message in messages.get_chat_history_list():
             tmp.append(
-                f"### {'Human' if message.fromUser else 'Assistant'}: {message.content}{'' if message.fromUser else '</s>'}"
+                (
+                    message_key(message),
+                    f" ### {'Human' if message.fromUser else 'Assistant'}: {message.content}{'' if message.fromUser else '</s>'}",
+                )
             )
-        tmp.append("### Assistant: ")
-        return " ".join(tmp)
+        tmp.append((None, " ### Assistant: "))
+        return tmp
+
+    def get_system_prompt(self, persona: str, references: list[str] = None) -> str | None:
+        return join_segments(self.get_system_segments(persona, references))
+
+    def get_system_segments(self, persona: str, references: list[str] = None) -> list[Segment]:
+        tmp = []
+        tmp.append((None, f"### Persona: {persona}"))
+        if references is not None:
+            tmp.append((None, " ### Reference:"))
+            for reference in references or [""]:
+                tmp.append((reference_key(reference), f" {reference}"))
+        return tmp
 
 
 class ChatMlPrompter(Prompter):
+    stop_sequences = ("<|im_end|>", "<|im_start|>")
+
     def get_prompt(self, messages: PromptData) -> str:
+        return join_segments(self.get_segments(messages))
+
+    def get_segments(self, messages: PromptData) -> list[Segment]:
+        tmp = self.get_system_segments(messages.get_persona(), messages.get_reference_list())
+        for i, message in enumerate(messages.get_chat_history_list()):
+            if i == 0 and not message.fromUser:
+                continue
+            # assert i == 0 or (i != 0 and message.fromUser != messages.get_chat_history_list()[i-1].fromUser)
+            tmp.append(
+                (
+                    message_key(message),
+                    f"\n<|im_start|>{'user' if message.fromUser else 'assistant'}\n{message.content}<|im_end|>",
+                )
+            )
+        tmp.append((None, "\n<|im_start|>assistant\n"))
+        return tmp
+
+    def get_system_prompt(self, persona: str, references: list[str] = None) -> str | None:
+        return join_segments(self.get_system_segments(persona, references))
+
+    def get_system_segments(self, persona: str, references: list[str] = None) -> list[Segment]:
         tmp = []
         tmp.append(
-            "<|im_start|>system\n당신은 주어진 캐릭터의 말투, 성격을 모방하여 대답하는 챗봇입니다. 유저의 질문에 대하여 캐릭터의 특징을 최대한 살려 대답하세요.<|im_end|>"
-        )
-        if len(messages.get_persona()) > 1:
-            tmp.append(
-                f"<|im_start|>system\n아래는 당신의 페르소나입니다. 유저의 질문에 대하여 다음의 페르소나를 고려하여 적절한 대답을 완성하세요. {messages.get_persona()}<|im_end|>"
+            (
+                None,
+                "<|im_start|>system\n당신은 주어진 캐릭터의 말투, 성격을 모방하여 대답하는 챗봇입니다. 유저의 질문에 대하여 캐릭터의 특징을 최대한 살려 대답하세요.<|im_end|>",
             )
-        if messages.get_reference():
+        )
+        if len(persona) > 1:
             tmp.append(
-                f"<|im_start|>system\n다음은 유저의 질문과 관련된 소설의 내용입니다. 유저의 질문에 대해 다음의 내용을 바탕으로 적절한 대답을 완성하세요. {messages.get_reference()}<|im_end|>"
+                (
+                    None,
+                    f"\n<|im_start|>system\n아래는 당신의 페르소나입니다. 유저의 질문에 대하여 다음의 페르소나를 고려하여 적절한 대답을 완성하세요. {persona}<|im_end|>",
+                )
             )
-        for i, message in enumerate(messages.get_chat_history_list()):
-            if i == 0 and not message.fromUser:
-                continue
-            # assert i == 0 or (i != 0 and message.fromUser != messages.get_chat_history_list()[i-1].fromUser)
+        if references is not None and " ".join(references):
             tmp.append(
-                f"<|im_start|>{'user' if message.fromUser else 'assistant'}\n{message.content}<|im_end|>"
+                (
+                    None,
+                    "\n<|im_start|>system\n다음은 유저의 질문과 관련된 소설의 내용입니다. 유저의 질문에 대해 다음의 내용을 바탕으로 적절한 대답을 완성하세요.",
+                )
             )
-        tmp.append("<|im_start|>assistant\n")
-        return "\n".join(tmp)
+            for reference in references:
+                tmp.append((reference_key(reference), f" {reference}"))
+            tmp.append((None, "<|im_end|>"))
+        return tmp
 
 
 class HuggingfaceTokenizerPrompter(Prompter):
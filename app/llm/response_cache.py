@@ -0,0 +1,171 @@
+import json
+import time
+import hashlib
+import logging
+import sqlite3
+import threading
+from array import array
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Callable, Sequence
+
+from app.metrics.registry import REGISTRY, Counter
+
+logger = logging.getLogger(__name__)
+
+RESPONSE_CACHE_LOOKUPS = REGISTRY.register(
+    Counter("toonchat_response_cache_lookups_total", "Response cache lookups", ("result",))
+)
+RESPONSE_CACHE_SAVED_SECONDS = REGISTRY.register(
+    Counter("toonchat_response_cache_saved_seconds_total", "Generate time answered from the cache")
+)
+
+# Kwargs that bound how long a generate may take rather than what it generates
+UNKEYED_KWARGS = ("cancel", "max_time", "stopping_criteria", "streamer")
+
+
+def response_key(token_ids: Sequence[int], generation_kwargs: dict, adapter: str = None) -> str:
+    """Stable hash of the prompt token ids, the generation settings and the adapter."""
+    settings = {key: value for key, value in generation_kwargs.items() if key not in UNKEYED_KWARGS}
+    digest = hashlib.blake2b(array("q", token_ids).tobytes(), digest_size=16)
+    digest.update(json.dumps([settings, adapter], sort_keys=True, default=str).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def is_deterministic(generation_kwargs: dict) -> bool:
+    return not generation_kwargs.get("do_sample", False)
+
+
+@dataclass
+class CachedResponse:
+    answer: str
+    created_at: float
+    generate_seconds: float
+
+
+class ResponseCache:
+    """Answers of earlier generates by response_key, in an LRU of max_entries and optionally
+    behind it an sqlite file of up to disk_max_entries.
+
+    Entries expire ttl seconds after they were generated. Sampled answers are only cached with
+    reuse_sampled, otherwise every user would get the same sample.
+    """
+
+    def __init__(
+        self,
+        max_entries: int,
+        ttl: float = 3600.0,
+        disk_path: str = None,
+        disk_max_entries: int = 100000,
+        reuse_sampled: bool = False,
+        clock: Callable[[], float] = time.time,
+    ) -> None:
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.disk_max_entries = disk_max_entries
+        self.reuse_sampled = reuse_sampled
+        self._clock = clock
+        self._entries: OrderedDict[str, CachedResponse] = OrderedDict()
+        self._lock = threading.Lock()
+        self._disk: sqlite3.Connection = None
+        self._disk_puts = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.saved_seconds = 0.0
+        if disk_path:
+            self._disk = sqlite3.connect(disk_path, check_same_thread=False)
+            self._disk.execute(
+                "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, answer TEXT, "
+                "created_at REAL, generate_seconds REAL, used_at REAL)"
+            )
+            self._disk.execute("CREATE INDEX IF NOT EXISTS responses_used ON responses (used_at)")
+            self._disk.commit()
+
+    def cacheable(self, generation_kwargs: dict) -> bool:
+        return self.reuse_sampled or is_deterministic(generation_kwargs)
+
+    def get(self, key: str) -> str | None:
+        now = self._clock()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self._expired(entry, now):
+                del self._entries[key]
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+            elif self._disk is not None:
+                entry = self._get_from_disk(key, now)
+
+            if entry is None:
+                self.misses += 1
+                RESPONSE_CACHE_LOOKUPS.labels("miss").inc()
+                return None
+            self.saved_seconds += entry.generate_seconds
+        RESPONSE_CACHE_LOOKUPS.labels("hit").inc()
+        RESPONSE_CACHE_SAVED_SECONDS.inc(entry.generate_seconds)
+        return entry.answer
+
+    def put(self, key: str, answer: str, generate_seconds: float):
+        entry = CachedResponse(answer, self._clock(), generate_seconds)
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            if self._disk is not None:
+                self._put_to_disk(key, entry)
+
+    def _expired(self, entry: CachedResponse, now: float) -> bool:
+        return self.ttl > 0 and now - entry.created_at >= self.ttl
+
+    def _get_from_disk(self, key: str, now: float) -> CachedResponse | None:
+        row = self._disk.execute(
+            "SELECT answer, created_at, generate_seconds FROM responses WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        entry = CachedResponse(*row)
+        if self._expired(entry, now):
+            self._disk.execute("DELETE FROM responses WHERE key = ?", (key,))
+            self._disk.commit()
+            return None
+        self._disk.execute("UPDATE responses SET used_at = ? WHERE key = ?", (now, key))
+        self._disk.commit()
+        self.disk_hits += 1
+        # Promoted, so the next lookup does not touch the file
+        self._entries[key] = entry
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        return entry
+
+    def _put_to_disk(self, key: str, entry: CachedResponse):
+        self._disk.execute(
+            "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)",
+            (key, entry.answer, entry.created_at, entry.generate_seconds, entry.created_at),
+        )
+        self._disk_puts += 1
+        # Trimming scans the index, so it runs every few hundred inserts rather than on each
+        if self._disk_puts % 256 == 0:
+            if self.ttl > 0:
+                self._disk.execute(
+                    "DELETE FROM responses WHERE created_at <= ?", (self._clock() - self.ttl,)
+                )
+            self._disk.execute(
+                "DELETE FROM responses WHERE key IN (SELECT key FROM responses "
+                "ORDER BY used_at DESC LIMIT -1 OFFSET ?)",
+                (self.disk_max_entries,),
+            )
+        self._disk.commit()
+
+    def report(self) -> dict:
+        lookups = self.hits + self.disk_hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+            "saved_seconds": self.saved_seconds,
+        }
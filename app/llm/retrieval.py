@@ -0,0 +1,357 @@
+"""Reference passages retrieved from a per-character index instead of shipped with each request.
+
+Each character's source text is split offline into overlapping passages and indexed with
+BM25 over character bigrams, the same terms reference_relevance uses for Korean text without
+a morphological analyzer. Optionally the passages are also embedded into a dense matrix:
+
+    python -m app.llm.retrieval --source /ai/novels --output /ai/retrieval
+
+reads <characterId>.txt files from --source and writes one directory per characterId. The
+postings and vectors are .npy files that are memory-mapped when a character is first asked
+about, so only the passages that score are ever read from disk.
+"""
+import os
+import re
+import json
+import logging
+import argparse
+import threading
+from collections import Counter as TermCounter, OrderedDict
+from dataclasses import replace
+from math import log
+from typing import Callable
+
+from app.utils import log_execution_time
+from app.message_queue.data import PromptData
+from app.metrics.registry import REGISTRY, STAGE_SECONDS, Counter
+
+logger = logging.getLogger(__name__)
+
+RETRIEVAL_SECONDS = STAGE_SECONDS.labels("retrieval")
+INDEX_LOADS = REGISTRY.register(
+    Counter("toonchat_retrieval_index_loads_total", "Passage indexes loaded", ("result",))
+)
+
+INDEX_FORMAT = 1
+INDEX_FILE = "index.json"
+OFFSETS_FILE = "offsets.npy"
+DOCS_FILE = "docs.npy"
+WEIGHTS_FILE = "weights.npy"
+VECTORS_FILE = "vectors.npy"
+
+_SENTENCE_END = re.compile(r"(?<=[.!?。…”\"])\s+|\n+")
+
+
+def terms(text: str) -> list[str]:
+    """Character bigrams of each word, single character words as they are."""
+    result = []
+    for word in text.lower().split():
+        if len(word) == 1:
+            result.append(word)
+        result.extend(word[i : i + 2] for i in range(len(word) - 1))
+    return result
+
+
+def chunk_text(text: str, chunk_chars: int = 400, overlap_chars: int = 80) -> list[str]:
+    """Passages of about chunk_chars made of whole sentences, the last sentences of a passage
+    up to overlap_chars are repeated at the start of the next one."""
+    sentences = [sentence.strip() for sentence in _SENTENCE_END.split(text) if sentence.strip()]
+    passages, current = [], []
+    for sentence in sentences:
+        if current and sum(map(len, current)) + len(sentence) > chunk_chars:
+            passages.append(" ".join(current))
+            overlap = []
+            for previous in reversed(current):
+                if sum(map(len, overlap)) + len(previous) > overlap_chars:
+                    break
+                overlap.insert(0, previous)
+            current = overlap
+        current.append(sentence)
+    if current:
+        passages.append(" ".join(current))
+    return passages
+
+
+class TextEmbedder:
+    """Mean pooled, normalized embeddings of a transformers encoder, loaded on first use."""
+
+    def __init__(self, model_name_or_path: str, device="cpu", batch_size: int = 32) -> None:
+        self.model_name_or_path = model_name_or_path
+        self.device = device
+        self.batch_size = batch_size
+        self._tokenizer = None
+        self._model = None
+        self._lock = threading.Lock()
+
+    def embed(self, texts: list[str]):
+        import numpy as np
+        import torch
+
+        with self._lock:
+            if self._model is None:
+                from transformers import AutoModel, AutoTokenizer
+
+                self._tokenizer = AutoTokenizer.from_pretrained(self.model_name_or_path)
+                self._model = AutoModel.from_pretrained(self.model_name_or_path).to(self.device)
+                self._model.eval()
+
+        vectors = []
+        for start in range(0, len(texts), self.batch_size):
+            # The first call sets padding and truncation on the tokenizer, which fails when
+            # another thread tokenizes at the same time
+            with self._lock:
+                encoded = self._tokenizer(
+                    texts[start : start + self.batch_size],
+                    padding=True,
+                    truncation=True,
+                    return_tensors="pt",
+                )
+            encoded = encoded.to(self.device)
+            with torch.no_grad():
+                hidden = self._model(**encoded).last_hidden_state
+            mask = encoded["attention_mask"].unsqueeze(-1).to(hidden.dtype)
+            pooled = (hidden * mask).sum(1) / mask.sum(1).clamp(min=1)
+            vectors.append(torch.nn.functional.normalize(pooled, dim=-1).float().cpu().numpy())
+        return np.concatenate(vectors).astype(np.float32)
+
+
+def build_index(
+    output_dir: str,
+    passages: list[str],
+    embedder: TextEmbedder = None,
+    k1: float = 1.2,
+    b: float = 0.75,
+):
+    """Writes the passages with BM25 weights precomputed per (term, passage)."""
+    import numpy as np
+
+    term_counts = [TermCounter(terms(passage)) for passage in passages]
+    lengths = [sum(counts.values()) for counts in term_counts]
+    average_length = sum(lengths) / len(lengths) if lengths else 0.0
+
+    postings: dict[str, list[tuple[int, float]]] = {}
+    for doc, counts in enumerate(term_counts):
+        norm = k1 * (1 - b + b * lengths[doc] / average_length) if average_length else k1
+        for term, tf in counts.items():
+            postings.setdefault(term, []).append((doc, tf * (k1 + 1) / (tf + norm)))
+
+    vocabulary = sorted(postings)
+    offsets, docs, weights = [0], [], []
+    for term in vocabulary:
+        entries = postings[term]
+        idf = log(1 + (len(passages) - len(entries) + 0.5) / (len(entries) + 0.5))
+        docs.extend(doc for doc, _ in entries)
+        weights.extend(idf * weight for _, weight in entries)
+        offsets.append(len(docs))
+
+    os.makedirs(output_dir, exist_ok=True)
+    np.save(os.path.join(output_dir, OFFSETS_FILE), np.asarray(offsets, dtype=np.int64))
+    np.save(os.path.join(output_dir, DOCS_FILE), np.asarray(docs, dtype=np.int32))
+    np.save(os.path.join(output_dir, WEIGHTS_FILE), np.asarray(weights, dtype=np.float32))
+    if embedder is not None:
+        np.save(os.path.join(output_dir, VECTORS_FILE), embedder.embed(passages))
+    # The index file goes last, a directory without it is not loaded
+    with open(os.path.join(output_dir, INDEX_FILE), "w", encoding="utf-8") as f:
+        json.dump(
+            {
+                "format": INDEX_FORMAT,
+                "embedding_model": embedder.model_name_or_path if embedder else None,
+                "terms": vocabulary,
+                "passages": passages,
+            },
+            f,
+            ensure_ascii=False,
+        )
+
+
+class PassageIndex:
+    def __init__(self, passages: list[str], vocabulary: list[str], offsets, docs, weights, vectors):
+        self.passages = passages
+        self.term_ids = {term: i for i, term in enumerate(vocabulary)}
+        self.offsets = offsets
+        self.docs = docs
+        self.weights = weights
+        self.vectors = vectors
+
+    @classmethod
+    def load(cls, path: str) -> "PassageIndex":
+        import numpy as np
+
+        with open(os.path.join(path, INDEX_FILE), encoding="utf-8") as f:
+            index = json.load(f)
+        if index.get("format") != INDEX_FORMAT:
+            raise ValueError(f"Unsupported index format {index.get('format')} in {path}")
+
+        def load_array(name: str):
+            return np.load(os.path.join(path, name), mmap_mode="r")
+
+        vectors = None
+        if os.path.exists(os.path.join(path, VECTORS_FILE)):
+            vectors = load_array(VECTORS_FILE)
+        return cls(
+            index["passages"],
+            index["terms"],
+            load_array(OFFSETS_FILE),
+            load_array(DOCS_FILE),
+            load_array(WEIGHTS_FILE),
+            vectors,
+        )
+
+    def search(
+        self, query: str, k: int, query_vector=None, dense_weight: float = 0.5
+    ) -> list[tuple[int, float]]:
+        """(passage index, score) of the k best passages, best first. Without a query vector
+        or passage vectors the score is BM25, otherwise BM25 scaled to [0, 1] mixed with the
+        cosine similarity."""
+        import numpy as np
+
+        scores = np.zeros(len(self.passages), dtype=np.float32)
+        for term in set(terms(query)):
+            term_id = self.term_ids.get(term)
+            if term_id is None:
+                continue
+            start, end = self.offsets[term_id], self.offsets[term_id + 1]
+            # A passage appears once per term, so fancy indexed += does not drop repeats
+            scores[self.docs[start:end]] += self.weights[start:end]
+
+        if query_vector is not None and self.vectors is not None:
+            top = scores.max()
+            if top > 0:
+                scores /= top
+            scores = (1 - dense_weight) * scores + dense_weight * (self.vectors @ query_vector)
+
+        k = min(k, len(scores))
+        if k == 0:
+            return []
+        best = np.argpartition(-scores, k - 1)[:k]
+        best = best[np.argsort(-scores[best])]
+        return [(int(i), float(scores[i])) for i in best if scores[i] > 0]
+
+
+class ReferenceRetriever:
+    """Replaces PromptData.reference with the top_k passages of the character's index that
+    best match the latest user message, as many as fit in token_budget.
+
+    Indexes are loaded on the first request for a character and up to max_indexes are kept.
+    Characters without an index keep the reference sent with the request.
+    """
+
+    def __init__(
+        self,
+        index_dir: str,
+        top_k: int = 4,
+        token_budget: int = 512,
+        max_indexes: int = 32,
+        count_tokens: Callable[[str], int] = len,
+        embedder: TextEmbedder = None,
+    ) -> None:
+        self.index_dir = index_dir
+        self.top_k = top_k
+        self.token_budget = token_budget
+        self.max_indexes = max_indexes
+        self.count_tokens = count_tokens
+        self.embedder = embedder
+        self._indexes: OrderedDict[int, PassageIndex | None] = OrderedDict()
+        self._token_counts: dict[tuple[int, int], int] = {}
+        self._lock = threading.Lock()
+
+    def index(self, character_id: int) -> PassageIndex | None:
+        with self._lock:
+            if character_id in self._indexes:
+                self._indexes.move_to_end(character_id)
+                return self._indexes[character_id]
+
+            path = os.path.join(self.index_dir, str(character_id))
+            index = None
+            if os.path.exists(os.path.join(path, INDEX_FILE)):
+                try:
+                    index = PassageIndex.load(path)
+                    INDEX_LOADS.labels("loaded").inc()
+                    logger.info(
+                        "Loaded %d passages of character %s", len(index.passages), character_id
+                    )
+                except Exception as e:
+                    INDEX_LOADS.labels("failed").inc()
+                    logger.error("Failed to load passage index from %s: %s", path, e)
+            else:
+                INDEX_LOADS.labels("missing").inc()
+            # Missing indexes are remembered too, so the directory is not checked every time
+            self._indexes[character_id] = index
+            while len(self._indexes) > self.max_indexes:
+                evicted, _ = self._indexes.popitem(last=False)
+                self._token_counts = {
+                    key: count for key, count in self._token_counts.items() if key[0] != evicted
+                }
+            return index
+
+    def retrieve(self, character_id: int, query: str) -> list[str] | None:
+        index = self.index(character_id)
+        if index is None:
+            return None
+
+        with RETRIEVAL_SECONDS.time():
+            query_vector = None
+            if self.embedder is not None and index.vectors is not None:
+                query_vector = self.embedder.embed([query])[0]
+            selected, budget = [], self.token_budget
+            for i, _ in index.search(query, self.top_k, query_vector):
+                tokens = self._passage_tokens(character_id, index, i)
+                if tokens <= budget:
+                    selected.append(i)
+                    budget -= tokens
+            # In the order of the source text, which reads better than the order of the scores
+            return [index.passages[i] for i in sorted(selected)]
+
+    def apply(self, data: PromptData) -> PromptData:
+        messages = data.get_chat_history_list()
+        query = next(
+            (message.content for message in reversed(messages) if message.is_user()),
+            messages[-1].content if messages else "",
+        )
+        passages = self.retrieve(data.get_character_id(), query)
+        return data if passages is None else replace(data, reference=passages)
+
+    def _passage_tokens(self, character_id: int, index: PassageIndex, i: int) -> int:
+        key = (character_id, i)
+        count = self._token_counts.get(key)
+        if count is None:
+            count = self._token_counts[key] = self.count_tokens(index.passages[i])
+        return count
+
+
+@log_execution_time
+def build_indexes(
+    source: str,
+    output_dir: str,
+    chunk_chars: int,
+    overlap_chars: int,
+    embedder: TextEmbedder = None,
+):
+    """Indexes every <characterId>.txt in source into output_dir/<characterId>."""
+    for name in sorted(os.listdir(source)):
+        character_id, extension = os.path.splitext(name)
+        if extension != ".txt" or not character_id.isdigit():
+            continue
+        with open(os.path.join(source, name), encoding="utf-8") as f:
+            passages = chunk_text(f.read(), chunk_chars, overlap_chars)
+        build_index(os.path.join(output_dir, character_id), passages, embedder)
+        logger.info("Indexed %d passages of character %s", len(passages), character_id)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build per-character reference passage indexes")
+    parser.add_argument("--source", required=True, help="directory of <characterId>.txt files")
+    parser.add_argument("--output", required=True)
+    parser.add_argument("--chunk-chars", type=int, default=400)
+    parser.add_argument("--overlap-chars", type=int, default=80)
+    parser.add_argument("--embedding-model", help="also store dense vectors of this encoder")
+    parser.add_argument("--device", default="cpu")
+    args = parser.parse_args()
+
+    embedder = TextEmbedder(args.embedding_model, args.device) if args.embedding_model else None
+    build_indexes(args.source, args.output, args.chunk_chars, args.overlap_chars, embedder)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main()
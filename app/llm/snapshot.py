@@ -0,0 +1,176 @@
+"""Pre-serialized model snapshots.
+
+Compiling a snapshot loads the model once the way the server does (quantized and optionally
+with the LoRA adapter merged) and saves it with the tokenizer as safetensors, so later starts
+memory-map the weights instead of quantizing and merging them again:
+
+    PROFILE=production python -m app.llm.snapshot --output /ai/snapshots/toonchat
+
+The manifest stores a hash of everything the snapshot was built from. A snapshot whose hash
+does not match the current config and source files is stale and is ignored.
+"""
+import os
+import json
+import time
+import hashlib
+import logging
+import argparse
+from importlib import metadata
+from pathlib import Path
+
+from app.utils import log_execution_time, path_concat
+from app.llm.constants import ModelType
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_FILE = "snapshot.json"
+SNAPSHOT_FORMAT = 1
+# Only these files change what gets loaded, logs or checkpoints next to them are ignored
+SOURCE_SUFFIXES = (".json", ".safetensors", ".bin", ".model", ".txt")
+LIBRARIES = ("torch", "transformers", "peft", "bitsandbytes")
+
+
+def _library_versions() -> dict:
+    versions = {}
+    for name in LIBRARIES:
+        try:
+            versions[name] = metadata.version(name)
+        except metadata.PackageNotFoundError:
+            versions[name] = None
+    return versions
+
+
+def _source_files(path: str) -> list:
+    if not path or not Path(path).is_dir():
+        # A hub model id, only the id itself can be compared
+        return [path]
+
+    files = []
+    for file in sorted(Path(path).rglob("*")):
+        if file.is_file() and file.suffix in SOURCE_SUFFIXES:
+            stat = file.stat()
+            files.append([str(file.relative_to(path)), stat.st_size, stat.st_mtime_ns])
+    return files
+
+
+def snapshot_source(kwargs: dict, merge_adapter: bool) -> dict:
+    """Everything the snapshot content depends on, from LLMConfig fields."""
+    merge_adapter = merge_adapter and kwargs.get("model_type") == ModelType.LoRA
+    adapter_path = None
+    if merge_adapter:
+        adapter_path = path_concat(kwargs.get("adapter_dir"), kwargs.get("adapter_name"))
+
+    return {
+        "format": SNAPSHOT_FORMAT,
+        "pretrained_model_name_or_path": kwargs.get("pretrained_model_name_or_path"),
+        "model_files": _source_files(kwargs.get("pretrained_model_name_or_path")),
+        "load_in_4bit": kwargs.get("load_in_4bit", True),
+        "merged_adapter": kwargs.get("adapter_name") if merge_adapter else None,
+        "adapter_files": _source_files(adapter_path) if merge_adapter else [],
+        "libraries": _library_versions(),
+    }
+
+
+def source_hash(source: dict) -> str:
+    return hashlib.sha256(json.dumps(source, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def read_manifest(snapshot_dir: str) -> dict | None:
+    try:
+        with open(path_concat(snapshot_dir, MANIFEST_FILE), encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def find_snapshot(kwargs: dict) -> dict | None:
+    """Manifest of the configured snapshot if it matches the current source, else None."""
+    snapshot_dir = kwargs.get("snapshot_dir")
+    if not snapshot_dir:
+        return None
+
+    manifest = read_manifest(snapshot_dir)
+    if manifest is None:
+        logger.warning("No snapshot found in %s, loading from source", snapshot_dir)
+        return None
+
+    merge_adapter = manifest.get("source", {}).get("merged_adapter") is not None
+    expected = source_hash(snapshot_source(kwargs, merge_adapter))
+    if manifest.get("hash") != expected:
+        logger.warning(
+            "Snapshot in %s is stale (hash %s, expected %s), loading from source",
+            snapshot_dir,
+            manifest.get("hash"),
+            expected,
+        )
+        return None
+
+    logger.info("Using snapshot %s built at %s", snapshot_dir, manifest.get("created_at"))
+    return manifest
+
+
+@log_execution_time
+def compile_snapshot(kwargs: dict, output_dir: str, merge_adapter: bool = True) -> dict:
+    from transformers import AutoModelForCausalLM, AutoTokenizer
+    import torch
+
+    source = snapshot_source(kwargs, merge_adapter)
+    pretrained_model_name_or_path = kwargs.get("pretrained_model_name_or_path")
+
+    logger.info("Compiling snapshot of %s into %s", pretrained_model_name_or_path, output_dir)
+    tokenizer = AutoTokenizer.from_pretrained(pretrained_model_name_or_path)
+    model = AutoModelForCausalLM.from_pretrained(
+        pretrained_model_name_or_path,
+        torch_dtype=torch.bfloat16,
+        load_in_4bit=source["load_in_4bit"],
+        device_map={"": kwargs.get("device", 0)},
+    )
+
+    if source["merged_adapter"]:
+        from peft.peft_model import PeftModel
+
+        adapter_path = path_concat(kwargs.get("adapter_dir"), kwargs.get("adapter_name"))
+        logger.info("Merging adapter from path: %s", adapter_path)
+        # Merging into 4-bit weights needs peft>=0.6.0, older versions raise here
+        model = PeftModel.from_pretrained(model, adapter_path).merge_and_unload()
+
+    os.makedirs(output_dir, exist_ok=True)
+    model.save_pretrained(output_dir, safe_serialization=True)
+    tokenizer.save_pretrained(output_dir)
+
+    # The manifest goes last, an interrupted compile leaves no valid snapshot behind
+    manifest = {
+        "hash": source_hash(source),
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "source": source,
+    }
+    with open(path_concat(output_dir, MANIFEST_FILE), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+    logger.info("Snapshot saved with hash %s", manifest["hash"])
+
+    return manifest
+
+
+def main():
+    from app.llm.config import get_llm_config
+
+    parser = argparse.ArgumentParser(description="Compile a pre-quantized model snapshot")
+    parser.add_argument("--output", default=None, help="defaults to SNAPSHOT_DIR")
+    parser.add_argument(
+        "--no-merge",
+        action="store_true",
+        help="keep the LoRA adapter separate, needed to serve several adapters",
+    )
+    args = parser.parse_args()
+
+    kwargs = get_llm_config().model_dump()
+    output_dir = args.output or kwargs.get("snapshot_dir")
+    if not output_dir:
+        parser.error("--output or SNAPSHOT_DIR is required")
+
+    compile_snapshot(kwargs, output_dir, merge_adapter=not args.no_merge)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main()
@@ -0,0 +1,305 @@
+"""Speculative decoding: a cheap drafter proposes tokens that the target model verifies at once.
+
+Each step feeds the last accepted token and the draft to the target model in one forward pass.
+Draft tokens are accepted with speculative sampling, so the answers follow the same
+distribution as sampling from the target model alone with generate, given the same
+repetition_penalty, temperature, top_k and top_p. generate takes top_k and top_p from the
+model's generation_config unless they are given (top_k is 50 by default), so they have to be
+merged into the settings, see model_sampling_settings. Its other warpers, like typical_p or
+min_p, are not applied. Without sampling, a draft token is accepted when it is the argmax.
+"""
+import time
+import logging
+import threading
+from dataclasses import dataclass
+from typing import Iterator
+
+from app.llm.kv_cache import crop_past_key_values
+from app.metrics.registry import REGISTRY, Counter
+
+logger = logging.getLogger(__name__)
+
+SPECULATIVE_TOKENS = REGISTRY.register(
+    Counter("toonchat_speculative_tokens_total", "Draft tokens proposed and accepted", ("result",))
+)
+
+
+# Warpers of generate that TokenDistribution does not apply, with their disabled value
+UNSUPPORTED_WARPERS = {"typical_p": 1.0, "epsilon_cutoff": 0.0, "eta_cutoff": 0.0, "min_p": None}
+
+
+def model_sampling_settings(model_generation_config) -> dict:
+    """top_k and top_p that generate takes from the model's generation_config unless given."""
+    unsupported = [
+        name
+        for name, disabled in UNSUPPORTED_WARPERS.items()
+        if getattr(model_generation_config, name, disabled) not in (disabled, None)
+    ]
+    if unsupported:
+        logger.warning("Speculative decoding does not apply %s of generation_config", unsupported)
+    return {"top_k": model_generation_config.top_k, "top_p": model_generation_config.top_p}
+
+
+class TokenDistribution:
+    """Next token probabilities with repetition_penalty, then the temperature, top_k and top_p
+    warpers applied like generate."""
+
+    def __init__(self, token_ids: list[int], settings: dict) -> None:
+        self.seen = set(token_ids)
+        self.penalty = settings.get("repetition_penalty") or 1.0
+        self.temperature = settings.get("temperature") or 1.0
+        self.top_k = settings.get("top_k") or 0
+        top_p = settings.get("top_p")
+        self.top_p = 1.0 if top_p is None else top_p
+        self.do_sample = settings.get("do_sample", False)
+        self._warpers = None
+
+    def add(self, token_ids: list[int]):
+        self.seen.update(token_ids)
+
+    def probs(self, logits, drafted: list[int] = ()):
+        """logits of one position, drafted the draft tokens in front of it."""
+        import torch
+
+        logits = logits.float()
+        if self.penalty != 1.0:
+            index = torch.tensor(list(self.seen.union(drafted)), device=logits.device)
+            score = logits.gather(-1, index)
+            score = torch.where(score < 0, score * self.penalty, score / self.penalty)
+            logits = logits.scatter(-1, index, score)
+        if self.do_sample:
+            scores = logits.unsqueeze(0)
+            for warper in self.get_warpers():
+                scores = warper(None, scores)
+            logits = scores[0]
+        return torch.softmax(logits, dim=-1)
+
+    def get_warpers(self) -> list:
+        """The warpers generate adds for these settings, in its order."""
+        if self._warpers is None:
+            from transformers import TemperatureLogitsWarper, TopKLogitsWarper, TopPLogitsWarper
+
+            warpers = []
+            if self.temperature != 1.0:
+                warpers.append(TemperatureLogitsWarper(self.temperature))
+            if self.top_k:
+                warpers.append(TopKLogitsWarper(self.top_k))
+            if self.top_p < 1.0:
+                warpers.append(TopPLogitsWarper(self.top_p))
+            self._warpers = warpers
+        return self._warpers
+
+    def sample(self, probs) -> int:
+        import torch
+
+        if self.do_sample:
+            return int(torch.multinomial(probs, 1))
+        return int(probs.argmax())
+
+
+def verify(
+    draft: list[int],
+    draft_probs: list | None,
+    target_logits,
+    distribution: TokenDistribution,
+) -> tuple[int, int]:
+    """Returns (number of accepted draft tokens, token that follows them).
+
+    target_logits has a row per draft position and one after the whole draft, they are only
+    turned into probabilities up to the first rejection. draft_probs is None for a
+    deterministic drafter, whose distribution is one-hot on the drafted token.
+    """
+    import torch
+
+    for j, token in enumerate(draft):
+        p = distribution.probs(target_logits[j], draft[:j])
+        if not distribution.do_sample:
+            target = int(p.argmax())
+            if target != token:
+                return j, target
+            continue
+
+        q = draft_probs[j] if draft_probs is not None else None
+        q_token = float(q[token]) if q is not None else 1.0
+        if float(torch.rand(())) * q_token < float(p[token]):
+            continue
+        # Rejected: sample from the part of p the draft did not cover
+        if q is None:
+            residual = p.clone()
+            residual[token] = 0
+        else:
+            residual = torch.clamp(p - q, min=0)
+        total = residual.sum()
+        if total <= 0:
+            return j, distribution.sample(p)
+        return j, int(torch.multinomial(residual / total, 1))
+    return len(draft), distribution.sample(distribution.probs(target_logits[len(draft)], draft))
+
+
+class PromptLookupDrafter:
+    """Drafts the tokens that followed the latest earlier occurrence of the last n-gram.
+
+    Toonchat answers quote names and phrases of the persona and reference passages, so the
+    prompt itself drafts well without a second model.
+    """
+
+    def __init__(self, max_ngram: int = 3) -> None:
+        self.max_ngram = max_ngram
+        # (n-gram) -> position right after its latest occurrence
+        self._index: dict[tuple, int] = {}
+        self._indexed = 0
+
+    def propose(
+        self, token_ids: list[int], num_tokens: int, distribution: TokenDistribution
+    ) -> tuple[list[int], None]:
+        # Only n-grams followed by a token are indexed, so the last one never matches itself
+        for end in range(max(self._indexed, 1), len(token_ids)):
+            for n in range(1, min(self.max_ngram, end) + 1):
+                self._index[tuple(token_ids[end - n : end])] = end
+        self._indexed = max(self._indexed, len(token_ids))
+
+        for n in range(min(self.max_ngram, len(token_ids)), 0, -1):
+            end = self._index.get(tuple(token_ids[-n:]))
+            if end is not None:
+                return token_ids[end : end + num_tokens], None
+        return [], None
+
+    def rollback(self, length: int):
+        pass
+
+
+class ModelDrafter:
+    """Samples the draft from a small model that shares the tokenizer of the target model."""
+
+    def __init__(self, model) -> None:
+        self.model = model
+        self.past_key_values = None
+        self.length = 0
+
+    def propose(
+        self, token_ids: list[int], num_tokens: int, distribution: TokenDistribution
+    ) -> tuple[list[int], list]:
+        import torch
+
+        draft, draft_probs = [], []
+        inputs = token_ids[self.length :]
+        for _ in range(num_tokens):
+            with torch.no_grad():
+                output = self.model(
+                    input_ids=torch.tensor([inputs], device=self.model.device),
+                    past_key_values=self.past_key_values,
+                    use_cache=True,
+                )
+            self.past_key_values = output.past_key_values
+            self.length += len(inputs)
+            q = distribution.probs(output.logits[0, -1], draft)
+            draft_probs.append(q)
+            draft.append(distribution.sample(q))
+            inputs = [draft[-1]]
+        return draft, draft_probs
+
+    def rollback(self, length: int):
+        """Forget the states of draft tokens past length, the target model rejected them."""
+        if self.length > length:
+            self.past_key_values = crop_past_key_values(self.past_key_values, length)
+            self.length = length
+
+
+@dataclass
+class SpeculationStats:
+    proposed: int = 0
+    accepted: int = 0
+    steps: int = 0
+    generated: int = 0
+
+    def add(self, other: "SpeculationStats"):
+        self.proposed += other.proposed
+        self.accepted += other.accepted
+        self.steps += other.steps
+        self.generated += other.generated
+
+    def report(self) -> dict:
+        return {
+            "proposed": self.proposed,
+            "accepted": self.accepted,
+            "acceptance_rate": self.accepted / self.proposed if self.proposed else 0.0,
+            "tokens_per_step": self.generated / self.steps if self.steps else 0.0,
+        }
+
+
+def speculative_decode(
+    model,
+    drafter,
+    token_ids: list[int],
+    settings: dict,
+    num_draft_tokens: int,
+    eos_token_id: int = None,
+    cancel: threading.Event = None,
+    stats: SpeculationStats = None,
+) -> Iterator[list[int]]:
+    """Yields the tokens generated by each step, up to max_new_tokens, eos or max_time."""
+    import torch
+
+    max_new_tokens = settings.get("max_new_tokens", 256)
+    max_time = settings.get("max_time")
+    deadline = time.monotonic() + max_time if max_time else None
+    distribution = TokenDistribution(token_ids, settings)
+    stats = stats if stats is not None else SpeculationStats()
+    sequence = list(token_ids)
+    generated = 0
+
+    # The target cache always covers the sequence but its last token, which the next step feeds
+    past_key_values = None
+    if len(sequence) > 1:
+        with torch.no_grad():
+            past_key_values = model(
+                input_ids=torch.tensor([sequence[:-1]], device=model.device), use_cache=True
+            ).past_key_values
+
+    while generated < max_new_tokens:
+        if (cancel is not None and cancel.is_set()) or (
+            deadline is not None and time.monotonic() >= deadline
+        ):
+            return
+        draft, draft_probs = drafter.propose(
+            sequence, min(num_draft_tokens, max_new_tokens - generated - 1), distribution
+        )
+        with torch.no_grad():
+            output = model(
+                input_ids=torch.tensor([[sequence[-1], *draft]], device=model.device),
+                past_key_values=past_key_values,
+                use_cache=True,
+            )
+        accepted, token = verify(draft, draft_probs, output.logits[0], distribution)
+        past_key_values = crop_past_key_values(output.past_key_values, len(sequence) + accepted)
+        drafter.rollback(len(sequence) + accepted)
+
+        tokens = [*draft[:accepted], token][: max_new_tokens - generated]
+        finished = eos_token_id is not None and eos_token_id in tokens
+        if finished:
+            tokens = tokens[: tokens.index(eos_token_id) + 1]
+        stats.proposed += len(draft)
+        stats.accepted += accepted
+        stats.steps += 1
+        stats.generated += len(tokens)
+        SPECULATIVE_TOKENS.labels("proposed").inc(len(draft))
+        SPECULATIVE_TOKENS.labels("accepted").inc(accepted)
+
+        sequence.extend(tokens)
+        distribution.add(tokens)
+        generated += len(tokens)
+        yield tokens
+        if finished:
+            return
+
+
+def load_draft_model(pretrained_model_name_or_path: str, device):
+    from transformers import AutoModelForCausalLM
+
+    logger.info("Start loading draft model from path: %s", pretrained_model_name_or_path)
+    model = AutoModelForCausalLM.from_pretrained(
+        pretrained_model_name_or_path, torch_dtype="auto", device_map={"": device}
+    )
+    model.eval()
+    logger.info("Finished loading draft model")
+    return model
@@ -0,0 +1,125 @@
+"""Stop sequences that end the assistant turn of a prompt template, e.g. " ### Human:".
+
+Generation is stopped on token ids, the answer is then cut on text. A stop string tokenizes
+differently depending on what precedes it, so its ids are precomputed behind a few anchors
+and each step only compares the tail of the sequence with them. Whatever the ids miss is
+still cut from the decoded answer, it only costs the tokens generated until eos.
+"""
+import logging
+from typing import Sequence
+
+from app.metrics.registry import REGISTRY, Counter
+
+logger = logging.getLogger(__name__)
+
+STOP_SEQUENCE_STOPS = REGISTRY.register(
+    Counter("toonchat_stop_sequence_stops_total", "Generations stopped by a stop sequence")
+)
+STOP_SEQUENCE_SAVED_TOKENS = REGISTRY.register(
+    Counter(
+        "toonchat_stop_sequence_saved_tokens_total",
+        "max_new_tokens left unused by generations stopped by a stop sequence",
+    )
+)
+
+# Texts a stop string may follow in an answer, the ids of the anchor are dropped
+ANCHORS = ("\n", " ", ".", "a")
+# Whitespace that usually merges into the first token of a stop string, e.g. " ###"
+PREFIXES = ("\n", " ")
+
+
+class StopSequences:
+    def __init__(self, tokenizer, stop_strings: Sequence[str]) -> None:
+        self.stop_strings = tuple(stop for stop in stop_strings if stop)
+        variants = set()
+        for stop in self.stop_strings:
+            variants.add(tuple(_encode(tokenizer, stop)))
+            for prefix in PREFIXES:
+                variants.add(tuple(_encode(tokenizer, prefix + stop)))
+            for anchor in ANCHORS:
+                anchor_ids = _encode(tokenizer, anchor)
+                ids = _encode(tokenizer, anchor + stop)
+                if ids[: len(anchor_ids)] == anchor_ids:
+                    variants.add(tuple(ids[len(anchor_ids) :]))
+        self.variants: tuple[tuple[int, ...], ...] = tuple(v for v in variants if v)
+        self.max_length = max(map(len, self.variants), default=0)
+        self._by_last_id: dict[int, list[tuple[int, ...]]] = {}
+        for variant in self.variants:
+            self._by_last_id.setdefault(variant[-1], []).append(variant)
+
+    def __bool__(self) -> bool:
+        return bool(self.variants)
+
+    def ends_with_stop(self, token_ids: Sequence[int]) -> bool:
+        """Whether token_ids end with the ids of a stop string, checked after every token."""
+        return self.find_ids(token_ids, len(token_ids) - 1) >= 0
+
+    def find_ids(self, token_ids: Sequence[int], start: int = 0) -> int:
+        """End of the first stop string whose last id is at or after start, -1 without one."""
+        for end in range(max(start, 0) + 1, len(token_ids) + 1):
+            for variant in self._by_last_id.get(token_ids[end - 1], ()):
+                if end >= len(variant) and tuple(token_ids[end - len(variant) : end]) == variant:
+                    return end
+        return -1
+
+    def find(self, text: str) -> int:
+        """Index of the first stop string in text, -1 without one."""
+        found = [index for index in map(text.find, self.stop_strings) if index >= 0]
+        return min(found, default=-1)
+
+    def trim(self, text: str) -> str:
+        index = self.find(text)
+        return text if index < 0 else text[:index].rstrip()
+
+    def record(self, generated: int, max_new_tokens: int = None):
+        """Counts a generation that stopped on a stop sequence after generated tokens."""
+        STOP_SEQUENCE_STOPS.inc()
+        if max_new_tokens is not None:
+            STOP_SEQUENCE_SAVED_TOKENS.inc(max(max_new_tokens - generated, 0))
+
+
+class StopTextFilter:
+    """Holds back streamed text that may be the start of a stop string.
+
+    Text before a stop string is released like StopSequences.trim cuts it, the stop string and
+    anything after it never is.
+    """
+
+    def __init__(self, stop_sequences: StopSequences) -> None:
+        self.stop_sequences = stop_sequences
+        self.stopped = False
+        self._pending = ""
+
+    def put(self, text: str) -> str:
+        if self.stopped:
+            return ""
+        self._pending += text
+        index = self.stop_sequences.find(self._pending)
+        if index >= 0:
+            self.stopped = True
+            released, self._pending = self._pending[:index].rstrip(), ""
+            return released
+
+        held = self._partial_stop_length(self._pending)
+        # Trailing whitespace waits too, an answer that stops right after it ends without it
+        released = self._pending[: len(self._pending) - held].rstrip()
+        self._pending = self._pending[len(released) :]
+        return released
+
+    def flush(self) -> str:
+        released, self._pending = self._pending, ""
+        return released
+
+    def _partial_stop_length(self, text: str) -> int:
+        """Length of the longest suffix of text that a stop string starts with."""
+        longest = 0
+        for stop in self.stop_sequences.stop_strings:
+            for length in range(min(len(stop) - 1, len(text)), longest, -1):
+                if stop.startswith(text[-length:]):
+                    longest = length
+                    break
+        return longest
+
+
+def _encode(tokenizer, text: str) -> list[int]:
+    return tokenizer.encode(text, add_special_tokens=False)
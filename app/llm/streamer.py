@@ -0,0 +1,110 @@
+import time
+import logging
+from queue import Queue
+
+logger = logging.getLogger(__name__)
+
+
+class IncrementalDecoder:
+    """Decodes token ids one step at a time without splitting multibyte characters.
+
+    Only a small window of tokens is re-decoded on every step, and text is held back while it
+    ends with a replacement character, i.e. while a Hangul syllable is still split across tokens.
+    """
+
+    def __init__(self, tokenizer) -> None:
+        self.tokenizer = tokenizer
+        self.token_ids: list[int] = []
+        self.prefix_offset = 0
+        self.read_offset = 0
+
+    def put(self, token_ids: list[int]) -> str:
+        self.token_ids.extend(token_ids)
+        prefix_text = self._decode(self.token_ids[self.prefix_offset : self.read_offset])
+        new_text = self._decode(self.token_ids[self.prefix_offset :])
+        if len(new_text) <= len(prefix_text) or new_text.endswith("\ufffd"):
+            return ""
+
+        self.prefix_offset = self.read_offset
+        self.read_offset = len(self.token_ids)
+        return new_text[len(prefix_text) :]
+
+    def flush(self) -> str:
+        prefix_text = self._decode(self.token_ids[self.prefix_offset : self.read_offset])
+        new_text = self._decode(self.token_ids[self.prefix_offset :])
+        self.prefix_offset = self.read_offset = len(self.token_ids)
+        return new_text[len(prefix_text) :]
+
+    def _decode(self, token_ids: list[int]) -> str:
+        return self.tokenizer.decode(token_ids, skip_special_tokens=True)
+
+
+class TokenStreamer:
+    """Streamer for model.generate(streamer=...) that is iterated from another thread."""
+
+    _end = object()
+
+    def __init__(self, tokenizer, skip_prompt=True, timeout: float = None) -> None:
+        self.decoder = IncrementalDecoder(tokenizer)
+        self.skip_prompt = skip_prompt
+        self.timeout = timeout
+        self._queue = Queue()
+        self._prompt_skipped = False
+
+    def put(self, value):
+        # generate passes the prompt first, then a tensor of one new token per step
+        if self.skip_prompt and not self._prompt_skipped:
+            self._prompt_skipped = True
+            return
+
+        text = self.decoder.put(value.reshape(-1).tolist())
+        if text:
+            self._queue.put(text)
+
+    def end(self):
+        text = self.decoder.flush()
+        if text:
+            self._queue.put(text)
+        self._queue.put(self._end)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> str:
+        value = self._queue.get(timeout=self.timeout)
+        if value is self._end:
+            raise StopIteration()
+        return value
+
+
+class ChunkCoalescer:
+    """Merges streamed text until max_interval seconds or max_tokens pieces have passed.
+
+    The first piece is never held back, so time to first token is not delayed.
+    """
+
+    def __init__(self, max_interval: float, max_tokens: int) -> None:
+        self.max_interval = max_interval
+        self.max_tokens = max_tokens
+        self._pieces: list[str] = []
+        self._last_flush = time.monotonic()
+        self._flushed = False
+
+    def add(self, text: str) -> str | None:
+        self._pieces.append(text)
+        if (
+            not self._flushed
+            or len(self._pieces) >= self.max_tokens
+            or time.monotonic() - self._last_flush >= self.max_interval
+        ):
+            return self.flush()
+        return None
+
+    def flush(self) -> str | None:
+        self._last_flush = time.monotonic()
+        if not self._pieces:
+            return None
+        chunk = "".join(self._pieces)
+        self._pieces.clear()
+        self._flushed = True
+        return chunk
@@ -0,0 +1,303 @@
+import time
+import queue
+import logging
+import itertools
+import threading
+import multiprocessing
+from concurrent.futures import Future
+from dataclasses import dataclass
+
+from app.message_queue.data import PromptData
+from app.llm.models import LLM
+from app.metrics.registry import REGISTRY, Counter
+
+# Registers pickling of the tzinfo pydantic parses createdAt with
+import app.llm.worker  # noqa: F401
+
+logger = logging.getLogger(__name__)
+
+WORKER_RESTARTS = REGISTRY.register(
+    Counter("toonchat_model_worker_restarts_total", "Model worker processes restarted", ("worker",))
+)
+
+_READY = "ready"
+_STARTED = "started"
+
+
+class WorkerCrashed(RuntimeError):
+    pass
+
+
+def _serve(llm: LLM, requests, responses):
+    """Answers (request_id, method, args, kwargs) until it gets None."""
+    while True:
+        request = requests.get()
+        if request is None:
+            return
+        request_id, method, args, kwargs = request
+        responses.put((request_id, _STARTED, None))
+        try:
+            responses.put((request_id, getattr(llm, method)(*args, **kwargs), None))
+        except Exception as e:
+            responses.put((request_id, None, repr(e)))
+
+
+def _worker_main(overrides: dict, requests, cheap_requests, responses):
+    """Loads one model and serves requests until it gets None. Cheap requests are served by
+    their own thread, so they never wait behind a generation."""
+    from app.llm.factory import llm_factory
+
+    try:
+        llm = llm_factory.create_llm(overrides["prompt_template"], **overrides)
+    except Exception as e:
+        responses.put((None, None, f"Failed to load {overrides['prompt_template']}: {e!r}"))
+        return
+    responses.put((None, _READY, None))
+
+    threading.Thread(
+        target=_serve, args=(llm, cheap_requests, responses), name="cheap-requests", daemon=True
+    ).start()
+    _serve(llm, requests, responses)
+
+
+@dataclass
+class _Pending:
+    request: tuple
+    future: Future
+    started: bool = False
+    attempts: int = 0
+
+
+class ModelWorker:
+    """One worker process and the thread that reads its answers and restarts it when it dies.
+
+    Requests that were queued behind a crash are sent again to the new process. The request
+    that was running is retried max_attempts times, it may be the reason of the crash.
+    """
+
+    restart_delay = 1.0
+    max_attempts = 2
+    poll_interval = 0.5
+    # Served next to generations, e.g. count_tokens runs before a request is admitted
+    cheap_methods = frozenset({"count_tokens"})
+
+    def __init__(self, name: str, overrides: dict, context) -> None:
+        self.name = name
+        self.overrides = overrides
+        self.restarts = 0
+        self._context = context
+        self._lock = threading.Lock()
+        self._pending: dict[int, _Pending] = {}
+        self._ids = itertools.count()
+        self._ready = threading.Event()
+        self._load_error: str = None
+        self._stopping = False
+        self._process = None
+        self._requests = None
+        self._cheap_requests = None
+        self._responses = None
+
+    def start(self):
+        self._spawn()
+        threading.Thread(target=self._read, name=f"worker-{self.name}", daemon=True).start()
+
+    def wait_ready(self, timeout: float = None):
+        if not self._ready.wait(timeout):
+            raise TimeoutError(f"Worker {self.name} did not load in {timeout}s")
+        if self._load_error:
+            raise RuntimeError(self._load_error)
+
+    def in_flight(self) -> int:
+        return len(self._pending)
+
+    def submit(self, method: str, *args, **kwargs) -> Future:
+        future = Future()
+        with self._lock:
+            request_id = next(self._ids)
+            pending = _Pending((request_id, method, args, kwargs), future)
+            self._pending[request_id] = pending
+            self._send(pending)
+        return future
+
+    def stop(self, timeout: float = 10.0):
+        self._stopping = True
+        self._cheap_requests.put(None)
+        self._requests.put(None)
+        self._process.join(timeout)
+        if self._process.is_alive():
+            self._process.kill()
+
+    def _spawn(self):
+        self._requests = self._context.Queue()
+        self._cheap_requests = self._context.Queue()
+        self._responses = self._context.Queue()
+        self._process = self._context.Process(
+            target=_worker_main,
+            args=(self.overrides, self._requests, self._cheap_requests, self._responses),
+            name=f"model-{self.name}",
+            daemon=True,
+        )
+        self._process.start()
+        logger.info("Started worker %s as process %d", self.name, self._process.pid)
+
+    def _send(self, pending: _Pending):
+        pending.started = False
+        pending.attempts += 1
+        method = pending.request[1]
+        requests = self._cheap_requests if method in self.cheap_methods else self._requests
+        requests.put(pending.request)
+
+    def _read(self):
+        while not self._stopping:
+            try:
+                request_id, result, error = self._responses.get(timeout=self.poll_interval)
+            except queue.Empty:
+                if not self._process.is_alive() and not self._stopping:
+                    self._restart()
+                continue
+            except (EOFError, OSError):
+                # The pipe broke with the process, is_alive catches up on the next poll
+                time.sleep(self.poll_interval)
+                continue
+
+            if request_id is None:
+                self._on_status(result, error)
+                continue
+            with self._lock:
+                pending = self._pending.get(request_id)
+                if pending is None:
+                    continue
+                if result == _STARTED and error is None:
+                    pending.started = True
+                    continue
+                del self._pending[request_id]
+            if error is not None:
+                pending.future.set_exception(RuntimeError(f"Worker {self.name}: {error}"))
+            else:
+                pending.future.set_result(result)
+
+    def _on_status(self, status: str, error: str):
+        if status == _READY:
+            logger.info("Worker %s is ready", self.name)
+            self._load_error = None
+        else:
+            logger.error("Worker %s failed: %s", self.name, error)
+            self._load_error = error
+            # Nothing would answer them until a restart loads the model
+            with self._lock:
+                failed = list(self._pending.values())
+                self._pending.clear()
+            for pending in failed:
+                pending.future.set_exception(RuntimeError(error))
+        self._ready.set()
+
+    def _restart(self):
+        logger.error(
+            "Worker %s exited with code %s, restarting in %.1fs",
+            self.name,
+            self._process.exitcode,
+            self.restart_delay,
+        )
+        WORKER_RESTARTS.labels(self.name).inc()
+        self.restarts += 1
+        time.sleep(self.restart_delay)
+        with self._lock:
+            self._spawn()
+            for request_id, pending in list(self._pending.items()):
+                if pending.started and pending.attempts >= self.max_attempts:
+                    del self._pending[request_id]
+                    pending.future.set_exception(
+                        WorkerCrashed(f"Worker {self.name} crashed {pending.attempts} times on it")
+                    )
+                elif pending.started:
+                    self._send(pending)
+                else:
+                    # Never ran, so the crash does not count against it
+                    pending.attempts -= 1
+                    self._send(pending)
+
+
+class ModelSupervisor(LLM):
+    """Serves several models, each in workers_per_model processes started with spawn.
+
+    models maps the name PromptData.model routes by to the LLM config overrides of its workers,
+    which name the prompt_template registered in LLMFactory and e.g. its
+    pretrained_model_name_or_path and device. Messages without a model go to default_model.
+    The AMQP connection stays in this process, so a crashed worker is restarted while
+    deliveries keep being consumed.
+    """
+
+    def __init__(self, **kwargs) -> None:
+        models: dict[str, dict] = kwargs["models"]
+        self.default_model = kwargs.get("default_model") or next(iter(models))
+        load_timeout = kwargs.get("load_timeout")
+        context = multiprocessing.get_context("spawn")
+        self.workers: dict[str, list[ModelWorker]] = {
+            name: [
+                ModelWorker(f"{name}#{i}", {"prompt_template": name, **overrides}, context)
+                for i in range(kwargs.get("workers_per_model", 1))
+            ]
+            for name, overrides in models.items()
+        }
+        # Workers load their models in parallel
+        for worker in self.all_workers():
+            worker.start()
+        for worker in self.all_workers():
+            worker.wait_ready(load_timeout)
+        logger.info("Serving models %s", ", ".join(self.workers))
+
+    def all_workers(self) -> list[ModelWorker]:
+        return [worker for workers in self.workers.values() for worker in workers]
+
+    def route(self, data: PromptData) -> str:
+        name = data.model or self.default_model
+        if name not in self.workers:
+            raise ValueError(f"Model {name} is not served")
+        return name
+
+    def worker(self, name: str) -> ModelWorker:
+        return min(self.workers[name], key=ModelWorker.in_flight)
+
+    def generate(self, data: PromptData, **generation_kwargs):
+        return self.generate_batch([data], **generation_kwargs)[0]
+
+    def generate_batch(self, data_list: list[PromptData], **generation_kwargs) -> list[str]:
+        # Events do not cross processes, cancelled requests are only dropped before they start
+        cancel = generation_kwargs.pop("cancel", None) or [None] * len(data_list)
+        groups: dict[str, list[int]] = {}
+        for i, (data, event) in enumerate(zip(data_list, cancel, strict=True)):
+            if event is None or not event.is_set():
+                groups.setdefault(self.route(data), []).append(i)
+
+        futures = [
+            (
+                indices,
+                self.worker(name).submit(
+                    "generate_batch", [data_list[i] for i in indices], **generation_kwargs
+                ),
+            )
+            for name, indices in groups.items()
+        ]
+        results = [""] * len(data_list)
+        for indices, future in futures:
+            for i, result in zip(indices, future.result(), strict=True):
+                results[i] = result
+        return results
+
+    def count_tokens(self, data: PromptData) -> int:
+        return self.worker(self.route(data)).submit("count_tokens", data).result()
+
+    def get_adapter(self, data: PromptData) -> str | None:
+        # The scheduler batches by adapter, so a batch only holds requests of one model. The
+        # worker resolves the adapter of its model itself
+        return self.route(data)
+
+    def report(self) -> dict:
+        return {
+            worker.name: {"in_flight": worker.in_flight(), "restarts": worker.restarts}
+            for worker in self.all_workers()
+        }
+
+    def shutdown(self):
+        for worker in self.all_workers():
+            worker.stop()
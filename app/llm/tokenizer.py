@@ -1,7 +1,15 @@
 import logging
+import threading
+from collections import OrderedDict
+from typing import Hashable
+
+from app.metrics.registry import STAGE_SECONDS
 
 logger = logging.getLogger(__name__)
 
+TOKENIZE_SECONDS = STAGE_SECONDS.labels("tokenize")
+DETOKENIZE_SECONDS = STAGE_SECONDS.labels("detokenize")
+
 
 def load_tokenizer(pretrained_model_name_or_path, kwargs: dict):
     from transformers import AutoTokenizer
@@ -10,23 +18,181 @@ def load_tokenizer(pretrained_model_name_or_path, kwargs: dict):
     tokenizer = AutoTokenizer.from_pretrained(pretrained_model_name_or_path)
     tokenizer.model_max_length = kwargs.pop("model_max_length", 4096)
     tokenizer.pad_token = tokenizer.eos_token
+    # Decoder-only models continue from the last position, so batches are padded on the left
+    tokenizer.padding_side = "left"
+    backend = getattr(tokenizer, "backend_tokenizer", None)
+    if backend is not None:
+        # The Rust tokenizer fails with "Already borrowed" when its padding or truncation is
+        # changed while another thread tokenizes, e.g. count_tokens next to a generation. Calls
+        # without either leave it as it is from here on
+        backend.no_padding()
+        backend.no_truncation()
     logger.info("Finished loading Tokenizer")
 
     return tokenizer
 
 
 def tokenizer_encode(tokenizer, prompt):
-    return tokenizer.encode(
-        prompt,
-        add_special_tokens=False,
-        padding=False,
-        truncation=False,
-        max_length=tokenizer.model_max_length,
-        return_tensors="pt",
-    )
-
-
-def tokenizer_decode(tokenizer, sequences):
-    decoded_output = tokenizer.batch_decode(sequences)[0]
-    logger.info(decoded_output)
-    return decoded_output
+    with TOKENIZE_SECONDS.time():
+        return tokenizer.encode(
+            prompt,
+            add_special_tokens=False,
+            padding=False,
+            truncation=False,
+            max_length=tokenizer.model_max_length,
+            return_tensors="pt",
+        )
+
+
+def tokenizer_encode_batch(tokenizer, prompts: list[str]) -> dict:
+    import torch
+
+    with TOKENIZE_SECONDS.time():
+        encoded = tokenizer(prompts, add_special_tokens=False, padding=False, truncation=False)
+    rows = encoded["input_ids"]
+    # Padded here, padding=True would switch padding on in the tokenizer shared between threads
+    length = max(len(row) for row in rows)
+    input_ids = torch.full((len(rows), length), tokenizer.pad_token_id, dtype=torch.long)
+    attention_mask = torch.zeros((len(rows), length), dtype=torch.long)
+    for i, row in enumerate(rows):
+        start = length - len(row) if tokenizer.padding_side == "left" else 0
+        input_ids[i, start : start + len(row)] = torch.tensor(row, dtype=torch.long)
+        attention_mask[i, start : start + len(row)] = 1
+    return {"input_ids": input_ids, "attention_mask": attention_mask}
+
+
+def tokenizer_decode_batch(tokenizer, sequences) -> list[str]:
+    with DETOKENIZE_SECONDS.time():
+        return tokenizer.batch_decode(sequences, skip_special_tokens=True)
+
+
+class SegmentEncoder:
+    """Tokenizes prompt segments once and assembles input ids from a bounded LRU of their ids.
+
+    Segments after the first are encoded behind an anchor whose ids are then dropped, so the
+    tokenizer sees the same left context as in the full prompt: the special token the previous
+    segment ends with, or a newline otherwise. Whether a boundary tokenizes the same with the
+    anchor as in the full prompt is proven per kind of boundary: the anchor and the characters
+    on either side of it. Every prompt with a boundary of an unproven kind is compared with the
+    plain string path; when it matches, its boundaries are proven, otherwise they are unsafe and
+    their segments are joined with the previous one from then on, and the prompt's string ids
+    are returned. Proven prompts are still compared every verify_every-th prompt, verify_every=0
+    never compares, for encoders that only count tokens.
+    """
+
+    def __init__(self, tokenizer, max_segments: int, anchor="\n", verify_every=100) -> None:
+        self.tokenizer = tokenizer
+        self.max_segments = max_segments
+        self.verify_every = verify_every
+        self.hits = 0
+        self.misses = 0
+        self.mismatches = 0
+        self._anchor = anchor
+        self._anchor_lengths: dict[str, int] = {}
+        self._special_tokens = tuple(
+            {*tokenizer.all_special_tokens, *tokenizer.get_added_vocab().keys()}
+        )
+        self._cache: OrderedDict[Hashable, tuple[str, list[int]]] = OrderedDict()
+        self._safe_boundaries: set[tuple[str, str, str]] = set()
+        self._unsafe_boundaries: set[tuple[str, str, str]] = set()
+        self._encoded_prompts = 0
+        self._lock = threading.Lock()
+
+    def encode(self, segments: list[tuple[Hashable, str]]) -> list[int]:
+        with TOKENIZE_SECONDS.time():
+            return self._encode_segments(segments)
+
+    def _encode_segments(self, segments: list[tuple[Hashable, str]]) -> list[int]:
+        # Segments behind an unsafe boundary are joined with the previous one into a run
+        runs: list[tuple[list[Hashable], list[str], str | None]] = []
+        boundaries = []
+        for key, text in segments:
+            if runs:
+                boundary = self._get_boundary(runs[-1][1][-1], text)
+                if boundary in self._unsafe_boundaries:
+                    runs[-1][0].append(key)
+                    runs[-1][1].append(text)
+                    continue
+                boundaries.append(boundary)
+                runs.append(([key], [text], boundary[0]))
+            else:
+                runs.append(([key], [text], None))
+
+        token_ids = []
+        for keys, texts, anchor in runs:
+            key = keys[0] if len(keys) == 1 else (None if None in keys else tuple(keys))
+            token_ids.extend(self.encode_segment(key, "".join(texts), anchor))
+
+        if not self.verify_every or not boundaries:
+            return token_ids
+        with self._lock:
+            self._encoded_prompts += 1
+            unproven = not self._safe_boundaries.issuperset(boundaries)
+            if not unproven and self._encoded_prompts % self.verify_every:
+                return token_ids
+
+        expected = self._encode("".join(text for _, text in segments))
+        with self._lock:
+            if token_ids == expected:
+                self._safe_boundaries.update(boundaries)
+                return token_ids
+            # Which boundary differs is unknown, all of the prompt's are encoded joined
+            self.mismatches += 1
+            self._safe_boundaries.difference_update(boundaries)
+            self._unsafe_boundaries.update(boundaries)
+        logger.warning(
+            "Segmented token ids differ from the prompt, joining %d kinds of boundaries",
+            len(set(boundaries)),
+        )
+        return expected
+
+    def segment_lengths(self, segments: list[tuple[Hashable, str]]) -> list[int]:
+        lengths, anchor = [], None
+        for key, text in segments:
+            lengths.append(len(self.encode_segment(key, text, anchor)))
+            anchor = self._get_anchor(text)
+        return lengths
+
+    def encode_segment(self, key: Hashable, text: str, anchor: str = None) -> list[int]:
+        cache_key = (anchor, text if key is None else key)
+        with self._lock:
+            cached = self._cache.get(cache_key)
+            if cached is not None and cached[0] == text:
+                self._cache.move_to_end(cache_key)
+                self.hits += 1
+                return cached[1]
+
+        if anchor is None:
+            token_ids = self._encode(text)
+        else:
+            token_ids = self._encode(anchor + text)[self._get_anchor_length(anchor) :]
+
+        with self._lock:
+            self.misses += 1
+            self._cache[cache_key] = (text, token_ids)
+            self._cache.move_to_end(cache_key)
+            while len(self._cache) > self.max_segments:
+                self._cache.popitem(last=False)
+        return token_ids
+
+    def _get_boundary(self, previous_text: str, text: str) -> tuple[str, str, str]:
+        return self._get_anchor(previous_text), previous_text[-1:], text[:1]
+
+    def _get_anchor(self, previous_text: str) -> str:
+        if previous_text.endswith(self._special_tokens):
+            return next(token for token in self._special_tokens if previous_text.endswith(token))
+        return self._anchor
+
+    def _get_anchor_length(self, anchor: str) -> int:
+        if anchor not in self._anchor_lengths:
+            self._anchor_lengths[anchor] = len(self._encode(anchor))
+        return self._anchor_lengths[anchor]
+
+    def _encode(self, text: str) -> list[int]:
+        return self.tokenizer.encode(text, add_special_tokens=False)
+
+
+def to_input_ids(token_ids: list[int]):
+    import torch
+
+    return torch.tensor([token_ids], dtype=torch.long)
@@ -0,0 +1,76 @@
+import logging
+import copyreg
+import multiprocessing
+from datetime import datetime, timezone
+from concurrent.futures import ProcessPoolExecutor
+from pydantic import TypeAdapter
+
+from app.message_queue.data import PromptData
+from app.llm.models import LLM
+
+logger = logging.getLogger(__name__)
+
+# Model owned by the current worker process
+_process_llm: LLM = None
+
+
+def _reduce_tzinfo(tzinfo):
+    return timezone, (tzinfo.utcoffset(None),)
+
+
+# pydantic-core parses offsets into its own tzinfo type, which can not be pickled to a worker
+copyreg.pickle(
+    type(TypeAdapter(datetime).validate_python("2000-01-01T00:00:00Z").tzinfo), _reduce_tzinfo
+)
+
+
+def _init_process_llm(model_name, dir_path):
+    from app.llm.factory import llm_factory
+
+    global _process_llm
+    _process_llm = llm_factory.create_llm(model_name, dir_path)
+
+
+def _process_generate_batch(data_list: list[PromptData], generation_kwargs: dict):
+    return _process_llm.generate_batch(data_list, **generation_kwargs)
+
+
+def _process_count_tokens(data: PromptData):
+    return _process_llm.count_tokens(data)
+
+
+def _process_ping():
+    return _process_llm is not None
+
+
+class ProcessPoolLLM(LLM):
+    """Runs an LLM from the factory in each of max_workers processes, for CPU backends."""
+
+    def __init__(self, **kwargs) -> None:
+        self.max_workers = kwargs.get("max_workers", 1)
+        logger.info(
+            "Starting %d worker processes for model %s", self.max_workers, kwargs.get("model_name")
+        )
+        self._executor = ProcessPoolExecutor(
+            max_workers=self.max_workers,
+            # fork is not safe once torch or pika threads are running
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_process_llm,
+            initargs=(kwargs.get("model_name"), kwargs.get("dir_path")),
+        )
+        # Blocks until a worker has loaded its model, so readiness reflects a usable pool
+        self._executor.submit(_process_ping).result()
+
+    def generate(self, data: PromptData, **generation_kwargs):
+        return self.generate_batch([data], **generation_kwargs)[0]
+
+    def generate_batch(self, data_list: list[PromptData], **generation_kwargs) -> list[str]:
+        # Events do not cross processes, cancelled requests are only dropped before they start
+        generation_kwargs.pop("cancel", None)
+        return self._executor.submit(_process_generate_batch, data_list, generation_kwargs).result()
+
+    def count_tokens(self, data: PromptData) -> int:
+        return self._executor.submit(_process_count_tokens, data).result()
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True, cancel_futures=True)
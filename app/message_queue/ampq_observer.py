@@ -2,6 +2,18 @@ from abc import ABCMeta, abstractmethod
 
 
 class AmqpObserver(metaclass=ABCMeta):
+    # Observers with manual_ack acknowledge deliveries themselves, e.g. after a batched generate
+    manual_ack: bool = False
+
     @abstractmethod
-    def update(self, data):
+    def update(self, data, delivery_tag=None):
         pass
+
+    def is_ready(self) -> bool:
+        """Amqp starts consuming only once every observer is ready."""
+        return True
+
+    def on_reconnect(self):
+        """The transport reconnected: the broker requeued every unsettled delivery, which can no
+        longer be settled. With Amqp, timers set by call_later on the old connection are lost."""
+        return None
@@ -1,28 +1,44 @@
 import logging
-import json
+import time
 import pika
 import functools
+import threading
+from typing import NamedTuple
+from concurrent.futures import ThreadPoolExecutor
 from pika.exchange_type import ExchangeType
 from pika.channel import Channel
 from pika.spec import Basic, BasicProperties
 
-from app.message_queue.config import Config
+from app.message_queue.config import Config, WorkerType
 from app.message_queue.ampq_observer import AmqpObserver
+from app.message_queue.codec import decode
+from app.message_queue.publisher import OutboundBuffer, OutboundMessage
+from app.metrics.registry import ERRORS, REJECTS, RECONNECTS
 
 logger = logging.getLogger(__name__)
 logger.addHandler(logging.StreamHandler())
 
 
+class DeliveryTag(NamedTuple):
+    """A broker delivery tag stamped with the channel it came from, tags restart per channel."""
+
+    generation: int
+    tag: int
+
+
 class Amqp(object):
     publish_exchange = "amq.topic"
+    reconnect_delay = 5.0
     observers: dict[str, AmqpObserver] = {}
 
     def __init__(self, config: Config) -> None:
-        self.should_reconnect = True
+        self.should_reconnect = False
         self.was_consuming = False
 
         self._connection: pika.SelectConnection = None
         self._channel: Channel = None
+        # Incremented for every opened channel, deliveries of an older one are not settled
+        self._channel_generation = 0
         self._closing = False
         self._consumer_tag = None
         self._consuming = False
@@ -33,6 +49,32 @@ class Amqp(object):
         self.consume_exchange_type = ExchangeType.direct
 
         self._prefetch_count = 1
+        self._ioloop_thread = None
+        self._qos_ok = False
+
+        self.worker_count = config.worker_count
+        self.worker_type = config.worker_type
+        self._workers: ThreadPoolExecutor = None
+        if self.worker_count > 0:
+            # Observers run on the pool, so keep enough deliveries in flight to occupy it
+            self._workers = ThreadPoolExecutor(
+                max_workers=self.worker_count, thread_name_prefix="amqp-worker"
+            )
+            self._prefetch_count = self.worker_count
+
+        self._outbound = OutboundBuffer(config.publish_buffer_size, config.publish_spill_path)
+        self._publish_batch_size = config.publish_batch_size
+        self._publish_flush_interval = config.publish_flush_interval
+        self._publish_max_unconfirmed = config.publish_max_unconfirmed
+        self._publish_report_interval = config.publish_report_interval
+        self._publish_properties = BasicProperties(
+            content_type="application/json", content_encoding="utf-8"
+        )
+        self._confirming = False
+        self._flush_scheduled = False
+        self._publish_seq = 0
+        # Published and not confirmed yet, by the publish sequence number of the channel
+        self._unconfirmed: dict[int, OutboundMessage] = {}
 
     def attach(self, observer: AmqpObserver):
         logger.info("Observer %s attached", observer.__class__.__name__)
@@ -42,6 +84,30 @@ class Amqp(object):
         logger.info("Observer %s detached", observer.__class__.__name__)
         self.observers.pop(observer.__class__.__name__, observer, None)
 
+    def set_prefetch_count(self, prefetch_count: int):
+        self._prefetch_count = max(self._prefetch_count, prefetch_count)
+
+    def is_process_worker(self):
+        return self._workers is not None and self.worker_type == WorkerType.PROCESS
+
+    def submit(self, callback, *args):
+        if self._workers is None:
+            callback(*args)
+        else:
+            self._workers.submit(callback, *args)
+
+    def call_later(self, delay: float, callback):
+        # The timer lives on the ioloop, the callback itself runs where observers run
+        self.threadsafe(
+            self._connection.ioloop.call_later, delay, functools.partial(self.submit, callback)
+        )
+
+    def threadsafe(self, callback, *args):
+        if self._ioloop_thread is None or threading.get_ident() == self._ioloop_thread:
+            callback(*args)
+        else:
+            self._connection.add_callback_threadsafe(functools.partial(callback, *args))
+
     def connect(self):
         logger.info("connection to %s", self._url)
         return pika.SelectConnection(
@@ -62,7 +128,16 @@ class Amqp(object):
     def on_channel_open(self, channel):
         logger.info("Channel opened")
         self._channel = channel
+        self._channel_generation += 1
+        # A flush timer of the previous connection's ioloop never fires
+        self._flush_scheduled = False
+        if self._channel_generation > 1:
+            for observer in self.observers.values():
+                observer.on_reconnect()
         self.add_on_channel_close_callback()
+        self._channel.confirm_delivery(
+            self.on_delivery_confirmation, callback=self.on_confirm_selectok
+        )
         self.setup_exchange(self.consume_exchange)
 
     def add_on_channel_close_callback(self):
@@ -71,6 +146,8 @@ class Amqp(object):
 
     def on_channel_closed(self, channel, reason):
         logger.warning("Channel %i was closed: %s", channel, reason)
+        self._qos_ok = False
+        self.requeue_unconfirmed()
         self.close_connection()
 
     def on_connection_open_error(self, _unused_connection: pika.SelectConnection, err: Exception):
@@ -79,6 +156,7 @@ class Amqp(object):
 
     def on_connection_closed(self, _unused_connection: pika.SelectConnection, reason: Exception):
         self._channel = None
+        self.requeue_unconfirmed()
         if self._closing:
             self._connection.ioloop.stop()
         else:
@@ -148,8 +226,21 @@ class Amqp(object):
 
     def on_basic_qos_ok(self, _unused_frame):
         logger.info("QOS set to: %d", self._prefetch_count)
+        self._qos_ok = True
+        self.start_consuming_when_ready()
+
+    def start_consuming_when_ready(self):
+        if self._consuming or not self._qos_ok:
+            return
+        if not all(observer.is_ready() for observer in self.observers.values()):
+            logger.info("Waiting for observers to be ready before consuming")
+            return
         self.start_consuming()
 
+    def notify_ready(self):
+        """Called from any thread by an observer that became ready."""
+        self.threadsafe(self.start_consuming_when_ready)
+
     def start_consuming(self):
         logger.info("Issuing consumer related RPC commands")
         self.add_on_cancel_callback()
@@ -173,11 +264,13 @@ class Amqp(object):
         properties: BasicProperties,
         body: bytes,
     ):
+        delivery_tag = DeliveryTag(self._channel_generation, basic_deliver.delivery_tag)
         try:
-            message = json.loads(str(body, encoding="utf-8"))
+            message = decode(body)
         except Exception as e:
+            ERRORS.labels("decode_body").inc()
             logger.error("Not a valid json format: %s", body)
-            self.reject_message(basic_deliver.delivery_tag, e, False)
+            self.reject_message(delivery_tag, e, False)
             return
 
         logger.debug(
@@ -187,20 +280,45 @@ class Amqp(object):
             message,
         )
 
+        self.submit(self.dispatch, message, delivery_tag)
+
+    def dispatch(self, message, delivery_tag):
         try:
             for observer in self.observers.values():
-                observer.update(message)
-            self.acknowledge_message(basic_deliver.delivery_tag)
+                observer.update(message, delivery_tag)
+            if not any(observer.manual_ack for observer in self.observers.values()):
+                self.acknowledge_message(delivery_tag)
         except Exception as e:
-            self.reject_message(basic_deliver.delivery_tag, e)
+            self.reject_message(delivery_tag, e)
 
     def acknowledge_message(self, delivery_tag):
+        self.threadsafe(self._acknowledge_message, delivery_tag)
+
+    def _acknowledge_message(self, delivery_tag: DeliveryTag):
         logger.debug("Acknowledging message %s", delivery_tag)
-        self._channel.basic_ack(delivery_tag)
+        if not self._can_settle(delivery_tag):
+            return
+        self._channel.basic_ack(delivery_tag.tag)
 
     def reject_message(self, delivery_tag, exception: Exception, requeue=False):
-        logger.info("Rejecting message %s by: ", delivery_tag, exception)
-        self._channel.basic_nack(delivery_tag, requeue=requeue)
+        self.threadsafe(self._reject_message, delivery_tag, exception, requeue)
+
+    def _reject_message(self, delivery_tag: DeliveryTag, exception: Exception, requeue=False):
+        logger.info("Rejecting message %s by: %s", delivery_tag, exception)
+        if not self._can_settle(delivery_tag):
+            return
+        REJECTS.inc()
+        self._channel.basic_nack(delivery_tag.tag, requeue=requeue)
+
+    def _can_settle(self, delivery_tag: DeliveryTag) -> bool:
+        if self._channel is None or not self._channel.is_open:
+            logger.warning("Channel is closed, can not settle message %s", delivery_tag)
+            return False
+        if delivery_tag.generation != self._channel_generation:
+            # Its channel is gone and the broker requeued it, the tag means another delivery now
+            logger.warning("Message %s is from a lost channel, not settling it", delivery_tag)
+            return False
+        return True
 
     def stop_consuming(self):
         if self._channel:
@@ -218,15 +336,101 @@ class Amqp(object):
         self._channel.close()
 
     def run(self):
-        self._connection = self.connect()
-        self._connection.ioloop.start()
+        self._ioloop_thread = threading.get_ident()
+        while True:
+            self._connection = self.connect()
+            if self._publish_report_interval > 0:
+                self._connection.ioloop.call_later(self._publish_report_interval, self.log_report)
+            self._connection.ioloop.start()
+            if not self.should_reconnect:
+                break
+            # Replies buffered meanwhile go out once the new channel is in confirm mode
+            logger.info("Reconnecting in %.1fs", self.reconnect_delay)
+            RECONNECTS.inc()
+            self.should_reconnect = False
+            self._closing = False
+            time.sleep(self.reconnect_delay)
+
+        logger.info("Outbound publisher: %s", self._outbound.report())
+        # Whatever is left survives a restart when a spill file is configured
+        self._outbound.spill_all()
 
     def publish(self, routing_key, body):
-        logger.debug("Publishing message to user: %s, message: %s", routing_key, body)
+        self._outbound.put(routing_key, body)
         try:
-            property = BasicProperties(content_type="application/json", content_encoding="utf-8")
-            self._channel.basic_publish(self.publish_exchange, routing_key, body, property)
+            self.threadsafe(self.schedule_flush)
         except Exception as e:
-            logger.error(
-                "Failed to publish message. user: %s, message: %s, error: %s", routing_key, body, e
+            # The connection is being replaced, the new channel flushes the buffer
+            logger.debug("Can not schedule flush: %s", e)
+
+    def schedule_flush(self):
+        if self._connection is None:
+            # Not running yet, the buffer is flushed once the channel is in confirm mode
+            return
+        if len(self._outbound) >= self._publish_batch_size or self._publish_flush_interval <= 0:
+            self.flush_outbound()
+        elif not self._flush_scheduled:
+            self._flush_scheduled = True
+            self._connection.ioloop.call_later(self._publish_flush_interval, self.on_flush_timer)
+
+    def on_flush_timer(self):
+        self._flush_scheduled = False
+        self.flush_outbound()
+
+    def on_confirm_selectok(self, _unused_frame):
+        logger.info("Publisher confirms enabled")
+        self._confirming = True
+        self.flush_outbound()
+
+    def flush_outbound(self):
+        if not self._confirming or self._channel is None or not self._channel.is_open:
+            # Flushed again once a new channel is in confirm mode
+            return
+
+        batch = self._outbound.take(self._publish_max_unconfirmed - len(self._unconfirmed))
+        for i, message in enumerate(batch):
+            logger.debug(
+                "Publishing message to user: %s, message: %s", message.routing_key, message.body
             )
+            try:
+                self._channel.basic_publish(
+                    self.publish_exchange,
+                    message.routing_key,
+                    message.body,
+                    self._publish_properties,
+                )
+            except Exception as e:
+                logger.error("Failed to publish message to user: %s: %s", message.routing_key, e)
+                self._outbound.retry(batch[i:])
+                return
+            self._publish_seq += 1
+            self._unconfirmed[self._publish_seq] = message
+
+    def on_delivery_confirmation(self, method_frame):
+        method = method_frame.method
+        if method.multiple:
+            tags = [tag for tag in self._unconfirmed if tag <= method.delivery_tag]
+        else:
+            tags = [method.delivery_tag] if method.delivery_tag in self._unconfirmed else []
+        messages = [self._unconfirmed.pop(tag) for tag in sorted(tags)]
+
+        if isinstance(method, Basic.Ack):
+            self._outbound.confirm(messages)
+        else:
+            logger.warning("Broker rejected %d replies, publishing them again", len(messages))
+            self._outbound.retry(messages)
+        if len(self._outbound):
+            self.flush_outbound()
+
+    def requeue_unconfirmed(self):
+        """Unconfirmed replies of a lost channel are published again on the next one."""
+        self._confirming = False
+        self._publish_seq = 0
+        if self._unconfirmed:
+            logger.warning("Requeueing %d unconfirmed replies", len(self._unconfirmed))
+            self._outbound.retry([self._unconfirmed[tag] for tag in sorted(self._unconfirmed)])
+            self._unconfirmed.clear()
+
+    def log_report(self):
+        logger.info("Outbound publisher: %s", self._outbound.report())
+        self._connection.ioloop.call_later(self._publish_report_interval, self.log_report)
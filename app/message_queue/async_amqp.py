@@ -0,0 +1,358 @@
+import signal
+import asyncio
+import logging
+import functools
+import importlib
+import itertools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from app.message_queue.config import Config, WorkerType
+from app.message_queue.ampq_observer import AmqpObserver
+from app.message_queue.codec import decode
+from app.metrics.registry import ERRORS, REJECTS, RECONNECTS
+from app.message_queue.publisher import OutboundBuffer
+
+logger = logging.getLogger(__name__)
+
+
+def _channel_lost(message) -> bool:
+    try:
+        return message.channel.is_closed
+    except Exception:
+        # aio_pika raises on the channel of a message once it is closed
+        return True
+
+
+class AsyncAmqp(object):
+    """asyncio transport with the same observer contract as Amqp.
+
+    Deliveries come in on their own channel and replies go out on a second channel with
+    publisher confirms, so a slow confirm never delays an ack. Observers run on a thread pool
+    and may call publish, acknowledge_message and reject_message from any thread.
+    """
+
+    publish_exchange = "amq.topic"
+    # Wait before publishing failed replies again, a robust connection reconnects meanwhile
+    retry_delay = 1.0
+
+    def __init__(self, config: Config, client=None) -> None:
+        self.observers: dict[str, AmqpObserver] = {}
+        # aio_pika unless something with the same surface is given, e.g. FakeBroker
+        self._client = client
+        self._url = config.broker_url
+        self.consume_exchange = config.task_default_exchange
+        self.consume_queue = config.task_default_queue
+        self.consume_routing_key = config.task_default_routing_key
+
+        self.worker_count = config.worker_count
+        self.worker_type = config.worker_type
+        # Observers block on inference, so they never run on the event loop itself
+        self._workers = ThreadPoolExecutor(
+            max_workers=max(1, self.worker_count), thread_name_prefix="amqp-worker"
+        )
+        self._prefetch_count = max(1, self.worker_count)
+        self._outbound = OutboundBuffer(config.publish_buffer_size, config.publish_spill_path)
+        self._publish_batch_size = config.publish_batch_size
+        self._publish_report_interval = config.publish_report_interval
+        self._max_pending = config.max_pending
+        self._drain_timeout = config.drain_timeout
+
+        self._loop: asyncio.AbstractEventLoop = None
+        self._loop_thread = None
+        self._connection = None
+        self._consume_channel = None
+        self._publish_channel = None
+        self._queue = None
+        self._exchange = None
+        # (queue, consumer tag) of every queue consumed while not paused
+        self._consumer_tags = []
+        self._consuming = False
+        self._paused = False
+        self._closing = False
+        self._stopped: asyncio.Event = None
+        self._outbound_ready: asyncio.Event = None
+        # Deliveries handed to observers and not settled yet, by a local delivery tag. Broker
+        # tags restart on a channel restored by connect_robust, local ones never repeat, so a
+        # delivery of the lost channel can not settle a new one
+        self._messages = {}
+        self._delivery_tags = itertools.count(1)
+
+    def attach(self, observer: AmqpObserver):
+        logger.info("Observer %s attached", observer.__class__.__name__)
+        self.observers[observer.__class__.__name__] = observer
+
+    def detach(self, observer: AmqpObserver):
+        logger.info("Observer %s detached", observer.__class__.__name__)
+        self.observers.pop(observer.__class__.__name__, None)
+
+    def set_prefetch_count(self, prefetch_count: int):
+        self._prefetch_count = max(self._prefetch_count, prefetch_count)
+
+    def is_process_worker(self):
+        return self.worker_count > 0 and self.worker_type == WorkerType.PROCESS
+
+    def submit(self, callback, *args):
+        self._workers.submit(callback, *args)
+
+    def call_later(self, delay: float, callback):
+        self.threadsafe(self._loop.call_later, delay, functools.partial(self.submit, callback))
+
+    def threadsafe(self, callback, *args):
+        if self._loop is None or threading.get_ident() == self._loop_thread:
+            callback(*args)
+        else:
+            self._loop.call_soon_threadsafe(functools.partial(callback, *args))
+
+    def notify_ready(self):
+        """Called from any thread by an observer that became ready."""
+        self.threadsafe(self.start_consuming_when_ready)
+
+    def run(self):
+        asyncio.run(self.serve())
+
+    def stop(self):
+        """Stop consuming and drain, callable from any thread or a signal handler."""
+        self.threadsafe(self._stopped.set)
+
+    async def serve(self):
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread = threading.get_ident()
+        self._stopped = asyncio.Event()
+        self._outbound_ready = asyncio.Event()
+        if self._max_pending <= 0:
+            self._max_pending = 2 * self._prefetch_count
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            try:
+                self._loop.add_signal_handler(sig, self._stopped.set)
+            except (NotImplementedError, RuntimeError, ValueError):
+                # Not the main thread, e.g. under a benchmark, stop() is still available
+                pass
+
+        await self.connect()
+        tasks = [self._loop.create_task(self.publish_loop())]
+        if self._publish_report_interval > 0:
+            tasks.append(self._loop.create_task(self.report_loop()))
+        self.start_consuming_when_ready()
+        await self._stopped.wait()
+
+        await self.drain()
+        for task in tasks:
+            task.cancel()
+        await self._connection.close()
+        self._workers.shutdown(wait=False)
+        logger.info("Outbound publisher: %s", self._outbound.report())
+        # Whatever is left survives a restart when a spill file is configured
+        self._outbound.spill_all()
+        logger.info("Stopped")
+
+    async def connect(self):
+        client = self._client or importlib.import_module("aio_pika")
+        self._client = client
+        logger.info("connection to %s", self._url)
+        self._connection = await client.connect_robust(self._url)
+        reconnect_callbacks = getattr(self._connection, "reconnect_callbacks", None)
+        if reconnect_callbacks is not None:
+            reconnect_callbacks.add(self.on_reconnect)
+
+        self._consume_channel = await self._connection.channel(publisher_confirms=False)
+        await self._consume_channel.set_qos(prefetch_count=self._prefetch_count)
+        logger.info("QOS set to: %d", self._prefetch_count)
+        exchange = await self._consume_channel.declare_exchange(
+            self.consume_exchange, client.ExchangeType.DIRECT, durable=True
+        )
+        self._queue = await self._consume_channel.declare_queue(self.consume_queue, durable=True)
+        await self._queue.bind(exchange, routing_key=self.consume_routing_key)
+        logger.info(
+            "Bound %s to %s with %s",
+            self.consume_exchange,
+            self.consume_queue,
+            self.consume_routing_key,
+        )
+
+        self._publish_channel = await self._connection.channel(publisher_confirms=True)
+        self._exchange = await self._publish_channel.get_exchange(self.publish_exchange)
+
+    def on_reconnect(self, *_unused_args):
+        logger.warning("Reconnected to %s", self._url)
+        RECONNECTS.inc()
+        # The broker redelivers what was unsettled on the lost channel, nothing settles the old
+        # deliveries anymore and they would hold back the consumer and drain forever
+        lost = [tag for tag, message in self._messages.items() if _channel_lost(message)]
+        for delivery_tag in lost:
+            del self._messages[delivery_tag]
+        if lost:
+            logger.info("Forgot %d deliveries of the lost channel", len(lost))
+        for observer in self.observers.values():
+            observer.on_reconnect()
+        self.check_backpressure()
+
+    def start_consuming_when_ready(self):
+        if self._consuming or self._paused or self._closing or self._queue is None:
+            return
+        if not all(observer.is_ready() for observer in self.observers.values()):
+            logger.info("Waiting for observers to be ready before consuming")
+            return
+        self._consuming = True
+        self._loop.create_task(self._consume())
+
+    def consumed_queues(self) -> list:
+        """(queue, callback) of the queues consumed together, paused and resumed together."""
+        return [(self._queue, self.on_message)]
+
+    async def _consume(self):
+        for queue, callback in self.consumed_queues():
+            logger.info("Start consuming %s", queue.name)
+            self._consumer_tags.append((queue, await queue.consume(callback)))
+        if self._paused or self._closing:
+            # Paused while the consumer was being set up
+            await self._cancel()
+
+    async def _cancel(self):
+        while self._consumer_tags:
+            queue, consumer_tag = self._consumer_tags.pop()
+            await queue.cancel(consumer_tag)
+
+    def check_backpressure(self):
+        """Pause consuming while observers or the publisher fall behind, resume at half."""
+        pending = max(len(self._messages), len(self._outbound) + self._outbound.in_flight())
+        if not self._paused and self._consuming and pending >= self._max_pending:
+            logger.info("Pausing consumer with %d pending", pending)
+            self._paused, self._consuming = True, False
+            self._loop.create_task(self._cancel())
+        elif self._paused and pending <= self._max_pending // 2:
+            logger.info("Resuming consumer with %d pending", pending)
+            self._paused = False
+            self.start_consuming_when_ready()
+
+    async def on_message(self, message):
+        if self._closing:
+            # Delivered while the consumer was being cancelled, it goes back to the queue
+            await self._settle(message, False, requeue=True)
+            return
+        try:
+            data = decode(message.body)
+        except Exception:
+            ERRORS.labels("decode_body").inc()
+            logger.error("Not a valid json format: %s", message.body)
+            await self._settle(message, False)
+            return
+
+        logger.debug("Received message # %s from %s", message.delivery_tag, message.app_id)
+        delivery_tag = self._track(message)
+        self.check_backpressure()
+        self._loop.run_in_executor(self._workers, self.dispatch, data, delivery_tag)
+
+    def _track(self, message) -> int:
+        """Holds message until it is settled, returns the delivery tag observers settle it by."""
+        delivery_tag = next(self._delivery_tags)
+        self._messages[delivery_tag] = message
+        return delivery_tag
+
+    def dispatch(self, message, delivery_tag):
+        try:
+            for observer in self.observers.values():
+                observer.update(message, delivery_tag)
+            if not any(observer.manual_ack for observer in self.observers.values()):
+                self.acknowledge_message(delivery_tag)
+        except Exception as e:
+            self.reject_message(delivery_tag, e)
+
+    def acknowledge_message(self, delivery_tag):
+        self.threadsafe(self._finish_message, delivery_tag, True)
+
+    def reject_message(self, delivery_tag, exception: Exception, requeue=False):
+        logger.info("Rejecting message %s by: %s", delivery_tag, exception)
+        self.threadsafe(self._finish_message, delivery_tag, False, requeue)
+
+    def _finish_message(self, delivery_tag, ack: bool, requeue=False):
+        message = self._messages.pop(delivery_tag, None)
+        if message is None:
+            logger.warning("Unknown delivery tag %s, can not settle it", delivery_tag)
+            return
+        self._loop.create_task(self._settle(message, ack, requeue))
+        self.check_backpressure()
+
+    async def _settle(self, message, ack: bool, requeue=False):
+        try:
+            if ack:
+                await message.ack()
+            else:
+                REJECTS.inc()
+                await message.nack(requeue=requeue)
+        except Exception as e:
+            # The channel was lost, the broker redelivers the message
+            logger.warning("Can not settle message %s: %s", message.delivery_tag, e)
+
+    def publish(self, routing_key, body):
+        self._outbound.put(routing_key, body)
+        self.threadsafe(self._on_publish)
+
+    def _on_publish(self):
+        if self._outbound_ready is not None:
+            self._outbound_ready.set()
+            self.check_backpressure()
+
+    async def publish_loop(self):
+        """Publish replies in batches, every batch waits for its confirms at once.
+
+        A batch is whatever was buffered during the previous confirm round trip.
+        """
+        while True:
+            batch = self._outbound.take(self._publish_batch_size)
+            if not batch:
+                self._outbound_ready.clear()
+                await self._outbound_ready.wait()
+                continue
+
+            results = await asyncio.gather(
+                *(self._publish(message.routing_key, message.body) for message in batch),
+                return_exceptions=True,
+            )
+            confirmed, failed = [], []
+            for message, result in zip(batch, results, strict=True):
+                (failed if isinstance(result, Exception) else confirmed).append(message)
+            self._outbound.confirm(confirmed)
+            if failed:
+                logger.error(
+                    "Failed to publish %d replies, retrying in %.1fs: %s",
+                    len(failed),
+                    self.retry_delay,
+                    next(result for result in results if isinstance(result, Exception)),
+                )
+                self._outbound.retry(failed)
+                await asyncio.sleep(self.retry_delay)
+            self.check_backpressure()
+
+    async def report_loop(self):
+        while True:
+            await asyncio.sleep(self._publish_report_interval)
+            logger.info("Outbound publisher: %s", self._outbound.report())
+
+    async def _publish(self, routing_key, body):
+        logger.debug("Publishing message to user: %s, message: %s", routing_key, body)
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        message = self._client.Message(
+            body=body, content_type="application/json", content_encoding="utf-8"
+        )
+        await self._exchange.publish(message, routing_key=routing_key)
+
+    async def drain(self):
+        """Let in-flight deliveries finish and their replies get confirmed."""
+        logger.info("Draining before shutdown")
+        self._closing = True
+        self._consuming = False
+        await self._cancel()
+
+        deadline = self._loop.time() + self._drain_timeout
+        while self._messages or len(self._outbound) or self._outbound.in_flight():
+            if self._loop.time() >= deadline:
+                logger.warning(
+                    "Drain timed out with %d deliveries and %d replies pending",
+                    len(self._messages),
+                    len(self._outbound) + self._outbound.in_flight(),
+                )
+                return
+            await asyncio.sleep(0.05)
+        logger.info("Drained")
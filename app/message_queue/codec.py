@@ -0,0 +1,45 @@
+import json
+import logging
+from dataclasses import asdict
+from functools import lru_cache
+
+from pydantic import TypeAdapter
+
+from app.message_queue.data import PromptData, MessageToMq
+from app.metrics.registry import STAGE_SECONDS
+
+logger = logging.getLogger(__name__)
+
+DECODE_SECONDS = STAGE_SECONDS.labels("decode_body")
+VALIDATION_SECONDS = STAGE_SECONDS.labels("validation")
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - orjson is in the base requirements
+    orjson = None
+
+
+@lru_cache
+def prompt_data_adapter() -> TypeAdapter:
+    # Building the validator is the expensive part, so it is done once per process
+    return TypeAdapter(PromptData)
+
+
+def decode(body: bytes):
+    """Parse a delivery body straight from bytes."""
+    with DECODE_SECONDS.time():
+        if orjson is not None:
+            return orjson.loads(body)
+        return json.loads(body)
+
+
+def decode_prompt_data(data: dict) -> PromptData:
+    with VALIDATION_SECONDS.time():
+        return prompt_data_adapter().validate_python(data)
+
+
+def encode_reply(message: MessageToMq) -> bytes:
+    if orjson is not None:
+        # orjson serializes dataclasses natively, without an intermediate dict
+        return orjson.dumps(message)
+    return json.dumps(asdict(message), ensure_ascii=False).encode("utf-8")
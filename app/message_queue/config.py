@@ -1,8 +1,26 @@
+from enum import Enum
+from functools import lru_cache
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
 from app.utils import get_profile
 
 
+class WorkerType(str, Enum):
+    THREAD = "thread"
+    PROCESS = "process"
+
+
+class Transport(str, Enum):
+    PIKA = "pika"
+    ASYNCIO = "asyncio"
+
+
+class ShardKey(str, Enum):
+    HISTORY = "history"
+    USER = "user"
+    CHARACTER = "character"
+
+
 class Config(BaseSettings):
     model_config = SettingsConfigDict(
         env_file=f"env/.env.{get_profile().value}", env_file_encoding="utf-8", extra="allow"
@@ -12,9 +30,56 @@ class Config(BaseSettings):
     task_default_queue: str
     task_default_exchange: str
     task_default_routing_key: str
+    # 0 runs observers inline on the ioloop thread
+    worker_count: int = 0
+    worker_type: WorkerType = WorkerType.THREAD
+    # asyncio runs AsyncAmqp with separate consume and publish channels
+    transport: Transport = Transport.PIKA
+    # Replies are published in batches of publish_batch_size or after publish_flush_interval
+    publish_batch_size: int = 64
+    publish_flush_interval: float = 0.01
+    publish_buffer_size: int = 10000
+    publish_max_unconfirmed: int = 1024
+    # Replies that do not fit in the buffer are appended here instead of being dropped
+    publish_spill_path: str | None = None
+    publish_report_interval: float = 60.0
+    # Consuming pauses at this many unsettled deliveries or unconfirmed replies, 0 for 2 * prefetch
+    max_pending: int = 0
+    drain_timeout: float = 30.0
+    # Conversation-affinity routing (see sharding.py) is enabled by a node id that is stable
+    # across restarts, e.g. the pod name of a StatefulSet
+    shard_node_id: str | None = None
+    shard_key: ShardKey = ShardKey.HISTORY
+    # Points per node on the consistent hash ring
+    shard_replicas: int = 64
+    shard_heartbeat_interval: float = 2.0
+    # A node not heard from for this long is taken out of the ring
+    shard_node_ttl: float = 10.0
+    # Requests for a node with this many queued or unsettled deliveries go to the overflow
+    # queue, 0 never overflows
+    shard_max_backlog: int = 100
 
     def to_dict(self):
         return self.model_dump()
 
 
-config = Config()
+@lru_cache
+def get_config() -> Config:
+    return Config()
+
+
+class ConversationConfig(BaseSettings):
+    model_config = SettingsConfigDict(
+        env_file=f"env/.env.{get_profile().value}", env_file_encoding="utf-8", extra="allow"
+    )
+
+    # Histories kept to rebuild those sent as deltas, 0 only accepts full histories
+    conversation_store_size: int = 0
+    conversation_max_messages: int = 200
+    # sqlite file that keeps the histories across restarts
+    conversation_store_path: str | None = None
+
+
+@lru_cache
+def get_conversation_config() -> ConversationConfig:
+    return ConversationConfig()
@@ -0,0 +1,194 @@
+"""Conversation histories kept on the server, so producers can send only the new messages.
+
+A full history with History.version set is stored as that version. A delta is a History whose
+baseVersion names the stored version its messages follow; the stored messages are put in
+front of them and the result is stored as History.version (baseVersion + number of new
+messages when unset). A delta whose baseVersion is not the stored version, e.g. after a
+restart or an eviction, raises HistoryRequired and the producer resends the full history.
+"""
+import json
+import logging
+import sqlite3
+import threading
+from collections import OrderedDict
+from dataclasses import asdict, dataclass, replace
+from datetime import datetime
+
+from app.message_queue.data import Message, PromptData
+from app.metrics.registry import REGISTRY, Counter
+
+logger = logging.getLogger(__name__)
+
+CONVERSATION_LOOKUPS = REGISTRY.register(
+    Counter("toonchat_conversation_deltas_total", "History deltas by outcome", ("result",))
+)
+
+
+class HistoryRequired(Exception):
+    """The delta does not follow the stored version, only a full history can be answered."""
+
+    def __init__(self, conversation_id: str, base_version: int, stored_version: int | None):
+        super().__init__(
+            f"Conversation {conversation_id} is at version {stored_version}, "
+            f"got a delta from version {base_version}"
+        )
+        self.conversation_id = conversation_id
+        self.base_version = base_version
+        self.stored_version = stored_version
+
+
+@dataclass
+class Conversation:
+    version: int
+    messages: list[Message]
+
+
+class ConversationStore:
+    """Up to max_conversations histories in an LRU, optionally persisted to an sqlite file.
+
+    Only the last max_messages of a conversation are kept, older ones would not fit in the
+    prompt anyway. On disk, messages are appended rather than the history rewritten.
+    """
+
+    def __init__(self, max_conversations: int, max_messages: int = 200, path: str = None):
+        self.max_conversations = max_conversations
+        self.max_messages = max_messages
+        self._conversations: OrderedDict[str, Conversation] = OrderedDict()
+        self._lock = threading.Lock()
+        self._disk: sqlite3.Connection = None
+        if path:
+            self._disk = sqlite3.connect(path, check_same_thread=False)
+            self._disk.execute(
+                "CREATE TABLE IF NOT EXISTS conversations (id TEXT PRIMARY KEY, version INTEGER)"
+            )
+            self._disk.execute(
+                "CREATE TABLE IF NOT EXISTS messages (conversation_id TEXT, position INTEGER, "
+                "message TEXT, PRIMARY KEY (conversation_id, position))"
+            )
+            self._disk.commit()
+
+    def resolve(self, data: PromptData) -> PromptData:
+        """data with its full history, stored when it carries a version."""
+        history = data.history
+        if history.baseVersion is None:
+            if history.version is not None:
+                with self._lock:
+                    self._put(history._id, Conversation(history.version, history.messages), 0)
+                CONVERSATION_LOOKUPS.labels("full").inc()
+            return data
+
+        with self._lock:
+            stored = self._get(history._id)
+            if stored is not None and self._already_applied(
+                stored, history.version, history.messages
+            ):
+                # Redelivered after it was applied, the stored history already ends with it
+                CONVERSATION_LOOKUPS.labels("redelivered").inc()
+                conversation = stored
+            elif stored is None or stored.version != history.baseVersion:
+                CONVERSATION_LOOKUPS.labels("mismatch").inc()
+                raise HistoryRequired(
+                    history._id, history.baseVersion, stored.version if stored else None
+                )
+            else:
+                CONVERSATION_LOOKUPS.labels("applied").inc()
+                version = (
+                    history.version
+                    if history.version is not None
+                    else history.baseVersion + len(history.messages)
+                )
+                conversation = Conversation(version, stored.messages + list(history.messages))
+                # Trims conversation to max_messages
+                self._put(history._id, conversation, len(stored.messages))
+        # Not read from the cache again, another thread may have evicted it meanwhile
+        return replace(
+            data,
+            history=replace(history, messages=conversation.messages, version=conversation.version),
+        )
+
+    def _already_applied(self, stored: Conversation, version: int, messages: list[Message]):
+        if version is None or stored.version != version or len(messages) > len(stored.messages):
+            return False
+        tail = stored.messages[len(stored.messages) - len(messages) :]
+        return [m.messageId for m in tail] == [m.messageId for m in messages]
+
+    def _get(self, conversation_id: str) -> Conversation | None:
+        conversation = self._conversations.get(conversation_id)
+        if conversation is not None:
+            self._conversations.move_to_end(conversation_id)
+        elif self._disk is not None:
+            conversation = self._get_from_disk(conversation_id)
+            if conversation is not None:
+                self._remember(conversation_id, conversation)
+        return conversation
+
+    def _put(self, conversation_id: str, conversation: Conversation, appended_from: int):
+        """appended_from is the number of leading messages that are already stored."""
+        dropped = max(0, len(conversation.messages) - self.max_messages)
+        if dropped:
+            conversation.messages = conversation.messages[dropped:]
+        self._remember(conversation_id, conversation)
+        if self._disk is not None:
+            self._put_to_disk(conversation_id, conversation, appended_from - dropped)
+
+    def _remember(self, conversation_id: str, conversation: Conversation):
+        self._conversations[conversation_id] = conversation
+        self._conversations.move_to_end(conversation_id)
+        while len(self._conversations) > self.max_conversations:
+            self._conversations.popitem(last=False)
+
+    def _get_from_disk(self, conversation_id: str) -> Conversation | None:
+        row = self._disk.execute(
+            "SELECT version FROM conversations WHERE id = ?", (conversation_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        rows = self._disk.execute(
+            "SELECT message FROM messages WHERE conversation_id = ? ORDER BY position DESC "
+            "LIMIT ?",
+            (conversation_id, self.max_messages),
+        ).fetchall()
+        return Conversation(row[0], [_load_message(message) for (message,) in reversed(rows)])
+
+    def _put_to_disk(self, conversation_id: str, conversation: Conversation, kept: int):
+        """Appends the messages after the kept ones already on disk, or rewrites the history
+        when it was not an append."""
+        if kept <= 0:
+            self._disk.execute("DELETE FROM messages WHERE conversation_id = ?", (conversation_id,))
+            start, new_messages = 0, conversation.messages
+        else:
+            row = self._disk.execute(
+                "SELECT MAX(position) FROM messages WHERE conversation_id = ?", (conversation_id,)
+            ).fetchone()
+            start = (row[0] + 1) if row[0] is not None else 0
+            new_messages = conversation.messages[kept:]
+        self._disk.executemany(
+            "INSERT OR REPLACE INTO messages VALUES (?, ?, ?)",
+            [
+                (conversation_id, start + i, _dump_message(message))
+                for i, message in enumerate(new_messages)
+            ],
+        )
+        if kept > 0:
+            self._disk.execute(
+                "DELETE FROM messages WHERE conversation_id = ? AND position < ?",
+                (conversation_id, start + len(new_messages) - self.max_messages),
+            )
+        self._disk.execute(
+            "INSERT OR REPLACE INTO conversations VALUES (?, ?)",
+            (conversation_id, conversation.version),
+        )
+        self._disk.commit()
+
+    def __len__(self) -> int:
+        return len(self._conversations)
+
+
+def _dump_message(message: Message) -> str:
+    return json.dumps(asdict(message), ensure_ascii=False, default=datetime.isoformat)
+
+
+def _load_message(text: str) -> Message:
+    message = json.loads(text)
+    message["createdAt"] = datetime.fromisoformat(message["createdAt"])
+    return Message(**message)
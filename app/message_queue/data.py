@@ -1,9 +1,9 @@
-from dataclasses import dataclass, asdict
+from dataclasses import dataclass, asdict, replace
 from datetime import datetime, timezone
 from typing import Optional
 
 
-@dataclass
+@dataclass(slots=True)
 class Message:
     messageId: str
     replyMessageId: Optional[str]
@@ -15,15 +15,21 @@ class Message:
         return self.fromUser
 
 
+# Not slotted, pydantic 2.0 can not set the defaults of a slotted dataclass
 @dataclass
 class History:
     _id: str
     userId: str
     characterId: int
+    # All messages, or with baseVersion only those added since that version
     messages: list[Message]
+    # Version of the conversation including messages, lets the next request send a delta
+    version: Optional[int] = None
+    # Set on a delta: the version of the history the server stored that messages follow
+    baseVersion: Optional[int] = None
 
 
-@dataclass
+@dataclass(slots=True)
 class GenerationArgs:
     temperature: float
     repetition_penalty: float
@@ -35,6 +41,12 @@ class PromptData:
     reference: list[str]
     history: History
     generationArgs: GenerationArgs
+    # LoRA adapter to answer with, defaults to the adapter of the character
+    adapterName: Optional[str] = None
+    # Scheduling lane, one of the configured priority_lanes (e.g. a Profile value or "paid")
+    priority: Optional[str] = None
+    # Served model to answer with, one of the configured serve_models
+    model: Optional[str] = None
 
     def get_user_id(self) -> str:
         return self.history.userId
@@ -51,13 +63,19 @@ class PromptData:
         else:
             return self.reference
 
+    def get_reference_list(self) -> list[str]:
+        return self.reference if isinstance(self.reference, list) else [self.reference]
+
     def get_chat_history_list(self) -> list[Message]:
         return self.history.messages
 
     def get_generation_args(self):
         return asdict(self.generationArgs)
 
-    def build_return_message(self, message_id: str, content: str):
+    def build_history_request(self, message_id: str):
+        return replace(self.build_return_message(message_id, ""), historyRequired=True)
+
+    def build_return_message(self, message_id: str, content: str, sequence=0, done=True):
         return MessageToMq(
             messageId=message_id,
             userId=self.history.userId,
@@ -65,10 +83,12 @@ class PromptData:
             createdAt=datetime.now(timezone.utc).isoformat(),
             content=content,
             fromUser=False,
+            sequence=sequence,
+            done=done,
         )
 
 
-@dataclass
+@dataclass(slots=True)
 class MessageToMq:
     messageId: str
     userId: str
@@ -76,6 +96,12 @@ class MessageToMq:
     createdAt: datetime
     content: str
     fromUser: bool = False
+    # Streamed answers are split into frames; the last one is done and carries the whole answer,
+    # or is empty when the answer was cut short
+    sequence: int = 0
+    done: bool = True
+    # The request was a history delta the server could not apply, resend the full history
+    historyRequired: bool = False
 
     def to_dict(self):
         return asdict(self)
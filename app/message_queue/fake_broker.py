@@ -0,0 +1,266 @@
+"""In-process stand-in for the parts of aio_pika that AsyncAmqp uses.
+
+A FakeBroker instance is passed where the aio_pika module would be used, so the transport
+can be exercised and benchmarked without RabbitMQ:
+
+    broker = FakeBroker(confirm_delay=0.001)
+    amqp = AsyncAmqp(config, client=broker)
+
+Everything runs on the event loop of the caller, there is no thread safety.
+"""
+import re
+import time
+import asyncio
+import itertools
+import logging
+from enum import Enum
+from collections import deque
+from dataclasses import dataclass, field
+
+logger = logging.getLogger(__name__)
+
+
+class ExchangeType(str, Enum):
+    DIRECT = "direct"
+    TOPIC = "topic"
+
+
+@dataclass
+class Message:
+    body: bytes
+    content_type: str = None
+    content_encoding: str = None
+    app_id: str = None
+
+
+@dataclass
+class DeclareOk:
+    message_count: int
+    consumer_count: int
+
+
+@dataclass
+class PublishedMessage:
+    exchange: str
+    routing_key: str
+    message: Message
+    published_at: float = field(default_factory=time.monotonic)
+
+
+def topic_matches(pattern: str, routing_key: str) -> bool:
+    words = [
+        "[^.]+" if word == "*" else ".*" if word == "#" else re.escape(word)
+        for word in pattern.split(".")
+    ]
+    return re.fullmatch(r"\.".join(words), routing_key) is not None
+
+
+class FakeIncomingMessage:
+    def __init__(self, channel: "FakeChannel", queue: "_QueueState", delivery_tag, message):
+        self.channel = channel
+        self.queue = queue
+        self.delivery_tag = delivery_tag
+        self.message = message
+        self.body = message.body
+        self.app_id = message.app_id
+        self.content_type = message.content_type
+
+    async def ack(self):
+        self.channel.settle(self, requeue=None)
+
+    async def nack(self, requeue: bool = True):
+        self.channel.settle(self, requeue=requeue)
+
+    async def reject(self, requeue: bool = False):
+        self.channel.settle(self, requeue=requeue)
+
+
+class _QueueState:
+    def __init__(self, broker: "FakeBroker", name: str) -> None:
+        self.broker = broker
+        self.name = name
+        self.messages: deque[Message] = deque()
+        # (consumer tag, channel, callback, no_ack), deliveries go round-robin
+        self.consumers: deque = deque()
+
+    def put(self, message: Message):
+        self.messages.append(message)
+        self.deliver()
+
+    def deliver(self):
+        while self.messages and self.consumers:
+            for _ in range(len(self.consumers)):
+                tag, channel, callback, no_ack = self.consumers[0]
+                self.consumers.rotate(-1)
+                if channel.can_deliver(no_ack):
+                    channel.deliver(self, self.messages.popleft(), callback, no_ack)
+                    break
+            else:
+                # Every consumer is at its prefetch limit
+                return
+
+
+class FakeExchange:
+    def __init__(self, channel: "FakeChannel", name: str) -> None:
+        self.channel = channel
+        self.name = name
+
+    async def publish(self, message: Message, routing_key: str):
+        if self.channel.is_closed:
+            raise RuntimeError("Channel is closed")
+        self.channel.broker.publish(self.name, routing_key, message)
+        if self.channel.publisher_confirms and self.channel.broker.confirm_delay:
+            await asyncio.sleep(self.channel.broker.confirm_delay)
+        return True
+
+
+class FakeQueue:
+    def __init__(self, channel: "FakeChannel", state: _QueueState) -> None:
+        self.channel = channel
+        self.state = state
+        self.name = state.name
+
+    async def declare(self) -> DeclareOk:
+        return DeclareOk(len(self.state.messages), len(self.state.consumers))
+
+    async def bind(self, exchange, routing_key: str = None):
+        name = exchange if isinstance(exchange, str) else exchange.name
+        binding = (routing_key or self.name, self.state)
+        # Binding again is a no-op, like on RabbitMQ
+        if binding not in self.channel.broker.bindings[name]:
+            self.channel.broker.bindings[name].append(binding)
+
+    async def consume(self, callback, no_ack: bool = False) -> str:
+        tag = f"ctag.{next(self.channel.broker.ids)}"
+        self.state.consumers.append((tag, self.channel, callback, no_ack))
+        self.state.deliver()
+        return tag
+
+    async def cancel(self, consumer_tag: str):
+        self.state.consumers = deque(
+            consumer for consumer in self.state.consumers if consumer[0] != consumer_tag
+        )
+
+
+class FakeChannel:
+    def __init__(self, connection: "FakeConnection", publisher_confirms: bool) -> None:
+        self.connection = connection
+        self.broker = connection.broker
+        self.publisher_confirms = publisher_confirms
+        self.prefetch_count = 0
+        self.is_closed = False
+        self._delivery_tags = itertools.count(1)
+        self._unacked: dict[int, FakeIncomingMessage] = {}
+
+    async def set_qos(self, prefetch_count: int = 0):
+        self.prefetch_count = prefetch_count
+
+    async def declare_exchange(self, name: str, type=ExchangeType.DIRECT, durable=False):
+        self.broker.exchanges.setdefault(name, ExchangeType(type))
+        self.broker.bindings.setdefault(name, [])
+        return FakeExchange(self, name)
+
+    async def get_exchange(self, name: str, ensure: bool = True):
+        if name not in self.broker.exchanges:
+            raise KeyError(f"Exchange {name} does not exist")
+        return FakeExchange(self, name)
+
+    async def declare_queue(self, name: str, durable=False, auto_delete=False):
+        if name not in self.broker.queues:
+            self.broker.queues[name] = _QueueState(self.broker, name)
+        return FakeQueue(self, self.broker.queues[name])
+
+    def can_deliver(self, no_ack: bool = False) -> bool:
+        return not self.is_closed and (
+            no_ack or not self.prefetch_count or len(self._unacked) < self.prefetch_count
+        )
+
+    def deliver(self, queue: _QueueState, message: Message, callback, no_ack: bool = False):
+        incoming = FakeIncomingMessage(self, queue, next(self._delivery_tags), message)
+        # Settled on delivery, settling it again fails like an unknown delivery tag
+        if not no_ack:
+            self._unacked[incoming.delivery_tag] = incoming
+        asyncio.get_running_loop().create_task(callback(incoming))
+
+    def settle(self, incoming: FakeIncomingMessage, requeue: bool | None):
+        if self.is_closed or self._unacked.pop(incoming.delivery_tag, None) is None:
+            raise RuntimeError(f"Unknown delivery tag {incoming.delivery_tag}")
+        if requeue:
+            incoming.queue.messages.appendleft(incoming.message)
+        elif requeue is not None:
+            self.broker.dead_lettered.append(incoming.message)
+        # Room under the prefetch of this channel, for every queue it consumes
+        for queue in self.broker.queues.values():
+            queue.deliver()
+
+    async def close(self):
+        if self.is_closed:
+            return
+        self.is_closed = True
+        for queue in self.broker.queues.values():
+            queue.consumers = deque(c for c in queue.consumers if c[1] is not self)
+        # Unacknowledged deliveries go back to their queue like on a real broker
+        for incoming in self._unacked.values():
+            incoming.queue.messages.appendleft(incoming.message)
+        self._unacked.clear()
+        for queue in self.broker.queues.values():
+            queue.deliver()
+
+
+class FakeConnection:
+    def __init__(self, broker: "FakeBroker") -> None:
+        self.broker = broker
+        self.channels: list[FakeChannel] = []
+        self.is_closed = False
+
+    async def channel(self, publisher_confirms: bool = True) -> FakeChannel:
+        channel = FakeChannel(self, publisher_confirms)
+        self.channels.append(channel)
+        return channel
+
+    async def close(self):
+        for channel in self.channels:
+            await channel.close()
+        self.is_closed = True
+
+
+class FakeBroker:
+    ExchangeType = ExchangeType
+    Message = Message
+
+    def __init__(self, confirm_delay: float = 0.0, keep_published: bool = True) -> None:
+        # Simulated round trip of a publisher confirm
+        self.confirm_delay = confirm_delay
+        self.keep_published = keep_published
+        self.exchanges: dict[str, ExchangeType] = {"amq.topic": ExchangeType.TOPIC}
+        self.bindings: dict[str, list] = {"amq.topic": []}
+        self.queues: dict[str, _QueueState] = {}
+        self.published: list[PublishedMessage] = []
+        self.published_count = 0
+        self.dead_lettered: list[Message] = []
+        self.ids = itertools.count(1)
+
+    async def connect_robust(self, url: str = None, **kwargs) -> FakeConnection:
+        return FakeConnection(self)
+
+    def publish(self, exchange: str, routing_key: str, message: Message | bytes):
+        if isinstance(message, bytes):
+            message = Message(message, content_type="application/json")
+        if exchange not in self.exchanges:
+            raise KeyError(f"Exchange {exchange} does not exist")
+
+        self.published_count += 1
+        if self.keep_published:
+            self.published.append(PublishedMessage(exchange, routing_key, message))
+
+        exchange_type = self.exchanges[exchange]
+        for binding_key, queue in self.bindings.get(exchange, []):
+            if (
+                binding_key == routing_key
+                if exchange_type == ExchangeType.DIRECT
+                else topic_matches(binding_key, routing_key)
+            ):
+                queue.put(message)
+
+    def queue_depth(self, name: str) -> int:
+        return len(self.queues[name].messages) if name in self.queues else 0
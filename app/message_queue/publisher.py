@@ -0,0 +1,180 @@
+import os
+import json
+import time
+import logging
+import threading
+from collections import deque
+from dataclasses import dataclass, field
+
+from app.metrics.registry import PUBLISH_CONFIRM_SECONDS, PUBLISH_DROPPED, register_gauge
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class OutboundMessage:
+    routing_key: str
+    body: bytes | str
+    enqueued_at: float = field(default_factory=time.monotonic)
+    sent_at: float = None
+    attempts: int = 0
+
+
+def _spill_line(message: OutboundMessage) -> str:
+    body = message.body.decode("utf-8") if isinstance(message.body, bytes) else message.body
+    return json.dumps([message.routing_key, body], ensure_ascii=False) + "\n"
+
+
+class OutboundBuffer:
+    """Bounded buffer of replies waiting for a publisher confirm.
+
+    Replies leave the buffer only once the broker confirmed them, a nack or a lost channel
+    puts them back in front. When the buffer is full, new replies are appended to spill_path
+    and read back as room frees up, so a broker blip does not lose answers; without a spill
+    file they are dropped. A spill file left by a previous run is published on start.
+    """
+
+    def __init__(self, capacity: int, spill_path: str = None, latency_window: int = 1024) -> None:
+        self.capacity = capacity
+        self.spill_path = spill_path
+        self._messages: deque[OutboundMessage] = deque()
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._spilled = 0
+        self._spill_offset = 0
+        self._confirm_latencies: deque[float] = deque(maxlen=latency_window)
+        self.published = 0
+        self.retried = 0
+        self.spilled_total = 0
+        self.dropped = 0
+
+        if spill_path and os.path.exists(spill_path):
+            with open(spill_path, "rb") as f:
+                self._spilled = sum(1 for _ in f)
+            if self._spilled:
+                logger.warning("Recovering %d spilled replies from %s", self._spilled, spill_path)
+
+        register_gauge("toonchat_outbound_depth", "Replies waiting to be published", self.__len__)
+        register_gauge("toonchat_outbound_in_flight", "Replies awaiting a confirm", self.in_flight)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._messages) + self._spilled
+
+    def in_flight(self) -> int:
+        with self._lock:
+            return self._in_flight
+
+    def put(self, routing_key: str, body: str) -> bool:
+        message = OutboundMessage(routing_key, body)
+        with self._lock:
+            # Once something is spilled, later replies queue behind it to keep their order
+            if len(self._messages) < self.capacity and not self._spilled:
+                self._messages.append(message)
+                return True
+            return self._spill(message)
+
+    def take(self, limit: int) -> list[OutboundMessage]:
+        with self._lock:
+            if self._spilled and len(self._messages) <= self.capacity // 2:
+                self._refill()
+            now = time.monotonic()
+            batch = []
+            while self._messages and len(batch) < limit:
+                message = self._messages.popleft()
+                message.sent_at = now
+                message.attempts += 1
+                batch.append(message)
+            self._in_flight += len(batch)
+            return batch
+
+    def confirm(self, messages: list[OutboundMessage]):
+        now = time.monotonic()
+        latencies = [now - message.sent_at for message in messages]
+        with self._lock:
+            self._in_flight -= len(messages)
+            self.published += len(messages)
+            self._confirm_latencies.extend(latencies)
+        for latency in latencies:
+            PUBLISH_CONFIRM_SECONDS.observe(latency)
+
+    def retry(self, messages: list[OutboundMessage]):
+        """Put unconfirmed messages back in front, in their original order."""
+        with self._lock:
+            self._in_flight -= len(messages)
+            self.retried += len(messages)
+            self._messages.extendleft(reversed(messages))
+
+    def _spill(self, message: OutboundMessage) -> bool:
+        if not self.spill_path:
+            self.dropped += 1
+            PUBLISH_DROPPED.inc()
+            logger.error("Outbound buffer is full, dropping reply to %s", message.routing_key)
+            return False
+        try:
+            with open(self.spill_path, "a", encoding="utf-8") as f:
+                f.write(_spill_line(message))
+        except OSError as e:
+            self.dropped += 1
+            PUBLISH_DROPPED.inc()
+            logger.error("Failed to spill reply to %s: %s", message.routing_key, e)
+            return False
+        self._spilled += 1
+        self.spilled_total += 1
+        return True
+
+    def _refill(self):
+        room = self.capacity - len(self._messages)
+        with open(self.spill_path, "rb") as f:
+            f.seek(self._spill_offset)
+            while room > 0 and self._spilled:
+                line = f.readline()
+                if not line:
+                    break
+                routing_key, body = json.loads(line)
+                self._messages.append(OutboundMessage(routing_key, body))
+                self._spilled -= 1
+                room -= 1
+            self._spill_offset = f.tell()
+
+        if not self._spilled:
+            # Everything is back in memory, start the file over
+            open(self.spill_path, "w").close()
+            self._spill_offset = 0
+
+    def spill_all(self):
+        """Move every buffered message to the spill file, e.g. before exiting."""
+        if not self.spill_path:
+            return
+        with self._lock:
+            if not self._messages:
+                return
+            # In-memory replies are older than the ones still waiting in the file
+            pending = b""
+            if os.path.exists(self.spill_path):
+                with open(self.spill_path, "rb") as f:
+                    f.seek(self._spill_offset)
+                    pending = f.read()
+            with open(self.spill_path, "wb") as f:
+                for message in self._messages:
+                    f.write(_spill_line(message).encode("utf-8"))
+                f.write(pending)
+            self._spill_offset = 0
+            self._spilled += len(self._messages)
+            logger.info("Spilled %d buffered replies to %s", len(self._messages), self.spill_path)
+            self._messages.clear()
+
+    def report(self) -> dict:
+        with self._lock:
+            latencies = sorted(self._confirm_latencies)
+            return {
+                "depth": len(self._messages),
+                "spilled": self._spilled,
+                "in_flight": self._in_flight,
+                "published": self.published,
+                "retried": self.retried,
+                "spilled_total": self.spilled_total,
+                "dropped": self.dropped,
+                "confirm_p50": latencies[len(latencies) // 2] if latencies else None,
+                "confirm_p99": latencies[int(len(latencies) * 0.99)] if latencies else None,
+            }
@@ -0,0 +1,377 @@
+"""Conversation-affinity routing, so consecutive turns of a conversation reach the same node.
+
+With shard_node_id set, every node consumes three queues of the task exchange: the shared task
+queue the producers publish to, its own node queue and a shared overflow queue. Requests from
+the shared queue are forwarded to the queue of the node that consistent hashing of their shard
+key (History._id, userId or characterId) picks, so per-node caches like ConversationStore keep
+hitting. Producers that know the ring can publish to the node routing keys themselves.
+
+Nodes announce themselves and their backlog with heartbeats on amq.topic. A node joining, or
+leaving through a heartbeat or its ttl, only moves the conversations it owns. Requests for a
+node whose backlog reached shard_max_backlog go to the overflow queue, where any node answers
+them. A stopping node takes itself out of its ring and leaves the shared and overflow queues
+to the others, answers what was forwarded to it and forwards what is still left to the nodes
+owning it now before draining. Once a node that died
+expires, the other nodes consume its durable queue and forward what was left there by the
+ring without it, until it comes back with the same node id.
+"""
+import json
+import time
+import bisect
+import asyncio
+import hashlib
+import logging
+from dataclasses import dataclass
+
+from app.message_queue.async_amqp import AsyncAmqp
+from app.message_queue.codec import decode
+from app.message_queue.config import Config, ShardKey
+from app.metrics.registry import ERRORS, REGISTRY, Counter, register_gauge
+
+logger = logging.getLogger(__name__)
+
+SHARD_ROUTES = REGISTRY.register(
+    Counter("toonchat_shard_routes_total", "Requests forwarded from the shared queue", ("target",))
+)
+SHARD_MEMBERSHIP = REGISTRY.register(
+    Counter("toonchat_shard_membership_total", "Nodes joining or leaving the ring", ("change",))
+)
+
+KEY_FIELDS = {ShardKey.HISTORY: "_id", ShardKey.USER: "userId", ShardKey.CHARACTER: "characterId"}
+
+
+def _hash(key: str) -> int:
+    return int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "big")
+
+
+def shard_key(data, key: ShardKey) -> str | None:
+    """The shard key of a task message, None when it has no history."""
+    try:
+        value = data["args"][0]["history"][KEY_FIELDS[key]]
+    except (KeyError, IndexError, TypeError):
+        return None
+    return None if value is None else str(value)
+
+
+def node_routing_key(routing_key: str, node: str) -> str:
+    return f"{routing_key}.node.{node}"
+
+
+class HashRing:
+    """Each node is placed at replicas points of a ring of 64-bit hashes and owns the keys
+    hashing up to its points, so adding or removing a node only moves the keys it owns."""
+
+    def __init__(self, nodes=(), replicas: int = 64) -> None:
+        self.replicas = replicas
+        self._points: list[int] = []
+        self._owners: list[str] = []
+        for node in nodes:
+            self.add(node)
+
+    def add(self, node: str) -> bool:
+        if node in self:
+            return False
+        for replica in range(self.replicas):
+            point = _hash(f"{node}#{replica}")
+            index = bisect.bisect(self._points, point)
+            self._points.insert(index, point)
+            self._owners.insert(index, node)
+        return True
+
+    def remove(self, node: str) -> bool:
+        if node not in self:
+            return False
+        kept = [
+            (point, owner)
+            for point, owner in zip(self._points, self._owners, strict=True)
+            if owner != node
+        ]
+        self._points = [point for point, _ in kept]
+        self._owners = [owner for _, owner in kept]
+        return True
+
+    def node_for(self, key: str) -> str | None:
+        if not self._points:
+            return None
+        return self._owners[bisect.bisect(self._points, _hash(key)) % len(self._points)]
+
+    @property
+    def nodes(self) -> list[str]:
+        return sorted(set(self._owners))
+
+    def __contains__(self, node: str) -> bool:
+        return node in self._owners
+
+    def __len__(self) -> int:
+        return len(self.nodes)
+
+
+@dataclass
+class NodeState:
+    # Queued and unsettled deliveries at the node when it last reported
+    backlog: int
+    seen_at: float
+
+
+class ShardMembership:
+    """The ring of the nodes heard from, with the backlog each one reported."""
+
+    def __init__(self, node_id: str, replicas: int, node_ttl: float, max_backlog: int) -> None:
+        self.node_id = node_id
+        self.node_ttl = node_ttl
+        self.max_backlog = max_backlog
+        self.ring = HashRing((node_id,), replicas)
+        self._nodes: dict[str, NodeState] = {node_id: NodeState(0, time.monotonic())}
+
+    def heard(self, node: str, backlog: int, leaving=False, now: float = None) -> bool:
+        """Records a heartbeat, True when it is from a node that was not in the ring."""
+        if leaving:
+            self.remove(node, "leave")
+            return False
+        self._nodes[node] = NodeState(backlog, time.monotonic() if now is None else now)
+        joined = self.ring.add(node)
+        if joined:
+            logger.info("Node %s joined, %d nodes in the ring", node, len(self.ring))
+            SHARD_MEMBERSHIP.labels("join").inc()
+        return joined
+
+    def expire(self, now: float = None) -> list[str]:
+        now = time.monotonic() if now is None else now
+        expired = [
+            node
+            for node, state in self._nodes.items()
+            if node != self.node_id and now - state.seen_at > self.node_ttl
+        ]
+        for node in expired:
+            self.remove(node, "expire")
+        return expired
+
+    def remove(self, node: str, change: str):
+        self._nodes.pop(node, None)
+        if self.ring.remove(node):
+            logger.info("Node %s left by %s, %d nodes in the ring", node, change, len(self.ring))
+            SHARD_MEMBERSHIP.labels(change).inc()
+
+    def route(self, key: str | None) -> str | None:
+        """The node owning key, None to overflow when it is saturated or there is no key."""
+        node = self.ring.node_for(key) if key is not None else None
+        if node is None:
+            return None
+        state = self._nodes.get(node)
+        if self.max_backlog and state is not None and state.backlog >= self.max_backlog:
+            return None
+        return node
+
+
+class ShardedAmqp(AsyncAmqp):
+    """AsyncAmqp that routes the shared task queue to the nodes owning the conversations."""
+
+    def __init__(self, config: Config, client=None) -> None:
+        super().__init__(config, client)
+        self.node_id = config.shard_node_id
+        self.shard_key = config.shard_key
+        self.node_queue = f"{self.consume_queue}.node.{self.node_id}"
+        self.node_routing_key = node_routing_key(self.consume_routing_key, self.node_id)
+        self.overflow_queue = f"{self.consume_queue}.overflow"
+        self.overflow_routing_key = f"{self.consume_routing_key}.overflow"
+        self.members_routing_key = f"{self.consume_routing_key}.members"
+        self.membership = ShardMembership(
+            self.node_id, config.shard_replicas, config.shard_node_ttl, config.shard_max_backlog
+        )
+        self._heartbeat_interval = config.shard_heartbeat_interval
+        self._node_queue = None
+        self._overflow_queue = None
+        self._forward_exchange = None
+        self._members_channel = None
+        self._heartbeat: asyncio.Task = None
+        # While leaving, "answer" consumes the node queue only and "forward" routes it
+        self._handoff: str = None
+        # (queue, consumer tag) of the queues of expired nodes forwarded from, by node
+        self._rescues: dict[str, tuple] = {}
+        register_gauge(
+            "toonchat_shard_nodes",
+            "Nodes in the consistent hash ring",
+            lambda: len(self.membership.ring),
+        )
+
+    async def connect(self):
+        await super().connect()
+        exchange = await self._consume_channel.declare_exchange(
+            self.consume_exchange, self._client.ExchangeType.DIRECT, durable=True
+        )
+        self._node_queue = await self._consume_channel.declare_queue(self.node_queue, durable=True)
+        await self._node_queue.bind(exchange, routing_key=self.node_routing_key)
+        self._overflow_queue = await self._consume_channel.declare_queue(
+            self.overflow_queue, durable=True
+        )
+        await self._overflow_queue.bind(exchange, routing_key=self.overflow_routing_key)
+        self._forward_exchange = await self._publish_channel.get_exchange(self.consume_exchange)
+
+        # Heartbeats are consumed on their own channel, the prefetch of deliveries never holds
+        # them back
+        self._members_channel = await self._connection.channel(publisher_confirms=False)
+        members = await self._members_channel.declare_queue(
+            f"{self.consume_queue}.members.{self.node_id}", auto_delete=True
+        )
+        await members.bind(self.publish_exchange, routing_key=self.members_routing_key)
+        # A lost heartbeat is made up for by the next one
+        await members.consume(self.on_heartbeat, no_ack=True)
+        logger.info(
+            "Node %s consumes %s and %s", self.node_id, self.node_queue, self.overflow_queue
+        )
+
+    def consumed_queues(self) -> list:
+        if self._handoff == "forward":
+            return [(self._node_queue, self.on_route)]
+        if self._handoff == "answer":
+            return [(self._node_queue, self.on_message)]
+        return [
+            (self._node_queue, self.on_message),
+            (self._overflow_queue, self.on_message),
+            (self._queue, self.on_route),
+        ]
+
+    async def _reconsume(self):
+        """Consumes consumed_queues again after they changed."""
+        self._consuming = False
+        await self._cancel()
+        self.start_consuming_when_ready()
+
+    async def _consume(self):
+        await super()._consume()
+        # Announced once the observers are ready, routers do not wait for a loading model
+        if self._heartbeat is None and not self._closing:
+            self._heartbeat = self._loop.create_task(self.heartbeat_loop())
+
+    async def on_route(self, message):
+        """Forwards a request of the shared queue to the queue of the node owning it."""
+        if self._closing:
+            await self._settle(message, False, requeue=True)
+            return
+        try:
+            data = decode(message.body)
+        except Exception:
+            ERRORS.labels("decode_body").inc()
+            logger.error("Not a valid json format: %s", message.body)
+            await self._settle(message, False)
+            return
+
+        node = self.membership.route(shard_key(data, self.shard_key))
+        if node is None:
+            routing_key = self.overflow_routing_key
+            SHARD_ROUTES.labels("overflow").inc()
+        else:
+            routing_key = node_routing_key(self.consume_routing_key, node)
+            SHARD_ROUTES.labels("local" if node == self.node_id else "remote").inc()
+        # Counted as in flight, so draining waits for the forward to be confirmed
+        delivery_tag = self._track(message)
+        try:
+            await self._forward_exchange.publish(
+                self._client.Message(
+                    body=message.body, content_type="application/json", content_encoding="utf-8"
+                ),
+                routing_key=routing_key,
+            )
+        except Exception as e:
+            logger.warning("Can not forward message %s: %s", message.delivery_tag, e)
+            self._finish_message(delivery_tag, False, requeue=True)
+            return
+        self._finish_message(delivery_tag, True)
+
+    async def on_heartbeat(self, message):
+        try:
+            data = decode(message.body)
+            node = data["node"]
+        except Exception:
+            logger.warning("Not a valid heartbeat: %s", message.body)
+            return
+        joined = self.membership.heard(node, data.get("backlog", 0), data.get("leaving", False))
+        if joined and node in self._rescues:
+            # Back with the same node id, it answers its queue itself again
+            queue, consumer_tag = self._rescues.pop(node)
+            logger.info("Node %s is back, stopped forwarding its queue", node)
+            await queue.cancel(consumer_tag)
+        if joined and node != self.node_id and self._heartbeat is not None:
+            # The new node learns about this one without waiting for an interval
+            self._loop.create_task(self.send_heartbeat())
+
+    async def heartbeat_loop(self):
+        while True:
+            await self.send_heartbeat()
+            for node in self.membership.expire():
+                await self.rescue(node)
+            await asyncio.sleep(self._heartbeat_interval)
+
+    async def rescue(self, node: str):
+        """Forwards what was left in the queue of an expired node to the nodes owning it now."""
+        if node in self._rescues or self._closing:
+            return
+        try:
+            queue = await self._consume_channel.declare_queue(
+                f"{self.consume_queue}.node.{node}", durable=True
+            )
+            self._rescues[node] = (queue, await queue.consume(self.on_route))
+        except Exception as e:
+            logger.warning("Can not forward the queue of node %s: %s", node, e)
+            return
+        logger.info("Node %s expired, forwarding its queue", node)
+
+    async def send_heartbeat(self, leaving=False):
+        try:
+            declared = await self._node_queue.declare()
+            body = {
+                "node": self.node_id,
+                "backlog": declared.message_count + len(self._messages),
+                "leaving": leaving,
+            }
+            await self._exchange.publish(
+                self._client.Message(
+                    body=json.dumps(body).encode("utf-8"), content_type="application/json"
+                ),
+                routing_key=self.members_routing_key,
+            )
+        except Exception as e:
+            logger.warning("Can not send a heartbeat: %s", e)
+
+    async def drain(self):
+        """Leaves the ring, answers what was forwarded here and forwards what is left."""
+        if self._members_channel is not None:
+            await self._members_channel.close()
+        # Left to the nodes staying
+        for queue, consumer_tag in self._rescues.values():
+            await queue.cancel(consumer_tag)
+        self._rescues.clear()
+        if self._heartbeat is not None:
+            self._heartbeat.cancel()
+            if len(self.membership.ring) > 1:
+                await self.hand_off()
+            else:
+                # The last node, its queue waits for it to come back
+                await self.send_heartbeat(leaving=True)
+        await super().drain()
+
+    async def hand_off(self):
+        # Routed by the ring of the nodes staying from now on, who also take over the shared
+        # and overflow queues
+        self.membership.remove(self.node_id, "leave")
+        self._handoff = "answer"
+        await self._reconsume()
+        await self.send_heartbeat(leaving=True)
+        # Routers that forwarded before hearing the leave have been answered
+        if not await self._wait_node_queue(lambda count: not count and not self._messages):
+            logger.warning("Node queue not answered in %.1fs, forwarding it", self._drain_timeout)
+        # Forwarded by routers that had not heard the leave yet, or not answered in time
+        self._handoff = "forward"
+        await self._reconsume()
+        if not await self._wait_node_queue(lambda count: not count):
+            logger.warning("Node queue not forwarded in %.1fs", self._drain_timeout)
+
+    async def _wait_node_queue(self, done) -> bool:
+        """Waits up to drain_timeout for done(messages in the node queue)."""
+        deadline = self._loop.time() + self._drain_timeout
+        while self._loop.time() < deadline:
+            await asyncio.sleep(0.05)
+            declared = await self._node_queue.declare()
+            if done(declared.message_count):
+                return True
+        return False
@@ -0,0 +1,22 @@
+from functools import lru_cache
+from pydantic_settings import BaseSettings, SettingsConfigDict
+
+from app.utils import get_profile
+
+
+class MetricsConfig(BaseSettings):
+    model_config = SettingsConfigDict(
+        env_file=f"env/.env.{get_profile().value}", env_file_encoding="utf-8", extra="allow"
+    )
+
+    # Serves /metrics in the Prometheus text format, 0 disables the endpoint
+    metrics_port: int = 0
+    metrics_host: str = "127.0.0.1"
+    # Rewritten every metrics_textfile_interval seconds, for the node_exporter textfile collector
+    metrics_textfile: str | None = None
+    metrics_textfile_interval: float = 15.0
+
+
+@lru_cache
+def get_metrics_config() -> MetricsConfig:
+    return MetricsConfig()
@@ -0,0 +1,66 @@
+import os
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from app.metrics.config import MetricsConfig, get_metrics_config
+from app.metrics.registry import REGISTRY, Registry
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def serve(host: str, port: int, registry: Registry = REGISTRY) -> ThreadingHTTPServer:
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = registry.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", CONTENT_TYPE)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    logger.info("Serving metrics on http://%s:%d/metrics", host, server.server_address[1])
+    return server
+
+
+def write_textfile(path: str, registry: Registry = REGISTRY):
+    # Renamed into place so the collector never reads a half-written file
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(registry.render())
+    os.replace(tmp_path, path)
+
+
+def write_textfile_periodically(
+    path: str, interval: float, registry: Registry = REGISTRY
+) -> threading.Event:
+    stopped = threading.Event()
+
+    def loop():
+        while not stopped.wait(interval):
+            try:
+                write_textfile(path, registry)
+            except OSError:
+                logger.exception("Failed to write metrics to %s", path)
+
+    threading.Thread(target=loop, name="metrics-textfile", daemon=True).start()
+    return stopped
+
+
+def start_exporter(config: MetricsConfig | None = None):
+    config = config or get_metrics_config()
+    if config.metrics_port > 0:
+        serve(config.metrics_host, config.metrics_port)
+    if config.metrics_textfile:
+        write_textfile_periodically(config.metrics_textfile, config.metrics_textfile_interval)
@@ -0,0 +1,218 @@
+"""Admission of generations by their KV cache memory, and generation limits that adapt to latency.
+
+A generation of rows sequences of prompt_tokens takes up to
+rows * (prompt_tokens + max_new_tokens) * kv_bytes_per_token of KV cache, which is reserved
+from memory_budget before it starts. A generation that does not fit waits for running ones
+to release their memory, first come first served. One that would never fit gets a lower
+max_new_tokens, down to min_new_tokens, and is rejected below that.
+
+With target_p95 set, the latency from a request's last message to its answer is observed.
+Queue waits are part of that latency, so the p95 rises under backlog. max_new_tokens and
+max_time are then scaled down multiplicatively, and scaled back up in steps once the p95 is
+well under the target.
+
+Nothing here depends on torch, the clock is injectable for tests.
+"""
+import time
+import logging
+import threading
+from collections import deque
+from dataclasses import dataclass
+from typing import Callable
+
+from app.metrics.registry import REGISTRY, STAGE_SECONDS, Counter, register_gauge
+
+logger = logging.getLogger(__name__)
+
+ADMISSIONS = REGISTRY.register(
+    Counter(
+        "toonchat_admission_decisions_total",
+        "Generations admitted, made to wait, shortened or rejected by KV memory",
+        ("decision",),
+    )
+)
+LIMIT_CHANGES = REGISTRY.register(
+    Counter(
+        "toonchat_generation_limit_changes_total",
+        "Times max_new_tokens and max_time were scaled to hold the target p95",
+        ("direction",),
+    )
+)
+ADMISSION_WAIT_SECONDS = STAGE_SECONDS.labels("admission_wait")
+
+
+def kv_bytes_per_token(model_config, dtype_bytes: int = 2) -> int:
+    """Bytes of keys and values a token adds to the KV cache, from a transformers config."""
+    layers = model_config.num_hidden_layers
+    heads = model_config.num_attention_heads
+    # Grouped-query attention caches fewer heads than it attends with
+    kv_heads = getattr(model_config, "num_key_value_heads", None) or heads
+    head_dim = getattr(model_config, "head_dim", None) or model_config.hidden_size // heads
+    return 2 * layers * kv_heads * head_dim * dtype_bytes
+
+
+class AdmissionRejected(Exception):
+    def __init__(self, reason: str, message: str) -> None:
+        super().__init__(message)
+        self.reason = reason
+
+
+@dataclass
+class Reservation:
+    nbytes: int
+    max_new_tokens: int
+
+
+class AdmissionController:
+    # Scaling applied when the p95 is over the target, and added back when it is under
+    # recover_below of it
+    decrease = 0.8
+    increase = 0.1
+    recover_below = 0.8
+    # Latencies needed before the p95 is trusted
+    min_samples = 20
+
+    def __init__(
+        self,
+        memory_budget: int,
+        bytes_per_token: int,
+        max_new_tokens: int,
+        max_time: float,
+        min_new_tokens: int = 64,
+        min_time: float = 2.0,
+        target_p95: float = 0,
+        adjust_interval: float = 5.0,
+        window: int = 500,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        # Without bytes per token the memory can not be estimated, only the limits adapt
+        self.memory_budget = memory_budget if bytes_per_token > 0 else 0
+        self.bytes_per_token = bytes_per_token
+        self.max_new_tokens = max_new_tokens
+        self.max_time = max_time
+        self.min_new_tokens = min(min_new_tokens, max_new_tokens)
+        self.min_time = min(min_time, max_time)
+        self.target_p95 = target_p95
+        self.adjust_interval = adjust_interval
+        self._clock = clock
+        self._condition = threading.Condition()
+        self._reserved = 0
+        self._waiting: deque[object] = deque()
+        self._latencies: deque[float] = deque(maxlen=window)
+        self._last_adjust = clock()
+        self._scale = 1.0
+        # Below this scale both limits are at their minimum
+        self._min_scale = min(self.min_new_tokens / max_new_tokens, self.min_time / max_time)
+        register_gauge(
+            "toonchat_kv_reserved_bytes", "KV memory of running generations", self.reserved
+        )
+        register_gauge("toonchat_admission_waiting", "Generations waiting for memory", self.waiting)
+        register_gauge(
+            "toonchat_generation_limit_scale", "Scale of the generation limits", self.scale
+        )
+
+    def estimate(self, prompt_tokens: int, max_new_tokens: int, rows: int = 1) -> int:
+        return rows * (prompt_tokens + max_new_tokens) * self.bytes_per_token
+
+    def acquire(
+        self, prompt_tokens: int, max_new_tokens: int, rows: int = 1, timeout: float = None
+    ) -> Reservation:
+        """Waits until the generation fits in the budget and reserves its memory.
+
+        Raises AdmissionRejected when it can never fit or did not fit before timeout.
+        """
+        if not self.memory_budget:
+            return Reservation(0, max_new_tokens)
+
+        fitting = self.memory_budget // (rows * self.bytes_per_token) - prompt_tokens
+        if fitting < min(self.min_new_tokens, max_new_tokens):
+            ADMISSIONS.labels("rejected").inc(rows)
+            raise AdmissionRejected(
+                "oversized",
+                f"{rows} x {prompt_tokens} prompt tokens do not fit in {self.memory_budget} bytes",
+            )
+        if fitting < max_new_tokens:
+            ADMISSIONS.labels("shortened").inc(rows)
+            max_new_tokens = fitting
+        nbytes = self.estimate(prompt_tokens, max_new_tokens, rows)
+
+        turn = object()
+        start = self._clock()
+        with self._condition:
+            self._waiting.append(turn)
+            admitted = self._condition.wait_for(
+                lambda: self._waiting[0] is turn and self._reserved + nbytes <= self.memory_budget,
+                timeout,
+            )
+            self._waiting.remove(turn)
+            if admitted:
+                self._reserved += nbytes
+            # The next in line may fit as well
+            self._condition.notify_all()
+
+        waited = self._clock() - start
+        ADMISSION_WAIT_SECONDS.observe(waited)
+        if not admitted:
+            ADMISSIONS.labels("timeout").inc(rows)
+            raise AdmissionRejected(
+                "admission_timeout", f"No memory for {nbytes} bytes in {timeout}s"
+            )
+        ADMISSIONS.labels("waited" if waited > 0.001 else "admitted").inc(rows)
+        return Reservation(nbytes, max_new_tokens)
+
+    def release(self, reservation: Reservation):
+        if not reservation.nbytes:
+            return
+        with self._condition:
+            self._reserved -= reservation.nbytes
+            self._condition.notify_all()
+
+    def limits(self) -> tuple[int, float]:
+        """max_new_tokens and max_time of the next generation."""
+        scale = self._scale
+        return (
+            max(self.min_new_tokens, round(self.max_new_tokens * scale)),
+            max(self.min_time, self.max_time * scale),
+        )
+
+    def observe(self, latency: float):
+        """Records the latency of an answered request, and adapts the limits to it."""
+        if not self.target_p95:
+            return
+        with self._condition:
+            self._latencies.append(latency)
+            now = self._clock()
+            if (
+                len(self._latencies) < self.min_samples
+                or now - self._last_adjust < self.adjust_interval
+            ):
+                return
+            latencies = sorted(self._latencies)
+            p95 = latencies[int(len(latencies) * 0.95)]
+            # Every decision is made on the latencies since the previous one
+            self._latencies.clear()
+            self._last_adjust = now
+            if p95 > self.target_p95 and self._scale > self._min_scale:
+                scale, direction = max(self._min_scale, self._scale * self.decrease), "down"
+            elif p95 < self.target_p95 * self.recover_below and self._scale < 1.0:
+                scale, direction = min(1.0, self._scale + self.increase), "up"
+            else:
+                return
+            self._scale = scale
+        LIMIT_CHANGES.labels(direction).inc()
+        logger.info(
+            "p95 latency %.2fs against %.2fs, generation limits %s at scale %.2f",
+            p95,
+            self.target_p95,
+            self.limits(),
+            scale,
+        )
+
+    def reserved(self) -> int:
+        return self._reserved
+
+    def waiting(self) -> int:
+        return len(self._waiting)
+
+    def scale(self) -> float:
+        return self._scale
@@ -0,0 +1,201 @@
+import time
+import logging
+import threading
+from collections import Counter, deque
+from dataclasses import dataclass, field
+from typing import Callable, Hashable
+
+from app.message_queue.data import PromptData
+from app.scheduler.deadline import Ticket
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class BatchRequest:
+    # Opaque to the scheduler, settled through the transport that delivered it
+    delivery_tag: Hashable
+    id: str
+    data: PromptData
+    tokens: int = 0
+    # Only requests with the same group are generated together (e.g. same generation args)
+    group: Hashable = None
+    adapter: str | None = None
+    ticket: Ticket = None
+    # Fairness is kept between tenants (userId), priority picks the lane
+    tenant: Hashable = None
+    priority: str | None = None
+    enqueued_at: float = field(default_factory=time.monotonic)
+    # Virtual start and finish times of weighted fair queuing, set on submit
+    start_tag: float = 0.0
+    finish_tag: float = 0.0
+
+
+class BatchScheduler:
+    """Gathers in-flight requests until a batch is full, over the token budget or timed out.
+
+    Requests are served FIFO. With fair, they are ordered by weighted fair queuing over their
+    tenant instead, so a tenant sending many requests only delays its own. priority_lanes
+    lists priorities from the highest lane down; a lower lane is served once the higher ones
+    are empty or after it waited lane_max_wait. max_tenant_in_flight caps the requests of one
+    tenant between next_batch and finish.
+    """
+
+    def __init__(
+        self,
+        max_batch_size: int,
+        max_batch_tokens: int,
+        max_wait: float,
+        max_adapter_wait: float = 1.0,
+        clock: Callable[[], float] = time.monotonic,
+        fair: bool = False,
+        tenant_weights: dict[Hashable, float] = None,
+        priority_lanes: list[str] = None,
+        lane_max_wait: float = 0,
+        max_tenant_in_flight: int = 0,
+    ) -> None:
+        self.max_batch_size = max_batch_size
+        self.max_batch_tokens = max_batch_tokens
+        self.max_wait = max_wait
+        self.max_adapter_wait = max_adapter_wait
+        self.fair = fair
+        self.tenant_weights = tenant_weights or {}
+        self.lanes = {priority: lane for lane, priority in enumerate(priority_lanes or [])}
+        self.lane_max_wait = lane_max_wait
+        self.max_tenant_in_flight = max_tenant_in_flight
+        self._clock = clock
+        self._queue: deque[BatchRequest] = deque()
+        self._pending_tokens = 0
+        self._virtual_time = 0.0
+        self._last_finish: dict[Hashable, float] = {}
+        self._in_flight: Counter = Counter()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._queue)
+
+    def submit(self, request: BatchRequest):
+        with self._lock:
+            if self.fair:
+                # An idle tenant starts from the current virtual time, it saves no credit
+                request.start_tag = max(
+                    self._virtual_time, self._last_finish.get(request.tenant, 0.0)
+                )
+                request.finish_tag = request.start_tag + 1 / self.tenant_weights.get(
+                    request.tenant, 1.0
+                )
+                self._last_finish[request.tenant] = request.finish_tag
+            self._queue.append(request)
+            self._pending_tokens += request.tokens
+
+    def drop(self, predicate: Callable[[BatchRequest], bool]) -> list[BatchRequest]:
+        """Remove and return the queued requests matching predicate, e.g. expired ones."""
+        with self._lock:
+            dropped, remained = [], deque()
+            for request in self._queue:
+                (dropped if predicate(request) else remained).append(request)
+            self._queue = remained
+            self._pending_tokens -= sum(request.tokens for request in dropped)
+        return dropped
+
+    def finish(self, batch: list[BatchRequest]):
+        """Called once a batch from next_batch is done, frees its tenants' in-flight slots."""
+        with self._lock:
+            self._in_flight.subtract(request.tenant for request in batch)
+            # Drops tenants with nothing in flight
+            self._in_flight += Counter()
+
+    def ready(self) -> bool:
+        return self.time_until_ready() == 0
+
+    def time_until_ready(self) -> float | None:
+        """Seconds until the oldest request must be flushed, None if nothing can be run."""
+        with self._lock:
+            eligible = self._eligible()
+            if not eligible:
+                return None
+            if (
+                len(eligible) >= self.max_batch_size
+                or sum(request.tokens for request in eligible) >= self.max_batch_tokens
+            ):
+                return 0
+            waited = self._clock() - eligible[0].enqueued_at
+            return max(0, self.max_wait - waited)
+
+    def next_batch(self, preferred_adapter: str = None) -> list[BatchRequest]:
+        """Pop the first request in scheduling order and every eligible request of the same
+        group and adapter that fits the limits.
+
+        Requests of preferred_adapter (the active one) go first to avoid switching adapters,
+        unless the first request has already waited max_adapter_wait.
+        """
+        with self._lock:
+            now = self._clock()
+            queue = self._eligible()
+            if not queue:
+                return []
+            if self.fair or self.lanes:
+                queue.sort(key=lambda request: self._order(request, now))
+
+            head_index = 0
+            if (
+                preferred_adapter is not None
+                and queue[0].adapter != preferred_adapter
+                and now - queue[0].enqueued_at < self.max_adapter_wait
+            ):
+                head_index = next(
+                    (i for i, request in enumerate(queue) if request.adapter == preferred_adapter),
+                    0,
+                )
+
+            head = queue.pop(head_index)
+            batch, tokens, taken = [head], head.tokens, Counter([head.tenant])
+            for request in queue:
+                if (
+                    len(batch) < self.max_batch_size
+                    and request.group == head.group
+                    and request.adapter == head.adapter
+                    and tokens + request.tokens <= self.max_batch_tokens
+                    and not self._capped(request.tenant, taken[request.tenant])
+                ):
+                    batch.append(request)
+                    tokens += request.tokens
+                    taken[request.tenant] += 1
+
+            batched = set(map(id, batch))
+            self._queue = deque(request for request in self._queue if id(request) not in batched)
+            self._pending_tokens -= tokens
+            self._in_flight.update(taken)
+            if self.fair:
+                self._advance_virtual_time(head.start_tag)
+
+        logger.debug("Batch of %d requests, %d tokens", len(batch), tokens)
+        return batch
+
+    def _capped(self, tenant: Hashable, taken: int = 0) -> bool:
+        return (
+            self.max_tenant_in_flight > 0
+            and self._in_flight[tenant] + taken >= self.max_tenant_in_flight
+        )
+
+    def _eligible(self) -> list[BatchRequest]:
+        if self.max_tenant_in_flight <= 0:
+            return list(self._queue)
+        return [request for request in self._queue if not self._capped(request.tenant)]
+
+    def _order(self, request: BatchRequest, now: float):
+        lane = self.lanes.get(request.priority, len(self.lanes))
+        if self.lane_max_wait > 0 and now - request.enqueued_at >= self.lane_max_wait:
+            lane = 0
+        # sort is stable, so ties keep their arrival order
+        return lane, request.finish_tag
+
+    def _advance_virtual_time(self, start_tag: float):
+        self._virtual_time = max(self._virtual_time, start_tag)
+        if len(self._last_finish) > 4 * len(self._queue) + 1024:
+            # Tenants at or behind the virtual time start from it anyway
+            self._last_finish = {
+                tenant: finish
+                for tenant, finish in self._last_finish.items()
+                if finish > self._virtual_time
+            }
@@ -0,0 +1,64 @@
+from functools import lru_cache
+from pydantic_settings import BaseSettings, SettingsConfigDict
+
+from app.utils import get_profile
+
+
+class SchedulerConfig(BaseSettings):
+    model_config = SettingsConfigDict(
+        env_file=f"env/.env.{get_profile().value}", env_file_encoding="utf-8", extra="allow"
+    )
+
+    # 1 keeps the original one-message-per-generate behaviour
+    max_batch_size: int = 1
+    max_batch_tokens: int = 8192
+    max_batch_wait: float = 0.05
+    # How long requests of the active adapter may be preferred over older ones
+    max_adapter_wait: float = 1.0
+    # Requests whose last message is older than request_ttl seconds are shed, 0 disables it
+    request_ttl: float = 0
+    # A newer message of a conversation cancels the queued or running answer to an older one
+    supersede_conversations: bool = False
+    deadline_report_interval: float = 60.0
+    # Weighted fair queuing across userId instead of FIFO, tenant_weights default to 1
+    fair_scheduling: bool = False
+    tenant_weights: dict[str, float] = {}
+    # PromptData.priority values from the highest lane down, e.g. ["paid", "production"]
+    priority_lanes: list[str] = []
+    # A lower lane is served after waiting this long, 0 for strict priority
+    lane_max_wait: float = 0
+    max_user_in_flight: int = 0
+    # Deliveries held in process to schedule among, 0 for max_batch_size per worker. Fairness
+    # only reorders what was prefetched, so it needs room for more than one tenant's backlog
+    prefetch_count: int = 0
+    # KV cache bytes the running generations may reserve, 0 disables admission control.
+    # kv_bytes_per_token is taken from the model config when 0
+    kv_memory_budget: int = 0
+    kv_bytes_per_token: int = 0
+    # Seconds a generation waits for memory before its requests are shed
+    admission_timeout: float = 30.0
+    # p95 seconds from the last message to the answer that max_new_tokens and max_time are
+    # lowered to hold, down to min_new_tokens and min_max_time. 0 keeps them fixed
+    target_p95_latency: float = 0
+    min_new_tokens: int = 64
+    min_max_time: float = 2.0
+    limit_adjust_interval: float = 5.0
+
+    def is_batching(self):
+        return self.max_batch_size > 1
+
+    def use_admission(self):
+        return self.kv_memory_budget > 0 or self.target_p95_latency > 0
+
+    def use_scheduler(self):
+        return (
+            self.is_batching()
+            or self.fair_scheduling
+            or bool(self.priority_lanes)
+            or self.max_user_in_flight > 0
+        )
+
+
+@lru_cache
+def get_scheduler_config() -> SchedulerConfig:
+    return SchedulerConfig()
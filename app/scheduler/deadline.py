@@ -0,0 +1,164 @@
+import time
+import logging
+import threading
+from collections import deque
+from dataclasses import dataclass, field
+from datetime import timezone
+from typing import Callable
+
+from app.message_queue.data import PromptData
+from app.metrics.registry import STAGE_SECONDS, SHED
+
+logger = logging.getLogger(__name__)
+
+QUEUE_WAIT_SECONDS = STAGE_SECONDS.labels("queue_wait")
+
+
+def message_timestamp(data: PromptData) -> float | None:
+    """Wall-clock time the last message of the conversation was created at."""
+    messages = data.get_chat_history_list()
+    if not messages or messages[-1].createdAt is None:
+        return None
+    created_at = messages[-1].createdAt
+    if created_at.tzinfo is None:
+        created_at = created_at.replace(tzinfo=timezone.utc)
+    return created_at.timestamp()
+
+
+@dataclass
+class Ticket:
+    """Lifetime of one request: when it was created, until when it is worth answering and
+    whether a newer message of the same conversation cancelled it."""
+
+    conversation_id: str
+    created_at: float
+    deadline: float | None = None
+    cancelled: threading.Event = field(default_factory=threading.Event)
+    started: bool = False
+    # messageId of the last message, a redelivered copy has the same one
+    message_id: str | None = None
+    duplicate: bool = False
+
+    def expired(self, now: float) -> bool:
+        return self.deadline is not None and now >= self.deadline
+
+    def remaining(self, now: float) -> float | None:
+        return None if self.deadline is None else self.deadline - now
+
+
+class DeadlineTracker:
+    """Sheds requests older than ttl and, with supersede, cancels the request of a conversation
+    once a newer message of it arrives.
+
+    Times are wall-clock seconds because they are compared with Message.createdAt, set by
+    the producer. A request without createdAt counts from when it was admitted.
+    """
+
+    def __init__(
+        self,
+        ttl: float = 0,
+        supersede: bool = False,
+        report_interval: float = 60.0,
+        clock: Callable[[], float] = time.time,
+        wait_window: int = 1024,
+    ) -> None:
+        self.ttl = ttl
+        self.supersede = supersede
+        self.report_interval = report_interval
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._latest: dict[str, Ticket] = {}
+        self._queue_waits: deque[float] = deque(maxlen=wait_window)
+        self._last_report = clock()
+        self.shed = {"expired": 0, "superseded": 0, "cancelled": 0, "duplicate": 0}
+
+    def now(self) -> float:
+        return self._clock()
+
+    def admit(self, data: PromptData) -> Ticket:
+        now = self._clock()
+        created_at = message_timestamp(data) or now
+        messages = data.get_chat_history_list()
+        ticket = Ticket(
+            data.history._id,
+            created_at,
+            created_at + self.ttl if self.ttl > 0 else None,
+            message_id=messages[-1].messageId if messages else None,
+        )
+        if not self.supersede:
+            return ticket
+
+        with self._lock:
+            previous = self._latest.get(ticket.conversation_id)
+            if previous is not None and previous.created_at > ticket.created_at:
+                # Redelivered or reordered, the conversation already moved on
+                ticket.cancelled.set()
+                return ticket
+            if (
+                previous is not None
+                and ticket.message_id is not None
+                and previous.message_id == ticket.message_id
+            ):
+                # A redelivered copy of the request in flight, which still answers it
+                ticket.duplicate = True
+                ticket.cancelled.set()
+                return ticket
+            if previous is not None:
+                logger.info("Request of %s superseded by a newer message", ticket.conversation_id)
+                previous.cancelled.set()
+            self._latest[ticket.conversation_id] = ticket
+        return ticket
+
+    def is_shed(self, ticket: Ticket) -> bool:
+        return ticket.cancelled.is_set() or ticket.expired(self._clock())
+
+    def record_shed(self, ticket: Ticket):
+        if ticket.duplicate:
+            reason = "duplicate"
+        elif ticket.cancelled.is_set():
+            reason = "cancelled" if ticket.started else "superseded"
+        else:
+            reason = "expired"
+        with self._lock:
+            self.shed[reason] += 1
+        SHED.labels(reason).inc()
+        logger.info("Shed %s request of %s", reason, ticket.conversation_id)
+
+    def start(self, tickets: list[Ticket]):
+        now = self._clock()
+        waits = [max(0.0, now - ticket.created_at) for ticket in tickets]
+        with self._lock:
+            for ticket in tickets:
+                ticket.started = True
+            self._queue_waits.extend(waits)
+        for wait in waits:
+            QUEUE_WAIT_SECONDS.observe(wait)
+
+    def remaining(self, tickets: list[Ticket]) -> float | None:
+        """Time left until the first deadline among tickets, None without a ttl."""
+        now = self._clock()
+        remaining = [ticket.remaining(now) for ticket in tickets if ticket.deadline is not None]
+        return min(remaining) if remaining else None
+
+    def release(self, ticket: Ticket):
+        with self._lock:
+            if self._latest.get(ticket.conversation_id) is ticket:
+                del self._latest[ticket.conversation_id]
+            report_due = (
+                self.report_interval > 0
+                and self._clock() - self._last_report >= self.report_interval
+            )
+            if report_due:
+                self._last_report = self._clock()
+        if report_due:
+            logger.info("Deadlines: %s", self.report())
+
+    def report(self) -> dict:
+        with self._lock:
+            waits = sorted(self._queue_waits)
+            return {
+                **self.shed,
+                "tracked": len(self._latest),
+                "queue_wait_p50": waits[len(waits) // 2] if waits else None,
+                "queue_wait_p99": waits[int(len(waits) * 0.99)] if waits else None,
+            }
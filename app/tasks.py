@@ -1,45 +1,464 @@
-import json
+import os
+import signal
 import logging
-from pydantic import TypeAdapter
+import threading
 
 from app.message_queue.amqp import Amqp
 from app.message_queue.ampq_observer import AmqpObserver
-from app.message_queue.data import PromptData
+from app.message_queue.data import PromptData, MessageToMq
+from app.message_queue.codec import decode_prompt_data, encode_reply
+from app.message_queue.config import get_conversation_config
+from app.message_queue.conversation_store import ConversationStore, HistoryRequired
 from app.llm.factory import llm_factory
-from app.llm.config import llm_config
+from app.llm.config import get_llm_config, generation_config
+from app.llm.worker import ProcessPoolLLM
+from app.llm.supervisor import ModelSupervisor
+from app.llm.streamer import ChunkCoalescer
+from app.scheduler.batch import BatchRequest, BatchScheduler
+from app.scheduler.config import get_scheduler_config
+from app.scheduler.deadline import DeadlineTracker, Ticket
+from app.scheduler.admission import AdmissionController, AdmissionRejected, Reservation
+from app.metrics.registry import STAGE_SECONDS, ERRORS, SHED
 
 logger = logging.getLogger(__name__)
 
+PUBLISH_SECONDS = STAGE_SECONDS.labels("publish")
+VALIDATION_ERRORS = ERRORS.labels("validation")
+
 
 class InferenceTask(AmqpObserver):
     model = None
     amqp: Amqp
 
     def __init__(self, amqp: Amqp) -> None:
-        self.model = llm_factory.create_llm(
-            llm_config.prompt_template, llm_config.pretrained_model_name_or_path
+        self.llm_config = get_llm_config()
+        scheduler_config = get_scheduler_config()
+        self.deadlines = DeadlineTracker(
+            scheduler_config.request_ttl,
+            scheduler_config.supersede_conversations,
+            scheduler_config.deadline_report_interval,
         )
+        conversation_config = get_conversation_config()
+        self.conversations: ConversationStore = None
+        if conversation_config.conversation_store_size:
+            self.conversations = ConversationStore(
+                conversation_config.conversation_store_size,
+                conversation_config.conversation_max_messages,
+                conversation_config.conversation_store_path,
+            )
+        self.admission: AdmissionController = None
+        self.admission_timeout = scheduler_config.admission_timeout
         self.amqp = amqp
+        self._ready = threading.Event()
         amqp.attach(self)
+        # The model loads while the AMQP connection is set up, consuming starts once it is ready
+        threading.Thread(target=self.load_model, name="model-loader", daemon=True).start()
+
+    def load_model(self):
+        try:
+            if self.llm_config.serve_models:
+                self.model = ModelSupervisor(
+                    models=self.llm_config.serve_models,
+                    default_model=self.llm_config.default_model,
+                    workers_per_model=self.llm_config.workers_per_model,
+                )
+            elif self.amqp.is_process_worker():
+                self.model = ProcessPoolLLM(
+                    model_name=self.llm_config.prompt_template,
+                    dir_path=self.llm_config.pretrained_model_name_or_path,
+                    max_workers=self.amqp.worker_count,
+                )
+            else:
+                self.model = llm_factory.create_llm(
+                    self.llm_config.prompt_template,
+                    self.llm_config.pretrained_model_name_or_path,
+                )
+            if get_scheduler_config().use_admission():
+                self.admission = self.create_admission()
+        except Exception as e:
+            logger.critical("Failed to load model: %s", e, exc_info=True)
+            os.kill(os.getpid(), signal.SIGTERM)
+            return
+
+        logger.info("Model is ready")
+        self._ready.set()
+        self.amqp.notify_ready()
+
+    def create_admission(self) -> AdmissionController:
+        scheduler_config = get_scheduler_config()
+        bytes_per_token = scheduler_config.kv_bytes_per_token or self.model.kv_bytes_per_token()
+        if scheduler_config.kv_memory_budget and not bytes_per_token:
+            logger.warning("KV bytes per token of the model are unknown, memory is not limited")
+        return AdmissionController(
+            scheduler_config.kv_memory_budget,
+            bytes_per_token,
+            generation_config["max_new_tokens"],
+            generation_config["max_time"],
+            scheduler_config.min_new_tokens,
+            scheduler_config.min_max_time,
+            scheduler_config.target_p95_latency,
+            scheduler_config.limit_adjust_interval,
+        )
+
+    def is_ready(self) -> bool:
+        return self._ready.is_set()
 
-    def update(self, data):
+    def wait_ready(self, timeout: float = None) -> bool:
+        return self._ready.wait(timeout)
+
+    def update(self, data, delivery_tag=None):
         if isinstance(data, dict) and "id" in data:
             args = data.get("args", None)
             if isinstance(args, list) and 0 < len(args) < 3:
-                answer, user_id = self.inference(id=data.get("id"), data=args[0])
-                body = json.dumps(answer, ensure_ascii=False)
-                self.publish(body, user_id)
+                if self.llm_config.stream:
+                    self.stream_inference(id=data.get("id"), data=args[0])
+                    return
+                result = self.inference(id=data.get("id"), data=args[0])
+                if result is not None:
+                    self.publish_frame(*result)
 
     def inference(self, id: str, data: dict):
         message: PromptData
         try:
-            message = TypeAdapter(PromptData).validate_python(data)
+            message = decode_prompt_data(data)
         except Exception as e:
+            VALIDATION_ERRORS.inc()
             logger.error("Failed to map message to dataclass. message: %s, error: %s", data, e)
+            raise
+        try:
+            message = self.resolve_history(message)
+        except HistoryRequired as e:
+            logger.warning("%s, requesting the full history", e)
+            return message.build_history_request(id), message.get_user_id()
+
+        ticket = self.deadlines.admit(message)
+        try:
+            if self.deadlines.is_shed(ticket):
+                self.deadlines.record_shed(ticket)
+                return None
+            generation_kwargs = self.generation_kwargs(message, [ticket])
+            try:
+                reservation = self.reserve([message], generation_kwargs)
+            except AdmissionRejected as e:
+                self.record_rejected(e, [ticket])
+                return None
+            self.deadlines.start([ticket])
+            try:
+                completion_result = self.model.generate(message, **generation_kwargs)
+            finally:
+                self.release(reservation)
+            if ticket.cancelled.is_set():
+                self.deadlines.record_shed(ticket)
+                return None
+            self.observe_latency([ticket])
+        finally:
+            self.deadlines.release(ticket)
+
+        return message.build_return_message(id, completion_result), message.get_user_id()
+
+    def stream_inference(self, id: str, data: dict):
+        try:
+            message: PromptData = decode_prompt_data(data)
+        except Exception:
+            VALIDATION_ERRORS.inc()
+            raise
+        try:
+            message = self.resolve_history(message)
+        except HistoryRequired as e:
+            logger.warning("%s, requesting the full history", e)
+            self.publish_frame(message.build_history_request(id), message.get_user_id())
             return
+        ticket = self.deadlines.admit(message)
+        try:
+            if self.deadlines.is_shed(ticket):
+                self.deadlines.record_shed(ticket)
+                return
+            generation_kwargs = self.generation_kwargs(message, [ticket])
+            try:
+                reservation = self.reserve([message], generation_kwargs)
+            except AdmissionRejected as e:
+                self.record_rejected(e, [ticket])
+                return
+            self.deadlines.start([ticket])
+            try:
+                self.stream_answer(id, message, ticket, generation_kwargs)
+            finally:
+                self.release(reservation)
+        finally:
+            self.deadlines.release(ticket)
+
+    def stream_answer(self, id: str, message: PromptData, ticket: Ticket, generation_kwargs: dict):
+        user_id = message.get_user_id()
+        coalescer = ChunkCoalescer(self.llm_config.stream_interval, self.llm_config.stream_tokens)
+        answer, sequence, done = [], 0, False
+
+        try:
+            for text in self.model.generate_stream(message, **generation_kwargs):
+                answer.append(text)
+                chunk = coalescer.add(text)
+                if chunk:
+                    self.publish_frame(
+                        message.build_return_message(id, chunk, sequence, False), user_id
+                    )
+                    sequence += 1
+
+            if ticket.cancelled.is_set():
+                # The answer to the newer message replaces this one, so it is never completed
+                self.deadlines.record_shed(ticket)
+                return
+            chunk = coalescer.flush()
+            if chunk:
+                self.publish_frame(
+                    message.build_return_message(id, chunk, sequence, False), user_id
+                )
+                sequence += 1
+            self.publish_frame(message.build_return_message(id, "".join(answer), sequence), user_id)
+            done = True
+            self.observe_latency([ticket])
+        finally:
+            if not done:
+                # Consumers wait for a done frame, a cut stream ends with an empty one
+                self.publish_frame(message.build_return_message(id, "", sequence), user_id)
+
+    def resolve_history(self, message: PromptData) -> PromptData:
+        """message with its full history, raises HistoryRequired for a delta that can not be
+        applied to the stored one."""
+        if self.conversations is not None:
+            return self.conversations.resolve(message)
+        if message.history.baseVersion is not None:
+            raise HistoryRequired(message.history._id, message.history.baseVersion, None)
+        return message
+
+    def generation_kwargs(self, message: PromptData, tickets: list[Ticket]) -> dict:
+        generation_kwargs = message.get_generation_args()
+        if self.deadlines.supersede:
+            generation_kwargs["cancel"] = [ticket.cancelled for ticket in tickets]
+        max_time = generation_config["max_time"]
+        if self.admission is not None:
+            generation_kwargs["max_new_tokens"], max_time = self.admission.limits()
+            generation_kwargs["max_time"] = max_time
+        remaining = self.deadlines.remaining(tickets)
+        if remaining is not None:
+            # Generating past the deadline only produces answers nobody reads
+            generation_kwargs["max_time"] = max(0.0, min(max_time, remaining))
+        return generation_kwargs
+
+    def reserve(
+        self, messages: list[PromptData], generation_kwargs: dict, prompt_tokens: int = None
+    ) -> Reservation | None:
+        """Waits for the KV memory of generating messages at once, lowering max_new_tokens to
+        what fits. Raises AdmissionRejected."""
+        if self.admission is None:
+            return None
+        if prompt_tokens is None and self.admission.memory_budget:
+            # Rows of a batch are padded to the longest prompt
+            prompt_tokens = max(self.model.count_tokens(message) for message in messages)
+        reservation = self.admission.acquire(
+            prompt_tokens or 0,
+            generation_kwargs.get("max_new_tokens", generation_config["max_new_tokens"]),
+            len(messages),
+            self.admission_timeout,
+        )
+        generation_kwargs["max_new_tokens"] = reservation.max_new_tokens
+        return reservation
 
-        completion_result = self.model.generate(message, **message.get_generation_args())
-        return message.build_return_message(id, completion_result).to_dict(), message.get_user_id()
+    def release(self, reservation: Reservation | None):
+        if reservation is not None:
+            self.admission.release(reservation)
 
-    def publish(self, data: str, routing_key: str):
+    def record_rejected(self, rejected: AdmissionRejected, tickets: list[Ticket]):
+        logger.warning("Shed %d requests: %s", len(tickets), rejected)
+        SHED.labels(rejected.reason).inc(len(tickets))
+
+    def observe_latency(self, tickets: list[Ticket]):
+        if self.admission is not None:
+            now = self.deadlines.now()
+            for ticket in tickets:
+                self.admission.observe(now - ticket.created_at)
+
+    def publish_frame(self, frame: MessageToMq, routing_key: str):
+        with PUBLISH_SECONDS.time():
+            self.publish(encode_reply(frame), routing_key)
+
+    def publish(self, data: bytes, routing_key: str):
         self.amqp.publish(routing_key, data)
+
+
+class BatchInferenceTask(InferenceTask):
+    manual_ack = True
+
+    def __init__(self, amqp: Amqp) -> None:
+        if get_llm_config().stream:
+            # Checked before the model loads, batches are answered in a single reply each
+            raise ValueError(
+                "STREAM is not supported with the batch scheduler, unset it or the scheduler "
+                "settings (MAX_BATCH_SIZE > 1, FAIR_SCHEDULING, PRIORITY_LANES, "
+                "MAX_USER_IN_FLIGHT)"
+            )
+        super().__init__(amqp)
+        scheduler_config = get_scheduler_config()
+        self.scheduler = BatchScheduler(
+            scheduler_config.max_batch_size,
+            scheduler_config.max_batch_tokens,
+            scheduler_config.max_batch_wait,
+            scheduler_config.max_adapter_wait,
+            fair=scheduler_config.fair_scheduling,
+            tenant_weights=scheduler_config.tenant_weights,
+            priority_lanes=scheduler_config.priority_lanes,
+            lane_max_wait=scheduler_config.lane_max_wait,
+            max_tenant_in_flight=scheduler_config.max_user_in_flight,
+        )
+        self._flush_timer = False
+        self._flush_timer_lock = threading.Lock()
+        # Every worker can gather and run its own batch
+        amqp.set_prefetch_count(
+            scheduler_config.prefetch_count
+            or scheduler_config.max_batch_size * max(1, amqp.worker_count)
+        )
+
+    def update(self, data, delivery_tag=None):
+        if not (isinstance(data, dict) and "id" in data):
+            self.amqp.acknowledge_message(delivery_tag)
+            return
+
+        args = data.get("args", None)
+        if not (isinstance(args, list) and 0 < len(args) < 3):
+            self.amqp.acknowledge_message(delivery_tag)
+            return
+
+        try:
+            message = decode_prompt_data(args[0])
+        except Exception as e:
+            VALIDATION_ERRORS.inc()
+            logger.error("Failed to map message to dataclass. message: %s, error: %s", data, e)
+            self.amqp.reject_message(delivery_tag, e)
+            return
+        try:
+            message = self.resolve_history(message)
+        except HistoryRequired as e:
+            logger.warning("%s, requesting the full history", e)
+            self.publish_frame(message.build_history_request(data.get("id")), message.get_user_id())
+            self.amqp.acknowledge_message(delivery_tag)
+            return
+
+        ticket = self.deadlines.admit(message)
+        if self.deadlines.is_shed(ticket):
+            # Dropped before tokenization, the answer would not be read anyway
+            self.shed(ticket, delivery_tag)
+            return
+
+        try:
+            adapter = self.model.get_adapter(message)
+            tokens = self.model.count_tokens(message)
+        except Exception:
+            # Rejected by dispatch, the ticket would otherwise hold the conversation
+            self.deadlines.release(ticket)
+            raise
+        self.model.preload_adapter(adapter)
+        self.scheduler.submit(
+            BatchRequest(
+                delivery_tag=delivery_tag,
+                id=data.get("id"),
+                data=message,
+                tokens=tokens,
+                group=tuple(message.get_generation_args().items()),
+                adapter=adapter,
+                ticket=ticket,
+                tenant=message.get_user_id(),
+                priority=message.priority,
+            )
+        )
+        self.flush()
+
+    def shed(self, ticket: Ticket, delivery_tag):
+        self.deadlines.record_shed(ticket)
+        self.deadlines.release(ticket)
+        self.amqp.acknowledge_message(delivery_tag)
+
+    def flush(self):
+        for request in self.scheduler.drop(lambda request: self.deadlines.is_shed(request.ticket)):
+            self.shed(request.ticket, request.delivery_tag)
+            self.model.discard_adapter(request.adapter)
+
+        while self.scheduler.ready():
+            batch = self.scheduler.next_batch(self.model.active_adapter())
+            if not batch:
+                break
+            try:
+                self.run_batch(batch)
+            finally:
+                self.scheduler.finish(batch)
+                for request in batch:
+                    self.model.discard_adapter(request.adapter)
+
+        wait = self.scheduler.time_until_ready()
+        with self._flush_timer_lock:
+            if wait is None or self._flush_timer:
+                return
+            self._flush_timer = True
+        self.amqp.call_later(wait, self.on_flush_timer)
+
+    def on_flush_timer(self):
+        with self._flush_timer_lock:
+            self._flush_timer = False
+        self.flush()
+
+    def on_reconnect(self):
+        # Queued requests are redelivered by the broker, keeping them would generate them twice
+        for request in self.scheduler.drop(lambda request: True):
+            self.deadlines.release(request.ticket)
+            self.model.discard_adapter(request.adapter)
+        with self._flush_timer_lock:
+            # The timer was set on the old connection
+            self._flush_timer = False
+
+    def run_batch(self, batch: list[BatchRequest]):
+        tickets = [request.ticket for request in batch]
+        try:
+            generation_kwargs = self.generation_kwargs(batch[0].data, tickets)
+            reservation = self.reserve(
+                [request.data for request in batch],
+                generation_kwargs,
+                max(request.tokens for request in batch),
+            )
+        except AdmissionRejected as e:
+            if e.reason == "oversized" and len(batch) > 1:
+                # Halves padded to their own longest prompt may fit where the batch does not
+                self.run_batch(batch[: len(batch) // 2])
+                self.run_batch(batch[len(batch) // 2 :])
+                return
+            self.record_rejected(e, tickets)
+            for request in batch:
+                self.deadlines.release(request.ticket)
+                self.amqp.acknowledge_message(request.delivery_tag)
+            return
+        except Exception as e:
+            self.fail_batch(batch, e)
+            return
+        self.deadlines.start(tickets)
+        try:
+            completion_results = self.model.generate_batch(
+                [request.data for request in batch], **generation_kwargs
+            )
+        except Exception as e:
+            self.fail_batch(batch, e)
+            return
+        finally:
+            self.release(reservation)
+
+        for request, completion_result in zip(batch, completion_results, strict=True):
+            if request.ticket.cancelled.is_set():
+                self.shed(request.ticket, request.delivery_tag)
+                continue
+            answer = request.data.build_return_message(request.id, completion_result)
+            self.publish_frame(answer, request.data.get_user_id())
+            self.observe_latency([request.ticket])
+            self.deadlines.release(request.ticket)
+            self.amqp.acknowledge_message(request.delivery_tag)
+
+    def fail_batch(self, batch: list[BatchRequest], exception: Exception):
+        ERRORS.labels("generate").inc()
+        logger.error("Failed to generate batch of %d requests: %s", len(batch), exception)
+        for request in batch:
+            self.deadlines.release(request.ticket)
+            self.amqp.reject_message(request.delivery_tag, exception)
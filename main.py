@@ -1,14 +1,25 @@
 import logging
 
-from app.message_queue.config import Config
+from app.message_queue.config import get_config, Transport
 from app.message_queue.amqp import Amqp
-from app.tasks import InferenceTask
+from app.message_queue.async_amqp import AsyncAmqp
+from app.message_queue.sharding import ShardedAmqp
+from app.tasks import InferenceTask, BatchInferenceTask
+from app.scheduler.config import get_scheduler_config
+from app.metrics.exporter import start_exporter
 
 LOG_FORMAT = (
     "%(levelname) -10s %(asctime)s %(name) -30s %(funcName) " "-35s %(lineno) -5d: %(message)s"
 )
 logging.basicConfig(level=logging.INFO, format=LOG_FORMAT)
 
-amqp = Amqp(Config())
-task = InferenceTask(amqp)
+start_exporter()
+config = get_config()
+if config.shard_node_id:
+    amqp = ShardedAmqp(config)
+elif config.transport == Transport.ASYNCIO:
+    amqp = AsyncAmqp(config)
+else:
+    amqp = Amqp(config)
+task = BatchInferenceTask(amqp) if get_scheduler_config().use_scheduler() else InferenceTask(amqp)
 amqp.run()
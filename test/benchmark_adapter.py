@@ -0,0 +1,191 @@
+"""Drives AdapterRegistry with MockAdapterBackend and BatchScheduler, without torch.
+
+Requests of many LoRA adapters arrive as a Poisson process on a simulated clock. Each batch
+waits for its adapter (a switch costs --switch-latency, loading one --load-latency) and then
+generates. The FIFO order is compared with adapter-aware batching, which prefers the active
+adapter, and every run checks that:
+
+    batches hold requests of one adapter
+    resident adapters stay within --max-adapters and --max-bytes
+    evictions follow LRU order, compared with a reference LRU
+    adapters preloaded by shed requests do not stay fetched
+
+    python test/benchmark_adapter.py --adapters 8 --max-adapters 4 --max-bytes 8
+"""
+import os
+import sys
+import random
+import itertools
+import argparse
+import datetime
+import statistics
+import logging
+from collections import OrderedDict
+
+logging.basicConfig(level="WARN")
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+from app.message_queue.data import PromptData, History, Message, GenerationArgs
+from app.llm.adapter import AdapterRegistry, MockAdapterBackend
+from app.scheduler.batch import BatchRequest, BatchScheduler
+
+
+class Clock:
+    def __init__(self) -> None:
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class ReferenceLRU:
+    """The eviction AdapterRegistry should make, computed independently."""
+
+    def __init__(self, max_adapters: int, max_bytes: int, sizes: dict[str, int]) -> None:
+        self.max_adapters = max_adapters
+        self.max_bytes = max_bytes
+        self.sizes = sizes
+        self.resident: OrderedDict[str, int] = OrderedDict()
+        self.evicted: list[str] = []
+
+    def use(self, name: str):
+        if name not in self.resident:
+            self.resident[name] = self.sizes[name]
+            while len(self.resident) > 1 and (
+                len(self.resident) > self.max_adapters
+                or sum(self.resident.values()) > self.max_bytes
+            ):
+                self.evicted.append(self.resident.popitem(last=False)[0])
+        self.resident.move_to_end(name)
+
+
+def build_prompt_data(i: int) -> PromptData:
+    return PromptData(
+        "나는 이영준이다.",
+        [],
+        History(
+            f"history_{i}",
+            f"user_{i}",
+            0,
+            [Message(f"message_{i}", None, datetime.datetime.now(), "안녕! 너는 누구니?", True)],
+        ),
+        GenerationArgs(0.3, 1.5),
+    )
+
+
+def arrivals(args) -> list[tuple[float, str, bool]]:
+    """(arrival, adapter, shed) of every request, adapters drawn by a Zipf-like popularity."""
+    rng = random.Random(args.seed)
+    names = [f"adapter_{i}" for i in range(args.adapters)]
+    weights = [1 / (rank + 1) for rank in range(args.adapters)]
+    result, now = [], 0.0
+    for _ in range(args.requests):
+        now += rng.expovariate(args.rate)
+        result.append((now, rng.choices(names, weights)[0], rng.random() < args.shed))
+    return result
+
+
+def check(condition: bool, message: str):
+    if not condition:
+        raise SystemExit(f"FAILED: {message}")
+
+
+def run(args, adapter_aware: bool) -> dict:
+    rng = random.Random(args.seed)
+    sizes = {f"adapter_{i}": rng.randint(1, 3) for i in range(args.adapters)}
+    backend = MockAdapterBackend(sizes)
+    registry = AdapterRegistry(backend, args.max_adapters, args.max_bytes)
+    reference = ReferenceLRU(args.max_adapters, args.max_bytes, sizes)
+    clock = Clock()
+    scheduler = BatchScheduler(
+        args.batch_size, args.batch_size, args.max_wait, args.max_adapter_wait, clock=clock
+    )
+
+    pending, data, tags = arrivals(args), build_prompt_data(0), itertools.count()
+    shed_ids, latencies, batch_sizes = set(), [], []
+    while pending or len(scheduler):
+        wait = scheduler.time_until_ready()
+        if pending and (wait is None or clock.now + wait >= pending[0][0]):
+            arrived, adapter, shed = pending.pop(0)
+            clock.now = max(clock.now, arrived)
+            request = BatchRequest(
+                next(tags), None, data, tokens=1, adapter=adapter, enqueued_at=clock.now
+            )
+            request.id = str(request.delivery_tag)
+            if shed:
+                shed_ids.add(request.id)
+            registry.preload(adapter)
+            scheduler.submit(request)
+            continue
+        clock.now += wait or 0
+
+        for request in scheduler.drop(lambda request: request.id in shed_ids):
+            registry.discard(request.adapter)
+        batch = scheduler.next_batch(registry.active if adapter_aware else None)
+        if not batch:
+            continue
+        adapter = batch[0].adapter
+        check(all(request.adapter == adapter for request in batch), "batch mixes adapters")
+
+        switches, loads = registry.switches, registry.loads
+        with registry.use(adapter):
+            reference.use(adapter)
+            report = registry.report()
+            check(report["resident"] == list(reference.resident), "resident differs from LRU")
+            check(
+                len(report["resident"]) <= args.max_adapters
+                and (report["bytes_held"] <= args.max_bytes or len(report["resident"]) == 1),
+                f"over the limits: {report}",
+            )
+        clock.now += (
+            args.latency
+            + (registry.switches - switches) * args.switch_latency
+            + (registry.loads - loads) * args.load_latency
+        )
+        scheduler.finish(batch)
+        for request in batch:
+            registry.discard(request.adapter)
+        latencies.extend(clock.now - request.enqueued_at for request in batch)
+        batch_sizes.append(len(batch))
+
+    evicted = [name for event, name in backend.events if event == "detach"]
+    check(evicted == reference.evicted, "evictions differ from LRU")
+    check(not registry.report()["fetched"], "fetched adapters of shed requests are kept")
+    cuts = statistics.quantiles(latencies, n=100)
+    return {
+        "batches": len(batch_sizes),
+        "mean_batch": statistics.fmean(batch_sizes),
+        "shed": len(shed_ids),
+        "p50": cuts[49],
+        "p95": cuts[94],
+        **registry.report(),
+    }
+
+
+def main(args):
+    print(f"{'order':>8} {'batches':>7} {'size':>5} {'switches':>8} {'loads':>5} {'evicted':>7} {'p50':>7} {'p95':>7}")  # fmt: skip
+    for name, adapter_aware in (("fifo", False), ("adapter", True)):
+        result = run(args, adapter_aware)
+        print(
+            f"{name:>8} {result['batches']:>7} {result['mean_batch']:>5.1f} "
+            f"{result['switches']:>8} {result['loads']:>5} {result['evictions']:>7} "
+            f"{result['p50']:>6.2f}s {result['p95']:>6.2f}s"
+        )
+    print("checks passed: single-adapter batches, memory cap, LRU evictions, shed preloads dropped")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Adapter registry and adapter-aware batching")
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--rate", type=float, default=15, help="arrivals per second")
+    parser.add_argument("--adapters", type=int, default=8)
+    parser.add_argument("--max-adapters", type=int, default=4)
+    parser.add_argument("--max-bytes", type=int, default=8, help="sizes are 1 to 3 bytes")
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--max-wait", type=float, default=0.05)
+    parser.add_argument("--max-adapter-wait", type=float, default=1.0)
+    parser.add_argument("--latency", type=float, default=0.05, help="of a generate call")
+    parser.add_argument("--switch-latency", type=float, default=0.02)
+    parser.add_argument("--load-latency", type=float, default=0.1)
+    parser.add_argument("--shed", type=float, default=0.05, help="share of requests shed")
+    parser.add_argument("--seed", type=int, default=0)
+    main(parser.parse_args())
@@ -0,0 +1,177 @@
+"""Simulates generations under load with and without AdmissionController, without a GPU.
+
+Worker threads take Poisson arrivals from a queue and "generate" by sleeping per prompt and
+generated token. A request generates its natural answer length, cut at max_new_tokens and
+max_time. The KV bytes of the running generations are tracked: over device_memory the device
+would OOM or thrash, which is simulated by slowing every token down. Compared modes:
+
+    static    fixed limits and no memory budget, like generation_config alone
+    memory    generations wait for KV memory within --budget
+    adaptive  memory, and max_new_tokens and max_time scaled to hold --target-p95
+
+    python test/benchmark_admission.py --rate 35 --duration 20
+"""
+import os
+import sys
+import time
+import queue
+import random
+import argparse
+import threading
+import statistics
+import logging
+
+logging.basicConfig(level="WARN")
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+from app.scheduler.admission import ADMISSIONS, AdmissionController, AdmissionRejected
+
+GIB = 1024**3
+
+
+class Device:
+    """KV memory of the running generations, and the slowdown once it is over capacity."""
+
+    def __init__(self, capacity: int, slowdown: float) -> None:
+        self.capacity = capacity
+        self.slowdown = slowdown
+        self.used = 0
+        self.peak = 0
+        self.over = 0
+        self._lock = threading.Lock()
+
+    def allocate(self, nbytes: int) -> float:
+        with self._lock:
+            self.used += nbytes
+            self.peak = max(self.peak, self.used)
+            if self.used > self.capacity:
+                self.over += 1
+                return self.slowdown
+            return 1.0
+
+    def free(self, nbytes: int):
+        with self._lock:
+            self.used -= nbytes
+
+
+def requests(args) -> list[tuple[float, int, int]]:
+    """(arrival, prompt tokens, natural answer length) of every request."""
+    rng = random.Random(args.seed)
+    result, now = [], 0.0
+    while now < args.duration:
+        prompt = int(rng.lognormvariate(6.8, 0.6))
+        result.append((now, min(prompt, args.max_prompt), rng.randint(32, 384)))
+        now += rng.expovariate(args.rate)
+    return result
+
+
+def run(args, mode: str) -> dict:
+    controller = AdmissionController(
+        args.budget * GIB if mode != "static" else 0,
+        args.bytes_per_token,
+        args.max_new_tokens,
+        args.max_time,
+        args.min_new_tokens,
+        args.min_time,
+        args.target_p95 if mode == "adaptive" else 0,
+        adjust_interval=args.adjust_interval,
+    )
+    device = Device(args.device_memory * GIB, args.slowdown)
+    pending: queue.Queue = queue.Queue()
+    latencies, generated, shed = [], [], []
+
+    def work():
+        while True:
+            item = pending.get()
+            if item is None:
+                return
+            arrived, prompt_tokens, natural = item
+            max_new_tokens, max_time = controller.limits()
+            try:
+                reservation = controller.acquire(
+                    prompt_tokens, max_new_tokens, timeout=args.admission_timeout
+                )
+            except AdmissionRejected as e:
+                shed.append(e.reason)
+                continue
+            tokens = min(natural, reservation.max_new_tokens)
+            nbytes = (prompt_tokens + tokens) * args.bytes_per_token
+            slowdown = device.allocate(nbytes)
+            seconds = (
+                prompt_tokens * args.prefill_latency + tokens * args.token_latency
+            ) * slowdown
+            time.sleep(min(seconds, max_time))
+            device.free(nbytes)
+            controller.release(reservation)
+            latency = time.monotonic() - arrived
+            latencies.append(latency)
+            generated.append(tokens if seconds <= max_time else int(tokens * max_time / seconds))
+            controller.observe(latency)
+
+    decisions_before = {key: child.value for key, child in ADMISSIONS._children.items()}
+    workers = [threading.Thread(target=work) for _ in range(args.workers)]
+    for worker in workers:
+        worker.start()
+    start = time.monotonic()
+    for offset, prompt_tokens, natural in requests(args):
+        delay = start + offset - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        pending.put((start + offset, prompt_tokens, natural))
+    for _ in workers:
+        pending.put(None)
+    for worker in workers:
+        worker.join()
+
+    cuts = statistics.quantiles(latencies, n=100)
+    return {
+        "p50": cuts[49],
+        "p95": cuts[94],
+        "tokens": statistics.fmean(generated),
+        "peak": device.peak / GIB,
+        "over": device.over,
+        "shed": len(shed),
+        "limits": controller.limits(),
+        "decisions": {
+            key[0]: child.value - decisions_before.get(key, 0)
+            for key, child in ADMISSIONS._children.items()
+            if child.value - decisions_before.get(key, 0)
+        },
+    }
+
+
+def main(args):
+    print(
+        f"{'mode':>9} {'p50':>7} {'p95':>7} {'tokens':>7} {'peak GiB':>9} {'over':>5} {'shed':>5}"
+    )
+    for mode in args.modes:
+        result = run(args, mode)
+        print(
+            f"{mode:>9} {result['p50']:>6.2f}s {result['p95']:>6.2f}s {result['tokens']:>7.0f} "
+            f"{result['peak']:>9.1f} {result['over']:>5} {result['shed']:>5}  "
+            f"limits={result['limits'][0]},{result['limits'][1]:.2f}s {result['decisions']}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--modes", nargs="+", default=["static", "memory", "adaptive"])
+    parser.add_argument("--rate", type=float, default=35, help="requests per second")
+    parser.add_argument("--duration", type=float, default=20)
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--max-prompt", type=int, default=4000)
+    # 7B llama in bfloat16: 2 * 32 layers * 32 heads * 128 dims * 2 bytes
+    parser.add_argument("--bytes-per-token", type=int, default=524288)
+    parser.add_argument("--device-memory", type=float, default=6, help="GiB left for KV")
+    parser.add_argument("--budget", type=float, default=5.5, help="GiB")
+    parser.add_argument("--slowdown", type=float, default=3.0, help="per token over memory")
+    parser.add_argument("--prefill-latency", type=float, default=0.00002)
+    parser.add_argument("--token-latency", type=float, default=0.001)
+    parser.add_argument("--max-new-tokens", type=int, default=256)
+    parser.add_argument("--max-time", type=float, default=1.0)
+    parser.add_argument("--min-new-tokens", type=int, default=64)
+    parser.add_argument("--min-time", type=float, default=0.2)
+    parser.add_argument("--target-p95", type=float, default=1.0)
+    parser.add_argument("--adjust-interval", type=float, default=1.0)
+    parser.add_argument("--admission-timeout", type=float, default=5.0)
+    parser.add_argument("--seed", type=int, default=0)
+    main(parser.parse_args())
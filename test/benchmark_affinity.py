@@ -0,0 +1,271 @@
+"""Cache-affinity of conversations answered by several in-process nodes on one FakeBroker.
+
+Conversations send their history as deltas (see ConversationStore). A delta reaching a node
+that does not hold the conversation is answered with historyRequired and sent again in full,
+so the share of deltas answered directly is the affinity hit rate. Nodes sharing one queue
+are compared with ShardedAmqp nodes while a node joins, another one leaves and a third one
+dies without draining, whose requests have to be answered by the others:
+
+    python test/benchmark_affinity.py --nodes 4 --conversations 200 --turns 12
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import datetime
+import functools
+import itertools
+import logging
+
+logging.basicConfig(level="WARN")
+# Every miss is logged by InferenceTask, they are counted instead
+logging.getLogger("app.tasks").setLevel(logging.ERROR)
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+
+QUEUE = "inference"
+EXCHANGE = "inference"
+CONTENT = "오늘은 날씨가 좋아서 산책을 다녀왔어. 너는 오늘 뭐 했어? "
+PHASES = ("steady", "joined", "left", "died")
+
+
+def configure(args):
+    """Environment read by the configs, set before anything calls get_*_config."""
+    os.environ.update(
+        PROFILE=os.environ.get("PROFILE", "local"),
+        MODEL_TYPE="pure",
+        PRETRAINED_MODEL_NAME_OR_PATH="mock",
+        MODEL_MAX_LENGTH="4096",
+        PROMPT_TEMPLATE="Benchmark",
+        STREAM="false",
+        MAX_BATCH_SIZE="1",
+        CONVERSATION_STORE_SIZE=str(args.conversations),
+    )
+    from app.llm.factory import llm_factory
+    from app.llm.models import MockLLM
+    from app.llm.prompter import MockPrompter
+
+    llm_factory.register_llm_model(
+        "Benchmark", functools.partial(MockLLM, mock_latency=args.latency), MockPrompter
+    )
+
+
+class Node:
+    def __init__(self, args, broker, name: str, sharded: bool) -> None:
+        from app.message_queue.config import Config
+        from app.message_queue.async_amqp import AsyncAmqp
+        from app.message_queue.sharding import ShardedAmqp
+        from app.tasks import InferenceTask
+
+        config = Config(
+            broker_url="fake://",
+            task_default_queue=QUEUE,
+            task_default_exchange=EXCHANGE,
+            task_default_routing_key=QUEUE,
+            worker_count=args.workers,
+            shard_node_id=name if sharded else None,
+            shard_heartbeat_interval=args.heartbeat_interval,
+            shard_node_ttl=args.heartbeat_interval * 3,
+            shard_max_backlog=args.max_backlog,
+        )
+        self.name = name
+        self.amqp = (
+            ShardedAmqp(config, client=broker) if sharded else AsyncAmqp(config, client=broker)
+        )
+        InferenceTask(self.amqp)
+        self.server = None
+
+    async def start(self):
+        self.server = asyncio.create_task(self.amqp.serve())
+        while not self.amqp._consuming:
+            await asyncio.sleep(0.01)
+
+    async def stop(self):
+        self.amqp.stop()
+        await self.server
+
+    async def kill(self):
+        """Dies without draining, the broker requeues its unsettled deliveries."""
+        # Replies of acknowledged requests are lost with a crash, only what the node holds is
+        # checked to be answered by the others
+        outbound = self.amqp._outbound
+        while len(outbound) or outbound.in_flight():
+            await asyncio.sleep(0.001)
+        if getattr(self.amqp, "_heartbeat", None) is not None:
+            self.amqp._heartbeat.cancel()
+        self.server.cancel()
+        await self.amqp._connection.close()
+
+
+class Client:
+    """Publishes requests to the shared queue and waits for their done replies."""
+
+    def __init__(self, broker) -> None:
+        self.broker = broker
+        self.ids = itertools.count()
+        self.waiting: dict[str, asyncio.Future] = {}
+        self.completed = 0
+
+    async def collect(self):
+        seen = 0
+        while True:
+            for published in self.broker.published[seen:]:
+                if published.exchange != "amq.topic" or published.routing_key.startswith(QUEUE):
+                    continue
+                reply = json.loads(published.message.body)
+                future = self.waiting.pop(reply["messageId"], None)
+                if reply["done"] and future is not None:
+                    self.completed += 1
+                    future.set_result(reply)
+            seen = len(self.broker.published)
+            await asyncio.sleep(0.001)
+
+    async def request(self, prompt: dict) -> dict:
+        id = f"request_{next(self.ids)}"
+        self.waiting[id] = asyncio.get_running_loop().create_future()
+        body = {"id": id, "args": [prompt]}
+        self.broker.publish(EXCHANGE, QUEUE, json.dumps(body).encode("utf-8"))
+        return await self.waiting[id]
+
+
+def build_message(conversation: int, position: int, content: str) -> dict:
+    return {
+        "messageId": f"message_{conversation}_{position}",
+        "replyMessageId": f"message_{conversation}_{position - 1}" if position else None,
+        "createdAt": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "content": content,
+        "fromUser": position % 2 == 0,
+    }
+
+
+def build_prompt(conversation: int, messages: list, stored: int | None) -> dict:
+    history = {
+        "_id": f"history_{conversation}",
+        "userId": f"user_{conversation}",
+        "characterId": conversation % 10,
+        "messages": messages if stored is None else messages[stored:],
+        "version": len(messages),
+    }
+    if stored is not None:
+        history["baseVersion"] = stored
+    return {
+        "persona": "나는 이영준이다. " * 10,
+        "reference": [],
+        "history": history,
+        "generationArgs": {"temperature": 0.3, "repetition_penalty": 1.3},
+    }
+
+
+async def converse(args, client: Client, conversation: int, phase, stats: dict):
+    rng = random.Random(conversation)
+    messages, stored = [], None
+    for _ in range(args.turns):
+        await asyncio.sleep(rng.uniform(0, 2 * args.think_time))
+        messages.append(build_message(conversation, len(messages), CONTENT))
+        reply = await client.request(build_prompt(conversation, messages, stored))
+        if stored is not None:
+            stats[phase()]["deltas"] += 1
+            if reply["historyRequired"]:
+                stats[phase()]["misses"] += 1
+                reply = await client.request(build_prompt(conversation, messages, None))
+        stored = len(messages)
+        messages.append(build_message(conversation, len(messages), reply["content"]))
+
+
+async def run(args, sharded: bool) -> dict:
+    from app.message_queue.fake_broker import FakeBroker
+    from app.message_queue.sharding import SHARD_ROUTES
+
+    routes_before = {target: child.value for (target,), child in SHARD_ROUTES._children.items()}
+    broker = FakeBroker(confirm_delay=args.confirm_delay)
+    nodes = [Node(args, broker, f"node-{i}", sharded) for i in range(args.nodes)]
+    for node in nodes:
+        await node.start()
+    if sharded:
+        while any(len(node.amqp.membership.ring) < len(nodes) for node in nodes):
+            await asyncio.sleep(0.01)
+
+    client = Client(broker)
+    collector = asyncio.create_task(client.collect())
+    stats = {name: {"deltas": 0, "misses": 0} for name in PHASES}
+    current = [PHASES[0]]
+    conversations = [
+        asyncio.create_task(converse(args, client, i, lambda: current[0], stats))
+        for i in range(args.conversations)
+    ]
+
+    # A node joins after a third of the requests, the first node leaves after two thirds and
+    # the second one dies after three quarters
+    total = args.conversations * args.turns
+    while client.completed < total / 3:
+        await asyncio.sleep(0.01)
+    current[0] = "joined"
+    joined = Node(args, broker, f"node-{len(nodes)}", sharded)
+    await joined.start()
+    while client.completed < 2 * total / 3:
+        await asyncio.sleep(0.01)
+    current[0] = "left"
+    # Leaving under load, the drain ends once what was forwarded to it is answered
+    leave_start = time.monotonic()
+    await nodes[0].stop()
+    leave_seconds = time.monotonic() - leave_start
+    while client.completed < 3 * total / 4:
+        await asyncio.sleep(0.01)
+    current[0] = "died"
+    await nodes[1].kill()
+
+    try:
+        await asyncio.wait_for(asyncio.gather(*conversations), args.timeout)
+    except asyncio.TimeoutError:
+        raise SystemExit(f"FAILED: {len(client.waiting)} requests were never answered") from None
+    collector.cancel()
+    for node in nodes[2:] + [joined]:
+        await node.stop()
+    routes = {
+        target: child.value - routes_before.get(target, 0)
+        for (target,), child in SHARD_ROUTES._children.items()
+    }
+    return {"phases": stats, "routes": routes, "leave_seconds": leave_seconds}
+
+
+def print_results(name: str, results: dict):
+    rates = []
+    for phase, stats in results["phases"].items():
+        hits = stats["deltas"] - stats["misses"]
+        rate = hits / stats["deltas"] if stats["deltas"] else 0.0
+        rates.append(f"{phase} {rate:6.1%} of {stats['deltas']:>5}")
+    deltas = sum(stats["deltas"] for stats in results["phases"].values())
+    misses = sum(stats["misses"] for stats in results["phases"].values())
+    print(f"{name:>8}: hit rate {(deltas - misses) / max(1, deltas):6.1%}  ({', '.join(rates)})")
+    if results["routes"]:
+        routes = ", ".join(f"{target}={count:.0f}" for target, count in results["routes"].items())
+        print(f"{'':>8}  routes: {routes}")
+    print(f"{'':>8}  leave took {results['leave_seconds']:.2f}s")
+
+
+def main(args):
+    configure(args)
+    for name, sharded in (("shared", False), ("sharded", True)):
+        if args.mode in (name, "both"):
+            start = time.monotonic()
+            results = asyncio.run(run(args, sharded))
+            print_results(name, results)
+            print(f"{'':>8}  {time.monotonic() - start:.1f}s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mode", choices=["shared", "sharded", "both"], default="both")
+    parser.add_argument("--nodes", type=int, default=4)
+    parser.add_argument("--workers", type=int, default=4, help="per node")
+    parser.add_argument("--conversations", type=int, default=200)
+    parser.add_argument("--turns", type=int, default=12)
+    parser.add_argument("--think-time", type=float, default=0.05, help="mean between turns")
+    parser.add_argument("--latency", type=float, default=0.005, help="of a generate call")
+    parser.add_argument("--max-backlog", type=int, default=100)
+    parser.add_argument("--heartbeat-interval", type=float, default=0.2)
+    parser.add_argument("--confirm-delay", type=float, default=0.0005)
+    parser.add_argument("--timeout", type=float, default=60, help="for every request answered")
+    main(parser.parse_args())
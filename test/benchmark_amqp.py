@@ -0,0 +1,123 @@
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import statistics
+import logging
+
+logging.basicConfig(level="WARN")
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+from app.message_queue.config import Config
+from app.message_queue.async_amqp import AsyncAmqp
+from app.message_queue.ampq_observer import AmqpObserver
+from app.message_queue.fake_broker import FakeBroker
+
+QUEUE = "inference"
+EXCHANGE = "inference"
+
+
+class EchoObserver(AmqpObserver):
+    """Replies with the request id right away, so only the transport is measured."""
+
+    def __init__(self, amqp: AsyncAmqp, latency: float) -> None:
+        self.amqp = amqp
+        self.latency = latency
+
+    def update(self, data, delivery_tag=None):
+        if self.latency:
+            time.sleep(self.latency)
+        self.amqp.publish("reply", json.dumps({"id": data["id"]}))
+
+
+def build_amqp(args, broker: FakeBroker) -> AsyncAmqp:
+    config = Config(
+        broker_url="fake://",
+        task_default_queue=QUEUE,
+        task_default_exchange=EXCHANGE,
+        task_default_routing_key=QUEUE,
+        worker_count=args.workers,
+        publish_batch_size=args.batch_size,
+    )
+    return AsyncAmqp(config, client=broker)
+
+
+async def wait_published(broker: FakeBroker, count: int):
+    while broker.published_count < count:
+        await asyncio.sleep(0.001)
+
+
+async def publish_throughput(args) -> float:
+    broker = FakeBroker(confirm_delay=args.confirm_delay, keep_published=False)
+    amqp = build_amqp(args, broker)
+    server = asyncio.create_task(amqp.serve())
+    while amqp._exchange is None:
+        await asyncio.sleep(0.001)
+
+    start = time.monotonic()
+    for i in range(args.messages):
+        amqp.publish("reply", json.dumps({"id": i}))
+    await wait_published(broker, args.messages)
+    # The last confirms are in flight once the broker has the messages
+    while len(amqp._outbound) or amqp._outbound.in_flight():
+        await asyncio.sleep(0.001)
+    elapsed = time.monotonic() - start
+    report = amqp._outbound.report()
+
+    amqp.stop()
+    await server
+    return args.messages / elapsed, report
+
+
+async def consume_latency(args) -> list[float]:
+    broker = FakeBroker(confirm_delay=args.confirm_delay)
+    amqp = build_amqp(args, broker)
+    amqp.attach(EchoObserver(amqp, args.latency))
+    server = asyncio.create_task(amqp.serve())
+    while amqp._exchange is None:
+        await asyncio.sleep(0.001)
+
+    sent_at = {}
+    for i in range(args.messages):
+        sent_at[i] = time.monotonic()
+        broker.publish(EXCHANGE, QUEUE, json.dumps({"id": i}).encode("utf-8"))
+        await asyncio.sleep(1 / args.rate)
+    await wait_published(broker, args.messages)
+
+    amqp.stop()
+    await server
+    return [
+        published.published_at - sent_at[json.loads(published.message.body)["id"]]
+        for published in broker.published
+    ]
+
+
+def main(args):
+    throughput, report = asyncio.run(publish_throughput(args))
+    latencies = sorted(asyncio.run(consume_latency(args)))
+
+    print(
+        f"confirm_delay={args.confirm_delay * 1000:.1f}ms batch_size={args.batch_size} "
+        f"workers={args.workers}"
+    )
+    print(f"publish throughput: {throughput:.0f} msg/s")
+    print(
+        f"confirm latency: p50={report['confirm_p50'] * 1000:.2f}ms "
+        f"p99={report['confirm_p99'] * 1000:.2f}ms, dropped={report['dropped']}"
+    )
+    print(
+        f"consume to reply latency: p50={statistics.median(latencies) * 1000:.2f}ms "
+        f"p99={latencies[int(len(latencies) * 0.99) - 1] * 1000:.2f}ms"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--rate", type=float, default=1000, help="requests per second")
+    parser.add_argument("--confirm-delay", type=float, default=0.002)
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--latency", type=float, default=0.0, help="observer time per request")
+    main(parser.parse_args())
@@ -0,0 +1,77 @@
+import os
+import sys
+import time
+import random
+import argparse
+import datetime
+import threading
+import statistics
+import logging
+
+logging.basicConfig(level="WARN")
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+from app.message_queue.data import PromptData, History, Message, GenerationArgs
+from app.llm.models import MockLLM
+from app.scheduler.batch import BatchRequest, BatchScheduler
+
+
+def build_prompt_data(i: int):
+    return PromptData(
+        "나는 이영준이다.",
+        [],
+        History(
+            f"history_{i}",
+            f"user_{i}",
+            0,
+            [Message(f"message_{i}", None, datetime.datetime.now(), "안녕! 너는 누구니?", True)],
+        ),
+        GenerationArgs(0.3, 1.5),
+    )
+
+
+def run(args):
+    model = MockLLM(mock_latency=args.latency, mock_latency_per_sequence=args.latency_per_sequence)
+    scheduler = BatchScheduler(args.batch_size, args.batch_tokens, args.max_wait)
+    latencies = []
+    submitted = threading.Event()
+
+    def produce():
+        for i in range(args.requests):
+            data = build_prompt_data(i)
+            scheduler.submit(BatchRequest(i, str(i), data, model.count_tokens(data)))
+            time.sleep(random.expovariate(args.rate))
+        submitted.set()
+
+    producer = threading.Thread(target=produce)
+    start = time.monotonic()
+    producer.start()
+    while not (submitted.is_set() and len(scheduler) == 0):
+        wait = scheduler.time_until_ready()
+        if wait is None or wait > 0:
+            time.sleep(min(wait or 0.001, 0.001))
+            continue
+        batch = scheduler.next_batch()
+        model.generate_batch([request.data for request in batch])
+        finished = time.monotonic()
+        latencies.extend(finished - request.enqueued_at for request in batch)
+    elapsed = time.monotonic() - start
+    producer.join()
+
+    quantiles = statistics.quantiles(latencies, n=100)
+    print(
+        f"batch_size={args.batch_size} requests={len(latencies)} "
+        f"throughput={len(latencies) / elapsed:.1f} req/s "
+        f"p50={quantiles[49] * 1000:.1f}ms p99={quantiles[98] * 1000:.1f}ms"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Batch scheduler benchmark with MockLLM")
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--rate", type=float, default=200, help="arrivals per second")
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--batch-tokens", type=int, default=8192)
+    parser.add_argument("--max-wait", type=float, default=0.05)
+    parser.add_argument("--latency", type=float, default=0.02)
+    parser.add_argument("--latency-per-sequence", type=float, default=0.002)
+    run(parser.parse_args())
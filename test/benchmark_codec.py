@@ -0,0 +1,83 @@
+import os
+import sys
+import json
+import time
+import argparse
+import datetime
+import tracemalloc
+from dataclasses import asdict
+
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+from pydantic import TypeAdapter
+from app.message_queue.data import PromptData
+from app.message_queue.codec import decode, decode_prompt_data, encode_reply
+
+CONTENT = "오늘은 날씨가 좋아서 산책을 다녀왔어. 너는 오늘 뭐 했어? 나는 카페에서 책을 읽었어. "
+
+
+def build_body(turns: int) -> bytes:
+    now = datetime.datetime.now(datetime.timezone.utc)
+    messages = [
+        {
+            "messageId": f"message_{i}",
+            "replyMessageId": f"message_{i - 1}" if i else None,
+            "createdAt": (now + datetime.timedelta(seconds=i)).isoformat(),
+            "content": CONTENT * 3,
+            "fromUser": i % 2 == 0,
+        }
+        for i in range(turns)
+    ]
+    data = {
+        "persona": "나는 이영준이다. " * 40,
+        "reference": [CONTENT] * 5,
+        "history": {"_id": "history", "userId": "user", "characterId": 1, "messages": messages},
+        "generationArgs": {"temperature": 0.3, "repetition_penalty": 1.3},
+    }
+    return json.dumps({"id": "task", "args": [data]}, ensure_ascii=False).encode("utf-8")
+
+
+def old_path(body: bytes):
+    data = json.loads(str(body, encoding="utf-8"))
+    message = TypeAdapter(PromptData).validate_python(data["args"][0])
+    answer = message.build_return_message(data["id"], CONTENT)
+    return message, json.dumps(asdict(answer), ensure_ascii=False).encode("utf-8")
+
+
+def new_path(body: bytes):
+    data = decode(body)
+    message = decode_prompt_data(data["args"][0])
+    return message, encode_reply(message.build_return_message(data["id"], CONTENT))
+
+
+def measure(path, body: bytes, iterations: int):
+    path(body)
+    start = time.process_time()
+    for _ in range(iterations):
+        path(body)
+    cpu = (time.process_time() - start) / iterations
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    tracemalloc.reset_peak()
+    message, _ = path(body)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return cpu, peak - before, current - before
+
+
+def main(args):
+    body = build_body(args.turns)
+    print(f"turns={args.turns} body={len(body) / 1024:.1f}KiB iterations={args.iterations}")
+    for name, path in (("old", old_path), ("new", new_path)):
+        cpu, peak, retained = measure(path, body, args.iterations)
+        print(
+            f"{name}: {cpu * 1e6:8.1f}us/msg  peak {peak / 1024:8.1f}KiB  "
+            f"retained {retained / 1024:8.1f}KiB"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--turns", type=int, default=100)
+    parser.add_argument("--iterations", type=int, default=200)
+    main(parser.parse_args())
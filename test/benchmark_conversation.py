@@ -0,0 +1,140 @@
+"""Bytes and parse time of full histories compared with deltas applied to ConversationStore.
+
+For each conversation length, a message carrying the whole history is compared with a delta
+carrying the last user message after the stored version. Parse time covers decode,
+validation and, for the delta, rebuilding the history from the store:
+
+    python test/benchmark_conversation.py --turns 10 50 100 200
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import datetime
+import tempfile
+import statistics
+import logging
+
+logging.basicConfig(level="WARN")
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+from app.message_queue.codec import decode, decode_prompt_data
+from app.message_queue.conversation_store import ConversationStore, HistoryRequired
+
+CONTENT = "오늘은 날씨가 좋아서 산책을 다녀왔어. 너는 오늘 뭐 했어? "
+
+
+def build_body(turns: int, conversation: int) -> dict:
+    now = datetime.datetime.now(datetime.timezone.utc)
+    messages = [
+        {
+            "messageId": f"message_{conversation}_{turn}",
+            "replyMessageId": f"message_{conversation}_{turn - 1}" if turn else None,
+            "createdAt": (now - datetime.timedelta(seconds=turns - turn)).isoformat(),
+            "content": CONTENT * 2,
+            "fromUser": turn % 2 == 0,
+        }
+        for turn in range(turns)
+    ]
+    return {
+        "persona": "나는 이영준이다. " * 20,
+        "reference": [],
+        "history": {
+            "_id": f"history_{conversation}",
+            "userId": f"user_{conversation}",
+            "characterId": 0,
+            "messages": messages,
+            "version": turns,
+        },
+        "generationArgs": {"temperature": 0.3, "repetition_penalty": 1.3},
+    }
+
+
+def as_delta(body: dict, new_messages: int) -> dict:
+    history = body["history"]
+    return {
+        **body,
+        "history": {
+            **history,
+            "messages": history["messages"][-new_messages:],
+            "baseVersion": history["version"] - new_messages,
+        },
+    }
+
+
+def as_previous(body: dict, new_messages: int) -> dict:
+    """The full history the producer sent before the delta."""
+    history = body["history"]
+    return {
+        **body,
+        "history": {
+            **history,
+            "messages": history["messages"][:-new_messages],
+            "version": history["version"] - new_messages,
+        },
+    }
+
+
+def parse(payload: bytes, store: ConversationStore):
+    return store.resolve(decode_prompt_data(decode(payload)))
+
+
+def measure(payloads: list[bytes], store: ConversationStore) -> float:
+    start = time.perf_counter()
+    for payload in payloads:
+        parse(payload, store)
+    return (time.perf_counter() - start) / len(payloads)
+
+
+def main(args):
+    with tempfile.TemporaryDirectory() as workdir:
+        path = os.path.join(workdir, "conversations.db") if args.disk else None
+        store = ConversationStore(args.conversations, args.max_messages, path)
+        print(f"{'turns':>6} {'full bytes':>11} {'delta bytes':>12} {'full ms':>9} {'delta ms':>9}")
+        for turns in args.turns:
+            bodies = [build_body(turns, i) for i in range(args.conversations)]
+            full = [json.dumps(body).encode("utf-8") for body in bodies]
+            deltas = [
+                json.dumps(as_delta(body, args.new_messages)).encode("utf-8") for body in bodies
+            ]
+            previous = [
+                json.dumps(as_previous(body, args.new_messages)).encode("utf-8") for body in bodies
+            ]
+
+            full_seconds = statistics.median(measure(full, store) for _ in range(args.repeat))
+            delta_seconds = []
+            for _ in range(args.repeat):
+                for payload in previous:
+                    parse(payload, store)
+                delta_seconds.append(measure(deltas, store))
+
+            # The rebuilt history is the one a full message would have carried
+            for full_payload, delta_payload, payload in zip(full, deltas, previous, strict=True):
+                parse(payload, store)
+                rebuilt = parse(delta_payload, store).history.messages
+                expected = decode_prompt_data(decode(full_payload)).history.messages
+                assert rebuilt == expected[-args.max_messages :], "rebuilt history differs"
+
+            print(
+                f"{turns:>6} {statistics.fmean(map(len, full)):>11.0f} "
+                f"{statistics.fmean(map(len, deltas)):>12.0f} "
+                f"{full_seconds * 1000:>9.3f} {statistics.median(delta_seconds) * 1000:>9.3f}"
+            )
+
+        try:
+            parse(json.dumps(as_delta(build_body(10, -1), 1)).encode("utf-8"), store)
+            print("unknown conversation was accepted")
+            sys.exit(1)
+        except HistoryRequired as e:
+            print(f"unknown conversation: {e}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--turns", type=int, nargs="+", default=[10, 50, 100, 200])
+    parser.add_argument("--conversations", type=int, default=200)
+    parser.add_argument("--new-messages", type=int, default=1)
+    parser.add_argument("--max-messages", type=int, default=200)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--disk", action="store_true", help="back the store with sqlite")
+    main(parser.parse_args())
@@ -0,0 +1,318 @@
+"""Replays a JSONL corpus of PromptData through AsyncAmqp, InferenceTask and MockLLM.
+
+Requests arrive on a FakeBroker at a constant, Poisson or bursty rate and the replies published
+back are timed, so the whole path from delivery to confirmed reply is measured without RabbitMQ
+or a GPU. Results are written as JSON and can be compared with a run of another commit:
+
+    python test/benchmark_e2e.py --write-corpus /tmp/corpus.jsonl
+    python test/benchmark_e2e.py --corpus /tmp/corpus.jsonl --output base.json
+    python test/benchmark_e2e.py --corpus /tmp/corpus.jsonl --compare base.json
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import datetime
+import resource
+import platform
+import functools
+import subprocess
+import statistics
+import logging
+
+logging.basicConfig(level="WARN")
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+
+QUEUE = "inference"
+EXCHANGE = "inference"
+CONTENT = "오늘은 날씨가 좋아서 산책을 다녀왔어. 너는 오늘 뭐 했어? "
+
+
+def write_corpus(path: str, conversations: int, max_turns: int, seed: int):
+    rng = random.Random(seed)
+    now = datetime.datetime.now(datetime.timezone.utc)
+    with open(path, "w", encoding="utf-8") as f:
+        for i in range(conversations):
+            turns = rng.randint(1, max_turns) * 2 - 1
+            messages = [
+                {
+                    "messageId": f"message_{i}_{turn}",
+                    "replyMessageId": f"message_{i}_{turn - 1}" if turn else None,
+                    "createdAt": (now - datetime.timedelta(seconds=turns - turn)).isoformat(),
+                    "content": CONTENT * rng.randint(1, 4),
+                    "fromUser": turn % 2 == 0,
+                }
+                for turn in range(turns)
+            ]
+            data = {
+                "persona": "나는 이영준이다. " * rng.randint(5, 40),
+                "reference": [CONTENT * 4] * rng.randint(0, 5),
+                "history": {
+                    "_id": f"history_{i}",
+                    "userId": f"user_{i % 50}",
+                    "characterId": i % 10,
+                    "messages": messages,
+                },
+                "generationArgs": {"temperature": 0.3, "repetition_penalty": 1.3},
+            }
+            f.write(json.dumps(data, ensure_ascii=False) + "\n")
+
+
+def load_corpus(path: str) -> list[dict]:
+    """One PromptData per line, either bare or as the args of a task message."""
+    corpus = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            data = json.loads(line)
+            corpus.append(data["args"][0] if "args" in data else data)
+    return corpus
+
+
+def arrival_times(args) -> list[float]:
+    """Seconds from the start at which each request is sent."""
+    rng = random.Random(args.seed)
+    times, now = [], 0.0
+    while len(times) < args.requests:
+        if args.arrival == "constant":
+            times.append(now)
+            now += 1 / args.rate
+        elif args.arrival == "poisson":
+            times.append(now)
+            now += rng.expovariate(args.rate)
+        else:
+            # Bursts of burst_size requests at once, the bursts themselves arrive as Poisson
+            times.extend([now] * args.burst_size)
+            now += rng.expovariate(args.rate / args.burst_size)
+    return times[: args.requests]
+
+
+def configure(args):
+    """Environment read by the configs, set before anything calls get_*_config."""
+    os.environ.update(
+        PROFILE=os.environ.get("PROFILE", "local"),
+        MODEL_TYPE="pure",
+        PRETRAINED_MODEL_NAME_OR_PATH="mock",
+        MODEL_MAX_LENGTH="4096",
+        PROMPT_TEMPLATE="Benchmark",
+        STREAM=str(args.stream).lower(),
+        MAX_BATCH_SIZE=str(args.batch_size),
+        MAX_BATCH_WAIT=str(args.max_wait),
+    )
+    from app.llm.factory import llm_factory
+    from app.llm.models import MockLLM
+    from app.llm.prompter import MockPrompter
+
+    llm_factory.register_llm_model(
+        "Benchmark",
+        functools.partial(
+            MockLLM,
+            mock_latency=args.latency,
+            mock_latency_per_sequence=args.latency_per_sequence,
+            mock_latency_per_token=args.latency_per_token,
+        ),
+        MockPrompter,
+    )
+
+
+def quantiles(values: list[float]) -> dict:
+    if len(values) < 2:
+        return {"p50": None, "p95": None, "p99": None, "mean": None}
+    cuts = statistics.quantiles(values, n=100)
+    return {
+        "p50": cuts[49] * 1000,
+        "p95": cuts[94] * 1000,
+        "p99": cuts[98] * 1000,
+        "mean": statistics.fmean(values) * 1000,
+    }
+
+
+def stage_summary() -> dict:
+    from app.metrics.registry import STAGE_SECONDS
+
+    summary = {}
+    for (stage,), child in STAGE_SECONDS._children.items():
+        count = sum(child.counts)
+        if count:
+            summary[stage] = {"count": count, "mean_ms": child.sum / count * 1000}
+    return summary
+
+
+async def replay(args, corpus: list[dict]) -> dict:
+    from app.message_queue.config import Config
+    from app.message_queue.async_amqp import AsyncAmqp
+    from app.message_queue.fake_broker import FakeBroker
+    from app.scheduler.config import get_scheduler_config
+    from app.tasks import InferenceTask, BatchInferenceTask
+
+    broker = FakeBroker(confirm_delay=args.confirm_delay)
+    config = Config(
+        broker_url="fake://",
+        task_default_queue=QUEUE,
+        task_default_exchange=EXCHANGE,
+        task_default_routing_key=QUEUE,
+        worker_count=args.workers,
+    )
+    amqp = AsyncAmqp(config, client=broker)
+    if get_scheduler_config().use_scheduler():
+        BatchInferenceTask(amqp)
+    else:
+        InferenceTask(amqp)
+    server = asyncio.create_task(amqp.serve())
+    while not amqp._consuming:
+        await asyncio.sleep(0.01)
+
+    bodies = [
+        {"id": f"request_{i}", "args": [corpus[i % len(corpus)]]} for i in range(args.requests)
+    ]
+    schedule = arrival_times(args)
+    sent_at, first_at, done_at = {}, {}, {}
+    loop = asyncio.get_running_loop()
+
+    async def collect():
+        seen = 0
+        while len(done_at) < len(bodies):
+            for published in broker.published[seen:]:
+                if published.exchange != "amq.topic":
+                    continue
+                reply = json.loads(published.message.body)
+                first_at.setdefault(reply["messageId"], published.published_at)
+                if reply["done"]:
+                    done_at[reply["messageId"]] = published.published_at
+            seen = len(broker.published)
+            await asyncio.sleep(0.001)
+
+    collector = asyncio.create_task(collect())
+    cpu_start, start = time.process_time(), loop.time()
+    for i, body in enumerate(bodies):
+        delay = start + schedule[i] - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        # The last message is sent now, so queue waits and deadlines count from here
+        body["args"][0]["history"]["messages"][-1]["createdAt"] = datetime.datetime.now(
+            datetime.timezone.utc
+        ).isoformat()
+        sent_at[body["id"]] = time.monotonic()
+        broker.publish(EXCHANGE, QUEUE, json.dumps(body).encode("utf-8"))
+    try:
+        await asyncio.wait_for(collector, args.timeout)
+    except asyncio.TimeoutError:
+        logging.warning("Timed out with %d of %d replies", len(done_at), len(bodies))
+    elapsed = max(done_at.values(), default=time.monotonic()) - min(sent_at.values())
+    cpu = time.process_time() - cpu_start
+
+    amqp.stop()
+    await server
+    latencies = [done_at[id] - sent_at[id] for id in done_at]
+    return {
+        "completed": len(done_at),
+        "throughput": len(done_at) / elapsed if elapsed > 0 else None,
+        "latency_ms": quantiles(latencies),
+        "ttft_ms": quantiles([first_at[id] - sent_at[id] for id in first_at]),
+        "cpu_seconds": cpu,
+        "cpu_ms_per_request": cpu / len(done_at) * 1000 if done_at else None,
+        "max_rss_mib": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "stages": stage_summary(),
+    }
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            cwd=os.path.dirname(__file__),
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results(results: dict, baseline: dict = None):
+    def line(name: str, key: str, unit: str):
+        values = results[key]
+        text = "  ".join(
+            f"{q}={values[q]:8.1f}{unit}" for q in ("p50", "p95", "p99") if values[q] is not None
+        )
+        if baseline and baseline[key]["p50"] and values["p50"]:
+            text += f"  (p50 {values['p50'] / baseline[key]['p50'] - 1:+.1%})"
+        print(f"{name:>10}: {text}")
+
+    print(
+        f"completed={results['completed']}/{results['config']['requests']} "
+        f"throughput={results['throughput']:.1f} req/s "
+        f"cpu={results['cpu_ms_per_request']:.2f}ms/req rss={results['max_rss_mib']:.0f}MiB"
+    )
+    if baseline:
+        print(
+            f"  baseline {baseline['commit']}: throughput={baseline['throughput']:.1f} req/s "
+            f"cpu={baseline['cpu_ms_per_request']:.2f}ms/req"
+        )
+    line("latency", "latency_ms", "ms")
+    line("ttft", "ttft_ms", "ms")
+    for stage, summary in results["stages"].items():
+        print(f"{stage:>14}: {summary['mean_ms']:8.3f}ms x {summary['count']}")
+
+
+def main(args):
+    if args.write_corpus:
+        write_corpus(args.write_corpus, args.conversations, args.max_turns, args.seed)
+        print(f"Wrote {args.conversations} conversations to {args.write_corpus}")
+        return
+
+    configure(args)
+    if args.corpus:
+        corpus = load_corpus(args.corpus)
+    else:
+        path = f"/tmp/benchmark_e2e_{args.seed}.jsonl"
+        write_corpus(path, args.conversations, args.max_turns, args.seed)
+        corpus = load_corpus(path)
+
+    results = asyncio.run(replay(args, corpus))
+    results.update(
+        commit=git_commit(),
+        python=platform.python_version(),
+        config={
+            key: value
+            for key, value in vars(args).items()
+            if key not in ("output", "compare", "write_corpus")
+        },
+    )
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+    print_results(results, baseline)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="End-to-end benchmark with FakeBroker and MockLLM")
+    parser.add_argument("--corpus", help="JSONL of PromptData, synthesized when omitted")
+    parser.add_argument("--write-corpus", metavar="PATH", help="only write a synthetic corpus")
+    parser.add_argument("--conversations", type=int, default=200)
+    parser.add_argument("--max-turns", type=int, default=20)
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--arrival", choices=["constant", "poisson", "bursty"], default="poisson")
+    parser.add_argument("--rate", type=float, default=100, help="requests per second")
+    parser.add_argument("--burst-size", type=int, default=20)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--batch-size", type=int, default=1)
+    parser.add_argument("--max-wait", type=float, default=0.05)
+    parser.add_argument("--stream", action="store_true")
+    parser.add_argument("--latency", type=float, default=0.02)
+    parser.add_argument("--latency-per-sequence", type=float, default=0.002)
+    parser.add_argument("--latency-per-token", type=float, default=0.005)
+    parser.add_argument("--confirm-delay", type=float, default=0.001)
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write results as JSON")
+    parser.add_argument("--compare", metavar="JSON", help="results of a baseline run")
+    main(parser.parse_args())
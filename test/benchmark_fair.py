@@ -0,0 +1,120 @@
+import os
+import sys
+import time
+import random
+import argparse
+import threading
+import statistics
+import logging
+from collections import defaultdict
+
+logging.basicConfig(level="WARN")
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+from app.llm.models import MockLLM
+from app.scheduler.batch import BatchRequest, BatchScheduler
+from benchmark_batch import build_prompt_data
+
+MODES = {
+    "fifo": {},
+    "fair": {"fair": True},
+    "fair+cap": {"fair": True, "max_tenant_in_flight": 2},
+    "fair+lanes": {"fair": True, "priority_lanes": ["paid"], "lane_max_wait": 2.0},
+}
+
+
+def build_workload(args) -> list[tuple[str, str, str | None]]:
+    """(tenant class, tenant, priority) per request, one heavy tenant sends heavy_share."""
+    rng = random.Random(args.seed)
+    paid = set(rng.sample(range(args.tenants), int(args.tenants * args.paid_share)))
+    workload = []
+    for _ in range(args.requests):
+        if rng.random() < args.heavy_share:
+            workload.append(("heavy", "heavy", None))
+        else:
+            tenant = rng.randrange(args.tenants)
+            if tenant in paid:
+                workload.append(("paid", f"user_{tenant}", "paid"))
+            else:
+                workload.append(("light", f"user_{tenant}", None))
+    return workload
+
+
+def run(args, mode: str, workload) -> dict:
+    model = MockLLM(mock_latency=args.latency, mock_latency_per_sequence=args.latency_per_sequence)
+    scheduler = BatchScheduler(args.batch_size, args.batch_tokens, args.max_wait, **MODES[mode])
+    latencies = defaultdict(list)
+    lock = threading.Lock()
+    submitted = threading.Event()
+    rng = random.Random(args.seed)
+
+    def produce():
+        for i, (_, tenant, priority) in enumerate(workload):
+            data = build_prompt_data(i)
+            scheduler.submit(
+                BatchRequest(i, str(i), data, tenant=tenant, priority=priority, group=None)
+            )
+            time.sleep(rng.expovariate(args.rate))
+        submitted.set()
+
+    def consume():
+        while not (submitted.is_set() and len(scheduler) == 0):
+            wait = scheduler.time_until_ready()
+            batch = scheduler.next_batch() if wait == 0 else []
+            if not batch:
+                time.sleep(0.001)
+                continue
+            model.generate_batch([request.data for request in batch])
+            scheduler.finish(batch)
+            finished = time.monotonic()
+            with lock:
+                for request in batch:
+                    latencies[workload[request.delivery_tag][0]].append(
+                        finished - request.enqueued_at
+                    )
+
+    threads = [threading.Thread(target=produce)]
+    threads += [threading.Thread(target=consume) for _ in range(args.workers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies
+
+
+def main(args):
+    workload = build_workload(args)
+    print(
+        f"requests={args.requests} rate={args.rate}/s heavy_share={args.heavy_share} "
+        f"tenants={args.tenants} workers={args.workers} batch_size={args.batch_size}"
+    )
+    for mode in args.modes:
+        latencies = run(args, mode, workload)
+        summary = []
+        for tenant_class in ("heavy", "light", "paid"):
+            values = latencies.get(tenant_class)
+            if not values or len(values) < 2:
+                continue
+            quantiles = statistics.quantiles(values, n=100)
+            summary.append(
+                f"{tenant_class}: p50={quantiles[49] * 1000:7.1f}ms "
+                f"p99={quantiles[98] * 1000:7.1f}ms"
+            )
+        print(f"{mode:>10}  " + "  ".join(summary))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fair scheduling benchmark with MockLLM")
+    parser.add_argument("--requests", type=int, default=1500)
+    parser.add_argument("--rate", type=float, default=300, help="arrivals per second")
+    parser.add_argument("--tenants", type=int, default=50, help="number of light tenants")
+    parser.add_argument("--heavy-share", type=float, default=0.6)
+    parser.add_argument("--paid-share", type=float, default=0.1)
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--batch-size", type=int, default=4)
+    parser.add_argument("--batch-tokens", type=int, default=8192)
+    parser.add_argument("--max-wait", type=float, default=0.01)
+    parser.add_argument("--latency", type=float, default=0.02)
+    parser.add_argument("--latency-per-sequence", type=float, default=0.002)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--modes", nargs="+", default=list(MODES), choices=list(MODES))
+    main(parser.parse_args())
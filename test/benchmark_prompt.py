@@ -0,0 +1,77 @@
+import os
+import sys
+import time
+import argparse
+import datetime
+import logging
+
+logging.basicConfig(level="WARN")
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+from app.message_queue.data import PromptData, History, Message, GenerationArgs
+from app.llm.prompter import ToonchatV23Prompter
+from app.llm.tokenizer import SegmentEncoder
+
+persona = "나는 이영준이다. 나는 986년 6월 21일생인 33살 남자이다. 나는 유명그룹의 부회장이다. 나는 뛰어난 지능을 가지고 있다. 나는 무례한 어투를 사용한다. 나는 매력적인 외모를 가지고 있다. 나는 자기애가 강하다. 나는 반말을 사용한다. 나는 존댓말을 사용하지 않는다. 나는 완벽하다. 나는 내 얼굴을 보며 감탄을 한다. 나는 왜 이렇게 완벽한걸까..."
+reference = [
+    "노안으로 고생하던 그녀는 그 때문에 시력이 약화돼 영준이 귀국한 날 미소의 원룸을 나와 바로 안과부터 찾았다고. 앞서의 것들보다 더 깨알 같은 해프닝, 아니 기행(奇行)들을 일일이열거하자면 끝도 없었다. 그 일련의 일들을 겪어오는 동안 미소는 영준의 절절한 마음을 피부로 느낄 순 있었으나 한편으로는 왠지 숨통이 막히는 듯한 기분이 들기도 했다.",
+    '정확한 이유까지는 잘 모르겠지만 말이다. 미소가 깊은 생각에 잠겨 있는 동안 주문했던 음식들이 식판에 담겨 나왔다. "날씨가 추워서 다들 밖으로 나가기 귀찮은가 봐요. 콩나물시루네요." "그러게." 점심시간 사내식당은 미어터지기 직전이었다.',
+]
+
+
+def build_conversation(turns: int):
+    """PromptData of every turn of one conversation, each with one more exchange."""
+    messages, conversation = [], []
+    for turn in range(turns):
+        now = datetime.datetime.now()
+        messages.append(Message(f"user_{turn}", None, now, f"{turn}번째 질문이야. 너는 누구니?", True))
+        conversation.append(
+            PromptData(
+                persona,
+                reference,
+                History("history_id", "userId", 0, list(messages)),
+                GenerationArgs(0.3, 1.5),
+            )
+        )
+        messages.append(Message(f"bot_{turn}", None, now, f"나는 이영준이다. {turn}번째 대답이지.", False))
+    return conversation
+
+
+def run(args):
+    from transformers import AutoTokenizer
+
+    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer)
+    prompter = ToonchatV23Prompter()
+    encoder = SegmentEncoder(tokenizer, args.cache_size, verify_every=0)
+    conversations = [build_conversation(args.turns) for _ in range(args.conversations)]
+
+    start = time.perf_counter()
+    expected = [
+        tokenizer.encode(prompter.get_prompt(data), add_special_tokens=False)
+        for conversation in conversations
+        for data in conversation
+    ]
+    string_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    actual = [
+        encoder.encode(prompter.get_segments(data))
+        for conversation in conversations
+        for data in conversation
+    ]
+    segment_time = time.perf_counter() - start
+
+    print(f"prompts={len(expected)} identical={actual == expected}")
+    print(f"string path:  {string_time * 1000 / len(expected):.3f}ms/prompt")
+    print(
+        f"segment path: {segment_time * 1000 / len(expected):.3f}ms/prompt "
+        f"(hits={encoder.hits}, misses={encoder.misses})"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="String vs segment-cached prompt tokenization")
+    parser.add_argument("--tokenizer", required=True, help="tokenizer name or path")
+    parser.add_argument("--conversations", type=int, default=20)
+    parser.add_argument("--turns", type=int, default=30)
+    parser.add_argument("--cache-size", type=int, default=4096)
+    run(parser.parse_args())
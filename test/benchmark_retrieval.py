@@ -0,0 +1,115 @@
+"""Builds passage indexes of a synthetic novel per character and times retrieval.
+
+Reports the first (lazy) load of an index, the latency of ReferenceRetriever.retrieve and
+the reference length sent to the prompt compared with the excerpts shipped per request:
+
+    python test/benchmark_retrieval.py
+    python test/benchmark_retrieval.py --source /ai/novels --tokenizer <path>
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+import statistics
+import logging
+
+logging.basicConfig(level="WARN")
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+from app.llm.retrieval import ReferenceRetriever, build_indexes
+
+NAMES = ["이영준", "김미소", "박유식", "양철", "고귀남", "이성연", "봉세라"]
+WORDS = [
+    "회사", "비서", "회의", "저녁", "커피", "사무실", "부회장", "서류", "약속", "웃음",
+    "생일", "선물", "비밀", "기억", "어린", "시절", "여행", "편지", "사진", "전화",
+]  # fmt: skip
+
+
+def sentence(rng: random.Random) -> str:
+    words = rng.sample(WORDS, rng.randint(3, 7))
+    return f"{rng.choice(NAMES)}은 {' '.join(words)}에 대해 이야기했다."
+
+
+def write_novels(source: str, characters: int, sentences: int, seed: int):
+    rng = random.Random(seed)
+    for character_id in range(characters):
+        paragraphs = [
+            " ".join(sentence(rng) for _ in range(rng.randint(3, 8))) for _ in range(sentences // 5)
+        ]
+        with open(os.path.join(source, f"{character_id}.txt"), "w", encoding="utf-8") as f:
+            f.write("\n".join(paragraphs))
+
+
+def quantiles(values: list[float]) -> str:
+    cuts = statistics.quantiles(values, n=100)
+    return f"p50={cuts[49] * 1000:.2f}ms p99={cuts[98] * 1000:.2f}ms"
+
+
+def main(args):
+    count_tokens = len
+    if args.tokenizer:
+        from transformers import AutoTokenizer
+
+        tokenizer = AutoTokenizer.from_pretrained(args.tokenizer)
+
+        def count_tokens(text: str) -> int:
+            return len(tokenizer.encode(text, add_special_tokens=False))
+
+    with tempfile.TemporaryDirectory() as workdir:
+        source = args.source
+        if not source:
+            source = os.path.join(workdir, "novels")
+            os.makedirs(source)
+            write_novels(source, args.characters, args.sentences, args.seed)
+        output = os.path.join(workdir, "index")
+        start = time.perf_counter()
+        build_indexes(source, output, args.chunk_chars, args.overlap_chars)
+        print(f"build: {time.perf_counter() - start:.2f}s")
+
+        retriever = ReferenceRetriever(
+            output, args.top_k, args.token_budget, args.max_indexes, count_tokens
+        )
+        character_ids = sorted(int(name) for name in os.listdir(output))
+        loads = []
+        for character_id in character_ids:
+            start = time.perf_counter()
+            retriever.index(character_id)
+            loads.append(time.perf_counter() - start)
+        print(f"lazy load: mean {statistics.fmean(loads) * 1000:.2f}ms per character")
+
+        rng = random.Random(args.seed)
+        latencies, retrieved, shipped = [], [], []
+        for _ in range(args.queries):
+            character_id = rng.choice(character_ids)
+            query = f"{rng.choice(NAMES)}의 {rng.choice(WORDS)} 이야기 해줘"
+            start = time.perf_counter()
+            passages = retriever.retrieve(character_id, query)
+            latencies.append(time.perf_counter() - start)
+            retrieved.append(sum(map(count_tokens, passages)))
+            # What the requests used to carry: a handful of whole excerpts of the novel
+            passages = retriever.index(character_id).passages
+            shipped.append(sum(map(count_tokens, rng.sample(passages, min(len(passages), 12)))))
+
+    unit = "tokens" if args.tokenizer else "chars"
+    print(f"retrieve: {quantiles(latencies)}")
+    print(
+        f"reference: {statistics.fmean(retrieved):.0f} {unit} retrieved, "
+        f"{statistics.fmean(shipped):.0f} {unit} shipped"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--source", help="directory of <characterId>.txt, synthesized if omitted")
+    parser.add_argument("--tokenizer", help="count tokens instead of characters")
+    parser.add_argument("--characters", type=int, default=20)
+    parser.add_argument("--sentences", type=int, default=20000, help="per synthetic novel")
+    parser.add_argument("--chunk-chars", type=int, default=400)
+    parser.add_argument("--overlap-chars", type=int, default=80)
+    parser.add_argument("--top-k", type=int, default=4)
+    parser.add_argument("--token-budget", type=int, default=1200)
+    parser.add_argument("--max-indexes", type=int, default=32)
+    parser.add_argument("--queries", type=int, default=2000)
+    parser.add_argument("--seed", type=int, default=0)
+    main(parser.parse_args())
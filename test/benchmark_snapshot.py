@@ -0,0 +1,148 @@
+"""Compiles a snapshot of a tiny CPU model with a merged LoRA adapter and checks its lifecycle.
+
+A random LoRA adapter is created for --model, then the same HuggingfaceLLM the server uses is
+loaded from source and from the snapshot, and every step is checked:
+
+    no snapshot is found before compiling
+    the compiled manifest hash matches the current config and files
+    the snapshot loads with the adapter merged and gives the logits of base model + adapter
+    touching an adapter file or changing LOAD_IN_4BIT makes the snapshot stale
+    a stale snapshot is ignored and the model loads from source
+
+    python test/benchmark_snapshot.py --model sshleifer/tiny-gpt2
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+import logging
+
+logging.basicConfig(level="WARN")
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+
+ADAPTER = "benchmark"
+TEXT = "Lee Youngjun looked at Kim Miso and said that Kim Miso is his secretary."
+
+
+def configure(workdir: str):
+    """Environment read by the configs, set before anything calls get_*_config."""
+    os.environ.update(
+        PROFILE=os.environ.get("PROFILE", "local"),
+        MODEL_TYPE="lora",
+        PRETRAINED_MODEL_NAME_OR_PATH=os.path.join(workdir, "base"),
+        ADAPTER_DIR=os.path.join(workdir, "adapters"),
+        ADAPTER_NAME=ADAPTER,
+        MODEL_MAX_LENGTH="512",
+        DEVICE="cpu",
+        LOAD_IN_4BIT="false",
+        SNAPSHOT_DIR=os.path.join(workdir, "snapshot"),
+        PROMPT_TEMPLATE="Toonchat_v2.1",
+    )
+
+
+def prepare(args, workdir: str):
+    """Saves --model locally, so its files are hashed, and a random LoRA adapter for it."""
+    import torch
+    from transformers import AutoModelForCausalLM, AutoTokenizer
+    from peft import LoraConfig, get_peft_model
+
+    torch.manual_seed(args.seed)
+    tokenizer = AutoTokenizer.from_pretrained(args.model)
+    model = AutoModelForCausalLM.from_pretrained(args.model, torch_dtype=torch.bfloat16)
+    tokenizer.save_pretrained(os.path.join(workdir, "base"))
+    model.save_pretrained(os.path.join(workdir, "base"), safe_serialization=True)
+    # Not initialized to a no-op, so a merged adapter changes the logits
+    lora = LoraConfig(r=args.rank, lora_alpha=2 * args.rank, init_lora_weights=False)
+    get_peft_model(model, lora).save_pretrained(os.path.join(workdir, "adapters", ADAPTER))
+
+
+def load(template: str):
+    from app.llm.factory import llm_factory
+
+    start = time.perf_counter()
+    llm = llm_factory.create_llm(template)
+    return llm, time.perf_counter() - start
+
+
+def logits(llm):
+    import torch
+
+    input_ids = llm.tokenizer(TEXT, return_tensors="pt")["input_ids"]
+    with torch.no_grad():
+        return llm.model(input_ids=input_ids).logits.float()
+
+
+def check(condition: bool, message: str):
+    if not condition:
+        raise SystemExit(f"FAILED: {message}")
+
+
+def main(args):
+    with tempfile.TemporaryDirectory() as workdir:
+        configure(workdir)
+        prepare(args, workdir)
+        from app.llm.config import get_llm_config
+        from app.llm.snapshot import compile_snapshot, find_snapshot
+
+        kwargs = get_llm_config().model_dump()
+        template, snapshot_dir = kwargs["prompt_template"], kwargs["snapshot_dir"]
+        check(find_snapshot(kwargs) is None, "a snapshot was found before compiling")
+
+        source_llm, source_seconds = load(template)
+        check(source_llm.snapshot is None, "loaded a snapshot before compiling")
+        expected = logits(source_llm)
+        with source_llm.model.disable_adapter():
+            base = logits(source_llm)
+        del source_llm
+
+        start = time.perf_counter()
+        manifest = compile_snapshot(kwargs, snapshot_dir)
+        compile_seconds = time.perf_counter() - start
+        found = find_snapshot(kwargs)
+        check(found is not None and found["hash"] == manifest["hash"], "fresh snapshot is stale")
+        check(manifest["source"]["merged_adapter"] == ADAPTER, "adapter was not merged")
+
+        snapshot_llm, snapshot_seconds = load(template)
+        check(snapshot_llm.snapshot is not None, "the snapshot was not loaded")
+        check(snapshot_llm.adapters is None, "the merged adapter was loaded again")
+        actual = logits(snapshot_llm)
+        # bfloat16 weights, merging rounds differently than applying the adapter on the fly
+        error = (actual - expected).abs().max().item()
+        scale = expected.abs().max().item()
+        adapter_effect = (expected - base).abs().max().item()
+        check(error <= args.tolerance * scale, f"snapshot logits differ by {error:.4g}")
+        check(adapter_effect > error, "the adapter does not change the logits, use another model")
+        del snapshot_llm
+
+        # A changed adapter file, even only its mtime, makes the snapshot stale
+        adapter_file = os.path.join(kwargs["adapter_dir"], ADAPTER, "adapter_config.json")
+        stat = os.stat(adapter_file)
+        os.utime(adapter_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+        check(find_snapshot(kwargs) is None, "snapshot with a changed adapter is not stale")
+        stale_llm, _ = load(template)
+        check(stale_llm.snapshot is None, "a stale snapshot was loaded")
+        del stale_llm
+        os.utime(adapter_file, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        check(find_snapshot(kwargs) is not None, "snapshot is stale with the adapter restored")
+        check(
+            find_snapshot({**kwargs, "load_in_4bit": True}) is None,
+            "snapshot is not stale with LOAD_IN_4BIT changed",
+        )
+
+    print(f"load from source:   {source_seconds * 1000:7.0f}ms")
+    print(f"compile:            {compile_seconds * 1000:7.0f}ms")
+    print(f"load from snapshot: {snapshot_seconds * 1000:7.0f}ms")
+    print(
+        f"max logit error {error:.4g} of {scale:.4g}, adapter changes them by {adapter_effect:.4g}"
+    )
+    print("checks passed: manifest hash, merged adapter, stale detection, fallback to source")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Snapshot compile, staleness and load on CPU")
+    parser.add_argument("--model", default="sshleifer/tiny-gpt2")
+    parser.add_argument("--rank", type=int, default=4, help="of the random LoRA adapter")
+    parser.add_argument("--tolerance", type=float, default=0.05, help="relative logit error")
+    parser.add_argument("--seed", type=int, default=0)
+    main(parser.parse_args())
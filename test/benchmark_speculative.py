@@ -0,0 +1,101 @@
+"""Compares speculative_decode with model.generate on a small CPU model.
+
+Greedy answers have to be identical to model.generate, sampled ones are only timed:
+
+    python test/benchmark_speculative.py --model sshleifer/tiny-gpt2
+    python test/benchmark_speculative.py --model Qwen/Qwen2-0.5B --draft-model Qwen/Qwen2-0.5B
+"""
+import os
+import sys
+import time
+import argparse
+import logging
+
+logging.basicConfig(level="WARN")
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+from app.llm.speculative import (
+    ModelDrafter,
+    PromptLookupDrafter,
+    SpeculationStats,
+    load_draft_model,
+    model_sampling_settings,
+    speculative_decode,
+)
+
+# Repetitive on purpose, like persona and reference passages quoted in answers
+PROMPT = (
+    "Persona: My name is Lee Youngjun. I am the vice president of Yumyung Group. "
+    "Reference: Lee Youngjun looked at Kim Miso and said that Kim Miso is his secretary. "
+    "User: Who is Kim Miso?\nLee Youngjun:"
+)
+
+
+def main(args):
+    import torch
+    from transformers import AutoModelForCausalLM, AutoTokenizer
+
+    torch.manual_seed(args.seed)
+    tokenizer = AutoTokenizer.from_pretrained(args.model)
+    model = AutoModelForCausalLM.from_pretrained(args.model, torch_dtype=torch.float32)
+    model.eval()
+    draft_model = load_draft_model(args.draft_model, "cpu") if args.draft_model else None
+    token_ids = tokenizer.encode(PROMPT)
+    settings = {
+        "max_new_tokens": args.max_new_tokens,
+        "do_sample": args.temperature > 0,
+        "temperature": args.temperature or 1.0,
+        "repetition_penalty": args.repetition_penalty,
+    }
+
+    start = time.perf_counter()
+    with torch.no_grad():
+        output = model.generate(
+            torch.tensor([token_ids]),
+            attention_mask=torch.ones(1, len(token_ids), dtype=torch.long),
+            pad_token_id=tokenizer.eos_token_id,
+            **settings,
+        )
+    baseline_seconds = time.perf_counter() - start
+    expected = output[0, len(token_ids) :].tolist()
+
+    stats = SpeculationStats()
+    drafter = ModelDrafter(draft_model) if draft_model else PromptLookupDrafter(args.max_ngram)
+    start = time.perf_counter()
+    generated = []
+    # generate samples with the top_k and top_p of the model's generation_config
+    speculative_settings = {**model_sampling_settings(model.generation_config), **settings}
+    for tokens in speculative_decode(
+        model,
+        drafter,
+        token_ids,
+        speculative_settings,
+        args.draft_tokens,
+        tokenizer.eos_token_id,
+        stats=stats,
+    ):
+        generated.extend(tokens)
+    speculative_seconds = time.perf_counter() - start
+
+    print(f"generate:    {len(expected)} tokens in {baseline_seconds * 1000:.0f}ms")
+    print(f"speculative: {len(generated)} tokens in {speculative_seconds * 1000:.0f}ms")
+    print(f"stats: {stats.report()}")
+    if not settings["do_sample"]:
+        matches = generated == expected
+        print(f"greedy output identical: {matches}")
+        if not matches:
+            print(f"expected: {tokenizer.decode(expected)!r}")
+            print(f"got:      {tokenizer.decode(generated)!r}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", default="sshleifer/tiny-gpt2")
+    parser.add_argument("--draft-model", help="draft with a model instead of prompt lookup")
+    parser.add_argument("--draft-tokens", type=int, default=8)
+    parser.add_argument("--max-ngram", type=int, default=3)
+    parser.add_argument("--max-new-tokens", type=int, default=64)
+    parser.add_argument("--temperature", type=float, default=0.0, help="0 for greedy")
+    parser.add_argument("--repetition-penalty", type=float, default=1.3)
+    parser.add_argument("--seed", type=int, default=0)
+    main(parser.parse_args())
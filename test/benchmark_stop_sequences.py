@@ -0,0 +1,157 @@
+"""Tokens saved per request by stopping on the stop sequences of a prompt template.
+
+With --answers, raw completions recorded before stop sequences existed (JSONL of
+{"completion": ...}, or of plain strings) are tokenized and the tokens after the first stop
+sequence are counted, no model is needed:
+
+    python test/benchmark_stop_sequences.py --tokenizer <path> --answers completions.jsonl
+
+Without it, --model generates answers to a few conversations twice, with and without the
+stop criteria, and compares the generated tokens and time:
+
+    python test/benchmark_stop_sequences.py --model <path> --template Toonchat_v2.3
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import datetime
+import statistics
+import logging
+
+logging.basicConfig(level="WARN")
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+from app.llm.stop_sequences import StopSequences
+
+QUESTIONS = ["너는 오늘 뭐 했어?", "좋아하는 음식이 뭐야?", "내일 같이 산책 갈래?", "비서는 누구야?"]
+
+
+def prompter_class(template: str):
+    from app.llm.factory import llm_factory
+
+    return llm_factory.llm_models[template][1]
+
+
+def load_completions(path: str) -> list[str]:
+    completions = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                data = json.loads(line)
+                completions.append(data["completion"] if isinstance(data, dict) else data)
+    return completions
+
+
+def replay_completions(args, tokenizer, stop_sequences: StopSequences):
+    saved, stopped = [], 0
+    for completion in load_completions(args.answers):
+        token_ids = tokenizer.encode(completion, add_special_tokens=False)
+        end = stop_sequences.find_ids(token_ids)
+        if end < 0 and stop_sequences.find(completion) >= 0:
+            # Tokenized unlike any variant, generation would only have stopped on eos
+            end = len(token_ids)
+        stopped += end >= 0
+        saved.append(len(token_ids) - end if end >= 0 else 0)
+    print(f"completions: {len(saved)}, stopped by a stop sequence: {stopped}")
+    print(f"tokens saved per request: mean {statistics.fmean(saved):.1f}, max {max(saved)}")
+
+
+def prompt_data(question: str):
+    from app.message_queue.codec import decode_prompt_data
+
+    now = datetime.datetime.now(datetime.timezone.utc).isoformat()
+    return decode_prompt_data(
+        {
+            "persona": "나는 유명그룹 부회장 이영준이다. 비서 김미소와 일한다.",
+            "reference": [],
+            "history": {
+                "_id": "history",
+                "userId": "user",
+                "characterId": 0,
+                "messages": [
+                    {
+                        "messageId": "0",
+                        "replyMessageId": None,
+                        "createdAt": now,
+                        "content": question,
+                        "fromUser": True,
+                    }
+                ],
+            },
+            "generationArgs": {"temperature": 0.3, "repetition_penalty": 1.3},
+        }
+    )
+
+
+def generate(args, tokenizer, stop_sequences: StopSequences):
+    import torch
+    from transformers import AutoModelForCausalLM
+    from app.llm.models import stopping_criteria
+
+    model = AutoModelForCausalLM.from_pretrained(args.model, torch_dtype="auto")
+    model.eval()
+    prompter = prompter_class(args.template)(tokenizer=tokenizer)
+    settings = {
+        "max_new_tokens": args.max_new_tokens,
+        "do_sample": False,
+        "repetition_penalty": 1.3,
+        "pad_token_id": tokenizer.eos_token_id,
+    }
+
+    results = {"eos only": [], "stop sequences": []}
+    for question in QUESTIONS:
+        token_ids = tokenizer.encode(
+            prompter.get_prompt(prompt_data(question)),
+            add_special_tokens=False,
+            return_tensors="pt",
+        )
+        for name, stops in (("eos only", None), ("stop sequences", stop_sequences)):
+            start = time.perf_counter()
+            with torch.no_grad():
+                output = model.generate(
+                    token_ids,
+                    attention_mask=torch.ones_like(token_ids),
+                    **stopping_criteria(stop_sequences=stops, prompt_length=token_ids.shape[1]),
+                    **settings,
+                )
+            seconds = time.perf_counter() - start
+            generated = output[0, token_ids.shape[1] :].tolist()
+            answer = stop_sequences.trim(tokenizer.decode(generated, skip_special_tokens=True))
+            results[name].append((len(generated), seconds, answer))
+
+    for name, rows in results.items():
+        print(
+            f"{name:>15}: {statistics.fmean(r[0] for r in rows):6.1f} tokens/request, "
+            f"{statistics.fmean(r[1] for r in rows) * 1000:7.0f}ms/request"
+        )
+    saved = [
+        a[0] - b[0] for a, b in zip(results["eos only"], results["stop sequences"], strict=True)
+    ]
+    print(f"tokens saved per request: mean {statistics.fmean(saved):.1f}, max {max(saved)}")
+    same = sum(
+        a[2] == b[2] for a, b in zip(results["eos only"], results["stop sequences"], strict=True)
+    )
+    print(f"identical answers: {same}/{len(QUESTIONS)}")
+
+
+def main(args):
+    from transformers import AutoTokenizer
+
+    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer or args.model)
+    stop_sequences = StopSequences(tokenizer, prompter_class(args.template).stop_sequences)
+    print(f"{args.template}: {len(stop_sequences.variants)} token id variants")
+    if args.answers:
+        replay_completions(args, tokenizer, stop_sequences)
+    else:
+        generate(args, tokenizer, stop_sequences)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model")
+    parser.add_argument("--tokenizer", help="defaults to the tokenizer of --model")
+    parser.add_argument("--template", default="Toonchat_v2.3", help="registered prompt_template")
+    parser.add_argument("--answers", help="JSONL of recorded completions")
+    parser.add_argument("--max-new-tokens", type=int, default=256)
+    main(parser.parse_args())
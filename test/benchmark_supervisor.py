@@ -0,0 +1,145 @@
+"""Routes requests to two MockLLM models served by ModelSupervisor worker processes.
+
+Checks that every request is answered by the model it names, measures throughput with 1, 2
+and 4 workers per model, checks that count_tokens does not wait behind a running generate,
+and kills a worker in the middle of a run to check that its requests are answered by the
+restarted process:
+
+    python test/benchmark_supervisor.py
+"""
+import os
+import sys
+import time
+import signal
+import argparse
+import datetime
+import threading
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+logging.basicConfig(level="WARN")
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+# Environment read by the configs, spawned workers inherit it
+os.environ.update(
+    PROFILE=os.environ.get("PROFILE", "local"),
+    MODEL_TYPE="pure",
+    PRETRAINED_MODEL_NAME_OR_PATH="mock",
+    MODEL_MAX_LENGTH="4096",
+    PROMPT_TEMPLATE="Mock",
+)
+from app.message_queue.data import PromptData
+from app.message_queue.codec import decode_prompt_data
+from app.llm.supervisor import ModelSupervisor, ModelWorker
+
+MODELS = ("small", "large")
+
+
+def prompt_data(i: int) -> PromptData:
+    return decode_prompt_data(
+        {
+            "persona": "나는 이영준이다.",
+            "reference": [],
+            "history": {
+                "_id": f"history_{i}",
+                "userId": f"user_{i}",
+                "characterId": 0,
+                "messages": [
+                    {
+                        "messageId": f"message_{i}",
+                        "replyMessageId": None,
+                        "createdAt": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                        "content": "너는 오늘 뭐 했어?",
+                        "fromUser": True,
+                    }
+                ],
+            },
+            "generationArgs": {"temperature": 0.3, "repetition_penalty": 1.3},
+            "model": MODELS[i % len(MODELS)],
+        }
+    )
+
+
+def start(args, workers_per_model: int) -> ModelSupervisor:
+    return ModelSupervisor(
+        models={
+            name: {
+                "prompt_template": "Mock",
+                "mock_answer": f"answer of {name}",
+                "mock_latency": args.latency,
+            }
+            for name in MODELS
+        },
+        workers_per_model=workers_per_model,
+        load_timeout=60,
+    )
+
+
+def run(supervisor: ModelSupervisor, requests: int, concurrency: int) -> tuple[float, int]:
+    """Returns (requests per second, number of wrong answers)."""
+    data_list = [prompt_data(i) for i in range(requests)]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        answers = list(pool.map(supervisor.generate, data_list))
+    elapsed = time.perf_counter() - start
+    wrong = sum(
+        answer != f"answer of {data.model}" for data, answer in zip(data_list, answers, strict=True)
+    )
+    return requests / elapsed, wrong
+
+
+def count_tokens_latency(supervisor: ModelSupervisor, generate_latency: float) -> float:
+    """Seconds count_tokens takes on a worker that is busy with a generate."""
+    data = prompt_data(0)
+    worker = supervisor.worker(supervisor.route(data))
+    generating = worker.submit("generate_batch", [data])
+    # Let the generate start before counting
+    time.sleep(generate_latency / 4)
+    start = time.perf_counter()
+    worker.submit("count_tokens", data).result()
+    elapsed = time.perf_counter() - start
+    generating.result()
+    return elapsed
+
+
+def main(args):
+    ModelWorker.restart_delay = 0.2
+    ModelWorker.poll_interval = 0.05
+    failed = False
+
+    for workers_per_model in (1, 2, 4):
+        supervisor = start(args, workers_per_model)
+        throughput, wrong = run(supervisor, args.requests, args.concurrency)
+        supervisor.shutdown()
+        print(f"workers_per_model={workers_per_model}: {throughput:7.1f} req/s, wrong={wrong}")
+        failed |= wrong > 0
+
+    slow_args = argparse.Namespace(**{**vars(args), "latency": 1.0})
+    supervisor = start(slow_args, 1)
+    latency = count_tokens_latency(supervisor, slow_args.latency)
+    supervisor.shutdown()
+    print(f"count_tokens during a {slow_args.latency:.1f}s generate: {latency * 1000:.0f}ms")
+    failed |= latency >= slow_args.latency / 2
+
+    supervisor = start(args, 2)
+    victim = supervisor.workers[MODELS[0]][0]
+    # Killed while requests are in flight on it, they are sent again to the new process
+    killer = threading.Timer(args.kill_after, os.kill, (victim._process.pid, signal.SIGKILL))
+    killer.start()
+    throughput, wrong = run(supervisor, args.requests, args.concurrency)
+    killer.join()
+    report = supervisor.report()
+    supervisor.shutdown()
+    restarts = sum(worker["restarts"] for worker in report.values())
+    print(f"crash: {throughput:7.1f} req/s, wrong={wrong}, restarts={restarts}")
+    failed |= wrong > 0 or restarts != 1
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=400)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--latency", type=float, default=0.02, help="seconds per generate")
+    parser.add_argument("--kill-after", type=float, default=0.3, help="seconds into the run")
+    main(parser.parse_args())